@@ -1,10 +1,29 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from routers import api, templates as template_router
+from compression import CompressionMiddleware, PrecompressedStaticFiles
+from crud import get_storage
+from routers import api, docs, templates as template_router, ws
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Сжатые варианты статики: дальше она отдаётся без сжатия на запрос.
+    static_files.precompress()
+    # Схема OpenAPI и страницы документации — готовыми байтами.
+    docs.build(app, app.root_path.rstrip("/"))
+    yield
+    # Сбросить журнал на диск / закрыть соединения с базой.
+    get_storage().close()
 
 
 app = FastAPI(
+    lifespan=lifespan,
+    # Схему и документацию отдаёт routers.docs из кеша.
+    openapi_url=None,
+    docs_url=None,
+    redoc_url=None,
     title="Users CRUD example",
     summary="Пример CRUD-сервиса пользователей на FastAPI",
     description="""
@@ -14,6 +33,9 @@ API демонстрирует базовые CRUD-операции над по
 - Валидация входных данных через Pydantic
 - Уникальность `email`
 - Подробные описания эндпоинтов/моделей для Swagger UI и ReDoc
+- Форматы тел: JSON по умолчанию, MessagePack (`application/msgpack`) и CBOR
+  (`application/cbor`) — по заголовкам `Accept` и `Content-Type`. Ошибки
+  всегда в JSON; выгрузка (`/users/export`) и поток изменений — в своих форматах.
 """,
     version="1.0.0",
     contact={
@@ -33,7 +55,11 @@ API демонстрирует базовые CRUD-операции над по
     ],
 )
 templates = Jinja2Templates(directory="templates")
-app.mount('/static', StaticFiles(directory='static'), name='static')
+static_files = PrecompressedStaticFiles(directory='static')
+app.mount('/static', static_files, name='static')
+app.add_middleware(CompressionMiddleware)
 
 app.include_router(template_router.router)
+app.include_router(docs.router)
 app.include_router(api.router)
+app.include_router(ws.router)
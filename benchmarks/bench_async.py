@@ -0,0 +1,114 @@
+"""Режимы выполнения эндпоинтов (`TUPAK_API_MODE`): sync и async.
+
+Поднимаем uvicorn в отдельном процессе для каждого режима и держим
+`CONNECTIONS` keep-alive соединений, каждое шлёт GET /users/{id} подряд.
+Клиент — сырые asyncio-сокеты, чтобы генератор нагрузки сам не упирался
+в разбор HTTP. Печатаем пропускную способность и p50/p99 задержки.
+
+Запуск из корня репозитория (нужен лимит файлов больше CONNECTIONS,
+например `ulimit -n 4096`):
+
+    python -m benchmarks.bench_async
+"""
+
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import List
+
+HOST = "127.0.0.1"
+CONNECTIONS = 1000
+DURATION = 10.0
+USERS = 1000
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode: str, port: int) -> subprocess.Popen:
+    env = {**os.environ, "TUPAK_API_MODE": mode, "TUPAK_STORAGE": "memory"}
+    env.pop("TUPAK_JOURNAL_DIR", None)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", HOST, "--port", str(port),
+         "--log-level", "warning", "--no-access-log", "--backlog", str(CONNECTIONS * 2)],
+        env=env,
+    )
+
+
+async def request(reader, writer, method: str, path: str, body: bytes = b"") -> bytes:
+    head = f"{method} {path} HTTP/1.1\r\nHost: {HOST}\r\nContent-Length: {len(body)}\r\n"
+    if body:
+        head += "Content-Type: application/json\r\n"
+    writer.write(head.encode() + b"\r\n" + body)
+    headers = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in headers.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.lower() == b"content-length":
+            length = int(value)
+    return await reader.readexactly(length)
+
+
+async def wait_ready(port: int) -> None:
+    for _ in range(100):
+        try:
+            reader, writer = await asyncio.open_connection(HOST, port)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return
+    raise RuntimeError("server did not start")
+
+
+async def seed(port: int) -> None:
+    reader, writer = await asyncio.open_connection(HOST, port)
+    users = [{"name": f"User {i}", "email": f"user{i}@example.com"} for i in range(USERS)]
+    await request(reader, writer, "POST", "/users/bulk", json.dumps(users).encode())
+    writer.close()
+
+
+async def worker(port: int, index: int, deadline: float, latencies: List[float]) -> None:
+    reader, writer = await asyncio.open_connection(HOST, port)
+    user_id = index % USERS + 1
+    while (start := time.perf_counter()) < deadline:
+        await request(reader, writer, "GET", f"/users/{user_id}")
+        latencies.append(time.perf_counter() - start)
+        user_id = user_id % USERS + 1
+    writer.close()
+
+
+async def load(port: int) -> List[float]:
+    await wait_ready(port)
+    await seed(port)
+    latencies: List[float] = []
+    deadline = time.perf_counter() + DURATION
+    await asyncio.gather(*(worker(port, i, deadline, latencies) for i in range(CONNECTIONS)))
+    return latencies
+
+
+def main() -> None:
+    print(f"{CONNECTIONS} connections, GET /users/{{id}}, {DURATION:.0f} s per mode")
+    for mode in ("sync", "async"):
+        port = free_port()
+        server = start_server(mode, port)
+        try:
+            latencies = asyncio.run(load(port))
+        finally:
+            server.terminate()
+            server.wait()
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(f"  {mode:<6} {len(latencies) / DURATION:>10,.0f} req/s   p50 {p50:>7.1f} ms   p99 {p99:>7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
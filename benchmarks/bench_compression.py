@@ -0,0 +1,50 @@
+"""Сжатие ответов: размер и цена на запрос для уровней gzip и brotli.
+
+Тело — `GET /users` на 1000 пользователей (как его отдаёт API) и файлы
+`static/css`. Для каждого кодировщика печатаем размер и время сжатия
+одного ответа: по ним выбраны уровни на лету (`config.GZIP_LEVEL`,
+`config.BROTLI_QUALITY`), а для статики — максимальные, потому что она
+сжимается один раз при старте.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.bench_compression
+"""
+
+import glob
+import timeit
+
+import compression
+import crud
+import database
+from schemas import UserCreate
+
+
+def bench(label: str, body: bytes, encoding: str, level: int, number: int) -> None:
+    encode = lambda: compression.Encoder(encoding, level).encode(body, final=True)
+    seconds = min(timeit.repeat(encode, number=number, repeat=5)) / number
+    print(f"  {label:<12}{len(encode()):>10,} bytes{seconds * 1e6:>12,.1f} us")
+
+
+def main() -> None:
+    database.reset()
+    storage = crud.InMemoryUserStorage()
+    for i in range(1000):
+        storage.create(UserCreate(name=f"Иван Петров {i}", email=f"user{i}@example.com"))
+    users = b"[" + b",".join(map(storage.encode, storage.list())) + b"]"
+    css = b"".join(open(path, "rb").read() for path in sorted(glob.glob("static/css/*.css")))
+    database.reset()
+
+    for title, body, number in (("GET /users, 1000 users", users, 20), ("static/css", css, 200)):
+        print(f"{title}: {len(body):,} bytes")
+        for level in (1, 6, 9):
+            bench(f"gzip {level}", body, "gzip", level, number)
+        if compression.brotli is not None:
+            for quality in (1, 4, 6, 11):
+                bench(f"br {quality}", body, "br", quality, number)
+        else:
+            print("  brotli is not installed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""JSON против MessagePack и CBOR: размер тел и стоимость кодирования.
+
+Для каждого формата (`media.CODECS`) на тех же путях, что и в
+`routers/api.py`:
+
+- ответ — один пользователь и страница из 1000: сервер кодирует
+  (`user_encoder` + `Codec.array`), клиент разбирает;
+- запрос — пачка из 1000 `UserCreate`: разбор тела и валидация
+  (`parse_batch` + `validate_batch`), как в `POST /users/bulk`.
+
+JSON со всеми полями у in-memory хранилища — готовые байты из
+`json_cache`, поэтому его кодирование почти бесплатно; строка
+`JSON (fresh)` — кодирование без кеша, как у MessagePack и CBOR.
+
+Запуск из корня репозитория (нужен extra `binary`):
+
+    python -m benchmarks.bench_encoding
+"""
+
+import timeit
+
+import crud
+import database
+import media
+from routers.api import binary_encoder, fieldset_encoder, parse_batch, validate_batch
+from schemas import User, UserCreate
+
+
+def bench(func, number: int) -> float:
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main() -> None:
+    database.reset()
+    storage = crud.InMemoryUserStorage()
+    for i in range(1000):
+        storage.create(UserCreate(name=f"Иван Петров {i}", email=f"user{i}@example.com"))
+    users = storage.list()
+    batch = [{"name": f"Анна Иванова {i}", "email": f"anna{i}@example.com"} for i in range(1000)]
+
+    codecs = {codec.name: codec for codec in media.CODECS.values()}
+    fresh = fieldset_encoder(tuple(User.model_fields))
+    encoders = [("JSON", media.JSON, storage.encode), ("JSON (fresh)", media.JSON, fresh)]
+    encoders += [(name, codec, binary_encoder(codec, None)) for name, codec in codecs.items() if codec is not media.JSON]
+
+    print(f"{'':<14}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for title, content, number in (("single user", users[:1], 20_000), ("1000 users", users, 50)):
+        print(title)
+        for name, codec, encode in encoders:
+            body = codec.array(list(map(encode, content)))
+            encode_us = bench(lambda: codec.array(list(map(encode, content))), number)
+            decode_us = bench(lambda: codec.loads(body), number)
+            print(f"  {name:<12}{len(body):>8,}{encode_us:>12,.1f}{decode_us:>12,.1f}")
+
+    print("bulk request, 1000 items (parse + validate)")
+    for name, codec in codecs.items():
+        body = codec.dumps(batch)
+        parse_us = bench(lambda: validate_batch(parse_batch(body, codec.media_type), UserCreate), 20)
+        print(f"  {name:<12}{len(body):>8,}{'':>12}{parse_us:>12,.1f}")
+    database.reset()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Стоимость блокировки записи в InMemoryUserStorage.
+
+Несколько потоков (как threadpool FastAPI) создают пользователей.
+Сравниваем хранилище с блокировкой и без неё: пропускную способность и
+нарушения инвариантов (дубли email) при гонке за одни и те же email.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.bench_locking
+"""
+
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import crud
+import database
+from schemas import UserCreate
+
+
+THREADS = 40
+OPS_PER_THREAD = 1000
+
+
+def make_storage(locked: bool) -> crud.InMemoryUserStorage:
+    database.reset()
+    storage = crud.InMemoryUserStorage()
+    if not locked:
+        storage._lock = contextlib.nullcontext()
+    return storage
+
+
+def run(storage: crud.InMemoryUserStorage, payloads) -> float:
+    def worker(chunk):
+        for payload in chunk:
+            try:
+                storage.create(payload)
+            except crud.EmailAlreadyExistsError:
+                pass
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        list(pool.map(worker, payloads))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    total = THREADS * OPS_PER_THREAD
+    # Уникальные email: чистая пропускная способность.
+    unique = [
+        [UserCreate(name="U", email=f"u{t}-{i}@example.com") for i in range(OPS_PER_THREAD)]
+        for t in range(THREADS)
+    ]
+    # Все потоки гоняются за одними и теми же email.
+    contended = [
+        [UserCreate(name="U", email=f"u{i}@example.com") for i in range(OPS_PER_THREAD)]
+        for _ in range(THREADS)
+    ]
+
+    print(f"{THREADS} threads x {OPS_PER_THREAD} creates")
+    for locked in (False, True):
+        label = "locked  " if locked else "unlocked"
+        elapsed = run(make_storage(locked), unique)
+        print(f"{label} unique emails:    {total / elapsed:>10,.0f} ops/s")
+
+        storage = make_storage(locked)
+        elapsed = run(storage, contended)
+        duplicates = len(database.users) - len(database.emails)
+        print(
+            f"{label} contended emails: {total / elapsed:>10,.0f} ops/s, "
+            f"users={len(database.users)}, duplicate emails={duplicates}"
+        )
+    database.reset()
+
+
+if __name__ == "__main__":
+    main()
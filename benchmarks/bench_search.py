@@ -0,0 +1,91 @@
+"""Поиск по индексам InMemoryUserStorage на миллионе пользователей.
+
+Имена собираются из небольших словарей имён и фамилий (как в жизни,
+многие триграммы встречаются у десятков тысяч пользователей), email
+уникальны. Для сравнения — линейный проход по `database.users`.
+
+Заполнение идёт в обход валидации (`model_construct`) — это замер
+поиска, а не создания пользователей.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.bench_search
+"""
+
+import itertools
+import time
+import timeit
+
+import crud
+import database
+import search
+from schemas import User
+
+
+USERS = 1_000_000
+
+FIRST_NAMES = ["Иван", "Анна", "Пётр", "Мария", "Олег", "Елена", "Сергей", "Ольга", "Дмитрий", "Наталья"]
+LAST_NAMES = [
+    "Петров", "Иванов", "Смирнов", "Кузнецов", "Попов", "Васильев", "Соколов", "Михайлов",
+    "Новиков", "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семёнов", "Егоров",
+]
+LATIN = {"Иван": "ivan", "Анна": "anna", "Пётр": "petr", "Мария": "maria", "Олег": "oleg",
+         "Елена": "elena", "Сергей": "sergey", "Ольга": "olga", "Дмитрий": "dmitry", "Наталья": "natalia"}
+
+
+def queries():
+    sample = database.users[123456]
+    return [
+        ("email, точное", sample.email),
+        ("email, префикс", sample.email[:-14]),
+        ("имя, редкое", sample.name.lower()),
+        ("имя, частое", "петров"),
+    ]
+
+
+def populate(storage: crud.InMemoryUserStorage) -> None:
+    names = itertools.cycle(itertools.product(FIRST_NAMES, LAST_NAMES))
+    now = crud.utcnow()
+    users = []
+    for user_id in range(1, USERS + 1):
+        first, last = next(names)
+        # Номер в имени делает часть запросов избирательной.
+        name = f"{first} {last} {user_id}"
+        user = User.model_construct(
+            id=user_id, name=name, email=f"{LATIN[first]}.{user_id}@example.com",
+            created_at=now, updated_at=now, seq=storage._next_seq(),
+        )
+        storage._insert(user, reindex=False)
+        users.append(user)
+    storage._merge_sorted(users)
+    database.next_id = USERS + 1
+
+
+def linear(query: str, limit: int = 20):
+    return search.top(database.users.values(), query, None, limit)
+
+
+def bench(label: str, func, number: int) -> float:
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"  {label:<12} {seconds * 1e3:>10,.3f} ms")
+    return seconds
+
+
+def main() -> None:
+    database.reset()
+    storage = crud.InMemoryUserStorage()
+    start = time.perf_counter()
+    populate(storage)
+    print(f"{USERS:,} users indexed in {time.perf_counter() - start:.1f} s")
+
+    for label, query in queries():
+        q = search.normalize(query)
+        found = storage.search(q)
+        assert [u.id for _, u in found] == [u.id for _, u in linear(q)], query
+        print(f"{label}: {query!r} ({len(found)} on first page)")
+        bench("index", lambda: storage.search(q), number=20)
+        bench("linear scan", lambda: linear(q), number=1)
+
+
+if __name__ == "__main__":
+    main()
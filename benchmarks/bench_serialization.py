@@ -0,0 +1,67 @@
+"""Стоимость кодирования ответа: один пользователь и список из 10k.
+
+Сравниваются пути, которыми `routers/api.py` может превратить `User` в
+байты ответа:
+
+- `stdlib json` — путь FastAPI до 0.130 (в uv.lock зафиксирована 0.128):
+  `response_model` -> dict -> `JSONResponse` (`json.dumps`);
+- `FastJSONResponse` — тот же dict, но кодирование через orjson;
+- `pydantic dump_json` — быстрый путь FastAPI >= 0.130, он включается
+  только при ответе по умолчанию (`JSONResponse`);
+- `json_cache` — готовые байты из in-memory хранилища (GET-эндпоинты).
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.bench_serialization
+"""
+
+import timeit
+from typing import List
+
+from fastapi.responses import JSONResponse, Response
+from pydantic import TypeAdapter
+
+import crud
+import database
+import responses
+from schemas import User, UserCreate
+
+
+def bench(label: str, func, number: int) -> None:
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"  {label:<20} {seconds * 1e6:>12,.1f} us")
+
+
+def main() -> None:
+    database.reset()
+    storage = crud.InMemoryUserStorage()
+    for i in range(10_000):
+        storage.create(UserCreate(name=f"Иван Петров {i}", email=f"user{i}@example.com"))
+    users = storage.list()
+
+    if responses.orjson is None:
+        print("orjson is not installed: FastJSONResponse falls back to stdlib json\n")
+
+    cases = [
+        ("single user", users[0], TypeAdapter(User), 20_000),
+        ("10k users", users, TypeAdapter(List[User]), 20),
+    ]
+    for title, content, adapter, number in cases:
+        print(title)
+        bench("stdlib json", lambda: JSONResponse(adapter.dump_python(content, mode="json")), number)
+        bench(
+            "FastJSONResponse",
+            lambda: responses.FastJSONResponse(adapter.dump_python(content, mode="json")),
+            number,
+        )
+        bench("pydantic dump_json", lambda: Response(adapter.dump_json(content), media_type="application/json"), number)
+        if isinstance(content, list):
+            cached = lambda: b"[" + b",".join(map(storage.encode, content)) + b"]"
+        else:
+            cached = lambda: storage.encode(content)
+        bench("json_cache", lambda: Response(cached(), media_type="application/json"), number)
+    database.reset()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""WebSocket-канал `/ws/users` против REST-эндпоинтов.
+
+Один uvicorn (`TUPAK_API_MODE=async`, память) и одинаковая нагрузка:
+`CONNECTIONS` соединений, каждое по кругу читает и переименовывает
+пользователей (GET и PUT через раз). Сравниваем:
+
+- rest — keep-alive HTTP/1.1, запрос за запросом (клиент из bench_async);
+- ws — запрос за запросом по WebSocket;
+- ws xN — по WebSocket с `DEPTH` запросами в полёте, ответы по `id`.
+
+Печатаем операции в секунду. Uvicorn нужен пакет `websockets`, он же —
+клиент бенчмарка:
+
+    pip install websockets
+    python -m benchmarks.bench_ws
+"""
+
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, List
+
+from websockets.asyncio.client import connect
+
+from benchmarks.bench_async import HOST, USERS, free_port, request, seed, start_server, wait_ready
+
+CONNECTIONS = 50
+DEPTH = 16
+DURATION = 5.0
+
+
+def operation(index: int) -> dict:
+    """`index`-я операция соединения: GET и PUT через раз."""
+    user_id = index // 2 % USERS + 1
+    if index % 2:
+        return {"op": "update", "user_id": user_id, "user": {"name": f"User {index}"}}
+    return {"op": "get", "user_id": user_id}
+
+
+async def rest_worker(port: int, offset: int, deadline: float) -> int:
+    reader, writer = await asyncio.open_connection(HOST, port)
+    done = 0
+    while time.perf_counter() < deadline:
+        op = operation(offset + done)
+        path = f"/users/{op['user_id']}"
+        if op["op"] == "get":
+            await request(reader, writer, "GET", path)
+        else:
+            await request(reader, writer, "PUT", path, json.dumps(op["user"]).encode())
+        done += 1
+    writer.close()
+    return done
+
+
+async def ws_worker(port: int, offset: int, deadline: float, depth: int = 1) -> int:
+    async with connect(f"ws://{HOST}:{port}/ws/users", compression=None) as ws:
+        sent = done = 0
+        while time.perf_counter() < deadline:
+            while sent - done < depth:
+                await ws.send(json.dumps({"id": sent, **operation(offset + sent)}))
+                sent += 1
+            reply = json.loads(await ws.recv())
+            assert reply["status"] == 200, reply
+            done += 1
+        return done
+
+
+async def load(port: int, worker: Callable[[int, int, float], Awaitable[int]]) -> int:
+    deadline = time.perf_counter() + DURATION
+    counts: List[int] = await asyncio.gather(*(worker(port, i * 7, deadline) for i in range(CONNECTIONS)))
+    return sum(counts)
+
+
+async def run(port: int) -> None:
+    await wait_ready(port)
+    await seed(port)
+    workers = [
+        ("rest", rest_worker),
+        ("ws", ws_worker),
+        (f"ws x{DEPTH}", lambda port, offset, deadline: ws_worker(port, offset, deadline, DEPTH)),
+    ]
+    for name, worker in workers:
+        ops = await load(port, worker)
+        print(f"  {name:<7} {ops / DURATION:>10,.0f} ops/s")
+
+
+def main() -> None:
+    print(f"{CONNECTIONS} connections, GET/PUT by id, {DURATION:.0f} s per transport")
+    port = free_port()
+    server = start_server("async", port)
+    try:
+        asyncio.run(run(port))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""Сжатие ответов: gzip и brotli на лету и заранее сжатая статика.
+
+- `CompressionMiddleware` сжимает ответы приложения по `Accept-Encoding`
+  (brotli, если установлен пакет `brotli` — `pip install tupak-api[brotli]`,
+  иначе gzip). Ответы меньше `config.COMPRESSION_MIN_SIZE`, уже сжатые
+  форматы (картинки) и поток событий (`text/event-stream`) не сжимаются.
+  Потоковые ответы (`/users/export`) сжимаются по частям: каждая часть
+  дожимается до границы блока (flush), так что клиент получает данные
+  сразу, а не в конце выгрузки.
+- `precompress_directory` при старте кладёт рядом с файлами статики
+  варианты `.br`/`.gz` (с максимальным уровнем сжатия), а
+  `PrecompressedStaticFiles` отдаёт их как есть — без сжатия на запрос.
+"""
+
+import mimetypes
+import os
+import zlib
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import config
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - зависит от окружения
+    brotli = None
+
+
+# Поддерживаемые кодировки в порядке предпочтения.
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+# Суффиксы заранее сжатых файлов.
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+# Типы, которые имеет смысл сжимать. `text/event-stream` исключён: события
+# мелкие, а сжатие с flush на каждом из них только добавляет байты.
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+    "application/msgpack",
+    "application/cbor",
+    "image/svg+xml",
+)
+UNCOMPRESSIBLE_TYPES = ("text/event-stream",)
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    if not content_type:
+        return False
+    content_type = content_type.lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) and not content_type.startswith(UNCOMPRESSIBLE_TYPES)
+
+
+@lru_cache(maxsize=256)
+def accepted_encodings(accept_encoding: Optional[str]) -> Tuple[str, ...]:
+    """Поддерживаемые кодировки из `Accept-Encoding` в порядке предпочтения.
+
+    Кодировки с `q=0` исключаются; `*` разрешает все поддерживаемые.
+    """
+    if not accept_encoding:
+        return ()
+    weights: Dict[str, float] = {}
+    for entry in accept_encoding.split(","):
+        coding, *params = entry.split(";")
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.strip().lower()] = q
+    default = weights.get("*", 0.0)
+    return tuple(coding for coding in ENCODINGS if weights.get(coding, default) > 0)
+
+
+class Encoder:
+    """Потоковый кодировщик: `encode` с `final=False` дожимает до границы блока."""
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=level)
+        else:
+            self._gzip = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def encode(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.process(data) + (self._brotli.finish() if final else self._brotli.flush())
+        return self._gzip.compress(data) + self._gzip.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Сжать файл целиком с максимальным уровнем (для статики)."""
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return Encoder("gzip", 9).encode(data, final=True)
+
+
+class CompressionMiddleware:
+    """ASGI-middleware: сжатие ответов по `Accept-Encoding`."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = config.COMPRESSION_MIN_SIZE,
+        gzip_level: int = config.GZIP_LEVEL,
+        brotli_quality: int = config.BROTLI_QUALITY,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = {"gzip": gzip_level, "br": brotli_quality}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # У ответа на HEAD нет тела: сжимать нечего.
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encodings = accepted_encodings(Headers(scope=scope).get("accept-encoding"))
+        if not encodings:
+            await self.app(scope, receive, send)
+            return
+        encoding = encodings[0]
+        responder = CompressingSender(send, encoding, self.levels[encoding], self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class CompressingSender:
+    """Сжимает тело одного ответа; решение принимается по первому куску тела."""
+
+    def __init__(self, send: Send, encoding: str, level: int, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self._start: Optional[Message] = None
+        self._encoder: Optional[Encoder] = None
+        self._decided = False
+
+    def _should_compress(self, headers: MutableHeaders, body: bytes, more_body: bool) -> bool:
+        if self._start["status"] in (204, 206, 304) or "content-encoding" in headers or "content-range" in headers:
+            return False
+        if not is_compressible(headers.get("content-type")):
+            return False
+        length = headers.get("content-length")
+        size = int(length) if length is not None and length.isdigit() else None
+        if size is None and not more_body:
+            size = len(body)
+        # Потоковый ответ без длины сжимается всегда: размер заранее неизвестен.
+        return size is None or size >= self.minimum_size
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self._start = message
+            return
+        if self._decided or self._start is None:
+            # Служебные сообщения до начала ответа (`http.response.debug`) — как есть.
+            if self._encoder is not None and message["type"] == "http.response.body":
+                more_body = message.get("more_body", False)
+                message = {**message, "body": self._encoder.encode(message.get("body", b""), final=not more_body)}
+            await self._send(message)
+            return
+
+        self._decided = True
+        headers = MutableHeaders(raw=self._start["headers"])
+        if message["type"] != "http.response.body":
+            await self._send(self._start)
+            await self._send(message)
+            return
+        body, more_body = message.get("body", b""), message.get("more_body", False)
+        if is_compressible(headers.get("content-type")):
+            headers.add_vary_header("Accept-Encoding")
+        if not self._should_compress(headers, body, more_body):
+            await self._send(self._start)
+            await self._send(message)
+            return
+
+        self._encoder = Encoder(self.encoding, self.level)
+        body = self._encoder.encode(body, final=not more_body)
+        headers["Content-Encoding"] = self.encoding
+        etag = headers.get("etag")
+        if etag is not None and not etag.startswith("W/"):
+            # Сжатое представление не побайтово равно исходному: ETag становится слабым.
+            headers["ETag"] = "W/" + etag
+        if more_body:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(len(body))
+        await self._send(self._start)
+        await self._send({**message, "body": body})
+
+
+def precompress_directory(directory: str) -> Dict[str, List[Tuple[str, str]]]:
+    """Положить рядом с файлами каталога сжатые варианты `.br`/`.gz`.
+
+    Сжимаются только сжимаемые типы; вариант не создаётся, если он не меньше
+    исходного файла, и не пересоздаётся, если он новее исходного. Возвращает
+    {реальный путь файла: [(кодировка, путь варианта)]} в порядке
+    предпочтения кодировок. Если каталог не записываемый, варианты, которые
+    не удалось создать, пропускаются — такие файлы сожмёт middleware.
+    """
+    variants: Dict[str, List[Tuple[str, str]]] = {}
+    suffixes = tuple(SUFFIXES.values())
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith(suffixes) or not is_compressible(mimetypes.guess_type(name)[0]):
+                continue
+            path = os.path.realpath(os.path.join(root, name))
+            found = []
+            data = None
+            for encoding in ENCODINGS:
+                target = path + SUFFIXES[encoding]
+                try:
+                    if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(path):
+                        if data is None:
+                            with open(path, "rb") as f:
+                                data = f.read()
+                        compressed = compress(data, encoding)
+                        if len(compressed) >= len(data):
+                            continue
+                        tmp = target + ".tmp"
+                        with open(tmp, "wb") as f:
+                            f.write(compressed)
+                        os.replace(tmp, target)
+                except OSError:
+                    continue
+                found.append((encoding, target))
+            if found:
+                variants[path] = found
+    return variants
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """`StaticFiles`, который отдаёт заранее сжатые варианты файлов.
+
+    Варианты находит `precompress` (вызывается при старте приложения).
+    Без него или для файлов без варианта работает как обычный `StaticFiles`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.variants: Dict[str, List[Tuple[str, str]]] = {}
+
+    def precompress(self) -> None:
+        self.variants = {}
+        for directory in self.all_directories:
+            self.variants.update(precompress_directory(str(directory)))
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        variants = self.variants.get(str(full_path))
+        if variants and status_code == 200:
+            accepted = accepted_encodings(Headers(scope=scope).get("accept-encoding"))
+            for encoding, path in variants:
+                if encoding not in accepted:
+                    continue
+                try:
+                    variant_stat = os.stat(path)
+                except OSError:
+                    break
+                if variant_stat.st_mtime < stat_result.st_mtime:
+                    # Исходный файл изменился после старта.
+                    break
+                response = FileResponse(
+                    path,
+                    stat_result=variant_stat,
+                    media_type=mimetypes.guess_type(str(full_path))[0],
+                    headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"},
+                )
+                if self.is_not_modified(response.headers, Headers(scope=scope)):
+                    return NotModifiedResponse(response.headers)
+                return response
+        return super().file_response(full_path, stat_result, scope, status_code)
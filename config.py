@@ -1,11 +1,55 @@
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-import app
-from routers import api
+import os
 
 
-templates = Jinja2Templates(directory="templates")
-app.mount('/static', StaticFiles(directory='static'), name='static')
+# Движок хранения пользователей: "memory" (по умолчанию) или "sqlite".
+STORAGE_BACKEND = os.getenv("TUPAK_STORAGE", "memory")
 
-app.app.include_router(templates.router)
-app.app.include_router(api.router)
\ No newline at end of file
+# Файл базы SQLite (для STORAGE_BACKEND="sqlite").
+SQLITE_PATH = os.getenv("TUPAK_SQLITE_PATH", "users.db")
+# Размер пула соединений SQLite. По умолчанию совпадает с лимитом
+# threadpool'а AnyIO (40), в котором FastAPI выполняет sync-эндпоинты.
+SQLITE_POOL_SIZE = int(os.getenv("TUPAK_SQLITE_POOL_SIZE", "40"))
+
+# Журнал операций для in-memory хранилища. Пустое значение — журнал
+# выключен и данные живут только в памяти процесса.
+JOURNAL_DIR = os.getenv("TUPAK_JOURNAL_DIR") or None
+# Политика fsync журнала: "always" (group commit), "interval" или "os".
+JOURNAL_FSYNC = os.getenv("TUPAK_JOURNAL_FSYNC", "interval")
+# Период fsync для политики "interval".
+JOURNAL_FSYNC_INTERVAL_MS = int(os.getenv("TUPAK_JOURNAL_FSYNC_INTERVAL_MS", "100"))
+# Через сколько операций делать снапшот и обрезать журнал.
+JOURNAL_SNAPSHOT_EVERY = int(os.getenv("TUPAK_JOURNAL_SNAPSHOT_EVERY", "10000"))
+
+# Максимальный размер пачки для пакетных эндпоинтов (/users/bulk).
+BULK_MAX_ITEMS = int(os.getenv("TUPAK_BULK_MAX_ITEMS", "10000"))
+
+# Режим выполнения эндпоинтов API: "sync" — каждый запрос в threadpool, как
+# у обычных `def`-эндпоинтов; "async" — при неблокирующем хранилище (память
+# без журнала) обработчик вызывается прямо в event loop, без перехода
+# в threadpool. Пакетные эндпоинты и список без `limit` всегда идут в
+# threadpool (см. `routing`).
+API_MODE = os.getenv("TUPAK_API_MODE", "sync")
+
+# Сколько последних изменений хранить для синхронизации (`/users/changes`).
+# Клиент, отставший сильнее, получает `410` и синхронизируется заново.
+CHANGELOG_SIZE = int(os.getenv("TUPAK_CHANGELOG_SIZE", "100000"))
+
+# Лента изменений (`/users/stream`): сколько событий может ждать отправки
+# одному клиенту — при переполнении клиент отключается и переподключается
+# с Last-Event-ID.
+STREAM_QUEUE_SIZE = int(os.getenv("TUPAK_STREAM_QUEUE_SIZE", "1000"))
+# Период heartbeat-комментария; с тем же периодом лента проверяет изменения,
+# сделанные другими процессами (SQLite с несколькими воркерами).
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("TUPAK_STREAM_HEARTBEAT_SECONDS", "15"))
+
+# Сжатие ответов (gzip, brotli): ответы меньше порога (байт) отдаются как есть —
+# выигрыш в размере меньше цены сжатия и заголовков.
+COMPRESSION_MIN_SIZE = int(os.getenv("TUPAK_COMPRESSION_MIN_SIZE", "1024"))
+# Уровни сжатия на лету: выше — меньше байт, но дороже по CPU на каждый
+# ответ. Статика сжимается заранее с максимальным уровнем.
+GZIP_LEVEL = int(os.getenv("TUPAK_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("TUPAK_BROTLI_QUALITY", "4"))
+
+# Сколько секунд клиенты могут кешировать схему OpenAPI и страницы
+# документации без перепроверки ETag (схема меняется только с версией кода).
+DOCS_CACHE_MAX_AGE = int(os.getenv("TUPAK_DOCS_CACHE_MAX_AGE", "86400"))
@@ -0,0 +1,1206 @@
+import bisect
+import json
+import queue
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, Dict, Generator, Iterator, List, Optional, Set, Tuple, Union
+
+from starlette.concurrency import run_in_threadpool
+
+import config
+import database
+import models
+import search
+from journal import Journal
+from schemas import User, UserCreate, UserUpdate
+
+
+class EmailAlreadyExistsError(Exception):
+    """Email уже занят другим пользователем."""
+
+
+class UserNotFoundError(Exception):
+    """Пользователь с таким ID не найден."""
+
+
+class DuplicateIdError(Exception):
+    """ID встречается в пачке больше одного раза."""
+
+
+class ChangesExpiredError(Exception):
+    """Изменений после этой точки уже нет в журнале: нужна полная синхронизация."""
+
+
+class BulkConflictError(Exception):
+    """Атомарная пачка не применена.
+
+    `errors` — ошибка по индексу элемента пачки, `conflicts` — эти индексы.
+    """
+
+    def __init__(self, errors: Dict[int, Exception]):
+        super().__init__(errors)
+        self.errors = errors
+
+    @property
+    def conflicts(self) -> List[int]:
+        return sorted(self.errors)
+
+
+# Элемент пакетного обновления и его результат.
+UserChange = Tuple[int, UserUpdate]
+BulkResult = Union[User, Exception]
+# Запись журнала изменений: (seq, ID пользователя, "create" | "update" | "delete").
+ChangeRecord = Tuple[int, int, str]
+# Изменение для клиента: запись журнала и текущий пользователь (`None` для delete).
+UserChangeEvent = Tuple[int, str, int, Optional[User]]
+
+
+def utcnow() -> datetime:
+    """Текущее время в UTC — для `created_at`/`updated_at`."""
+    return datetime.now(timezone.utc)
+
+
+def plan_updates(
+    changes: List[UserChange],
+    current: Callable[[int], Optional[User]],
+    email_owner: Callable[[str], Optional[int]],
+) -> Tuple[Dict[int, Tuple[User, User]], Dict[int, Exception]]:
+    """Проверить пачку обновлений целиком.
+
+    Возвращает (индекс -> (старый, новый) пользователь) для применимых
+    элементов и (индекс -> ошибка) для остальных. Email проверяются по
+    итоговому состоянию пачки: обмен email между пользователями допустим.
+    Если элемент отпал, освобождаемый им email остаётся занятым, поэтому
+    проверка повторяется до неподвижной точки.
+
+    У нового пользователя обновлён `updated_at`; `seq` проставляет
+    хранилище при записи.
+    """
+    accepted: Dict[int, Tuple[User, User]] = {}
+    errors: Dict[int, Exception] = {}
+    seen = set()
+    now = utcnow()
+    for index, (user_id, payload) in enumerate(changes):
+        if user_id in seen:
+            errors[index] = DuplicateIdError(user_id)
+            continue
+        seen.add(user_id)
+        old = current(user_id)
+        if old is None:
+            errors[index] = UserNotFoundError(user_id)
+            continue
+        # Поля payload уже провалидированы — копия без повторной валидации.
+        new = old.model_copy(update={
+            "name": payload.name if payload.name is not None else old.name,
+            "email": payload.email if payload.email is not None else old.email,
+            "updated_at": now,
+        })
+        accepted[index] = (old, new)
+
+    while True:
+        claims: Dict[str, List[int]] = {}
+        for index, (_, new) in accepted.items():
+            claims.setdefault(new.email, []).append(index)
+        accepted_ids = {old.id for old, _ in accepted.values()}
+
+        failed: Dict[int, Exception] = {}
+        for email, indexes in claims.items():
+            owner = email_owner(email)
+            if owner is not None and owner not in accepted_ids:
+                winner = None
+            else:
+                # Email остаётся у владельца, если тот его не меняет, иначе — у первого.
+                winner = next((i for i in indexes if accepted[i][0].id == owner), indexes[0])
+            failed.update((i, EmailAlreadyExistsError(email)) for i in indexes if i != winner)
+        if not failed:
+            return accepted, errors
+        errors.update(failed)
+        for index in failed:
+            del accepted[index]
+
+
+def collapse_changes(records: List[ChangeRecord]) -> List[ChangeRecord]:
+    """Свести записи журнала к одной на пользователя, по возрастанию seq.
+
+    Остаётся последняя запись пользователя. Созданный в этом же отрезке
+    журнала пользователь отдаётся как `create`, а созданный и удалённый —
+    не отдаётся вовсе: клиент его не видел.
+    """
+    latest: Dict[int, ChangeRecord] = {}
+    created: Set[int] = set()
+    for record in records:
+        _, user_id, op = record
+        if op == "create":
+            created.add(user_id)
+        latest[user_id] = record
+    collapsed = []
+    for seq, user_id, op in sorted(latest.values()):
+        if user_id in created:
+            if op == "delete":
+                continue
+            op = "create"
+        collapsed.append((seq, user_id, op))
+    return collapsed
+
+
+def resolve_changes(collapsed: List[ChangeRecord], users: Dict[int, User]) -> List[UserChangeEvent]:
+    """Дополнить записи из `collapse_changes` текущими пользователями из `users`.
+
+    Пользователь, удалённый уже после чтения журнала, пропускается: запись
+    об удалении придёт со следующими изменениями.
+    """
+    resolved = []
+    for seq, user_id, op in collapsed:
+        user = users.get(user_id) if op != "delete" else None
+        if op != "delete" and user is None:
+            continue
+        resolved.append((seq, op, user_id, user))
+    return resolved
+
+
+def changed_ids(collapsed: List[ChangeRecord]) -> List[int]:
+    """ID пользователей, чьи текущие данные нужны для `resolve_changes`."""
+    return [user_id for _, user_id, op in collapsed if op != "delete"]
+
+
+def email_domain(email: str) -> str:
+    """Домен email в нижнем регистре — ключ фильтра `?domain=` и гистограммы."""
+    return email.partition("@")[2].lower()
+
+
+# Поля сортировки списка и ключ пользователя в соответствующем индексе.
+# Имена сравниваются как есть (по кодам символов, как BINARY в SQLite),
+# email — без учёта регистра.
+SORT_KEYS: Dict[str, Callable[[User], Any]] = {
+    "id": attrgetter("id"),
+    "name": attrgetter("name"),
+    "email": lambda user: search.normalize(user.email),
+}
+
+# Позиция в отсортированном списке: (ключ, ID).
+SortPosition = Tuple[Any, int]
+
+
+class UserStorage(ABC):
+    """Интерфейс хранилища пользователей.
+
+    Роутеры работают только через него, поэтому движок хранения можно
+    заменить (см. `set_storage`), не трогая код эндпоинтов.
+    """
+
+    # Может ли операция ждать ввода-вывода (диск, fsync). Неблокирующее
+    # хранилище можно вызывать прямо из event loop (см. `routing`).
+    blocking: bool = True
+
+    @abstractmethod
+    def get(self, user_id: int) -> Optional[User]:
+        """Пользователь по ID или `None`."""
+
+    @abstractmethod
+    def get_many(self, user_ids: List[int]) -> Dict[int, User]:
+        """Найденные пользователи из `user_ids`: словарь id -> User."""
+
+    @abstractmethod
+    def list(self) -> List[User]:
+        """Все пользователи в порядке добавления."""
+
+    @abstractmethod
+    def page(self, after: Optional[int] = None, limit: Optional[int] = None, domain: Optional[str] = None) -> List[User]:
+        """Страница пользователей с ID больше `after`, по возрастанию ID.
+
+        Без `limit` — все оставшиеся. С `domain` — только пользователи с
+        email в этом домене (см. `email_domain`). Стоимость O(log n + limit).
+        """
+
+    @abstractmethod
+    def page_by(
+        self,
+        field: str,
+        descending: bool = False,
+        after: Optional[SortPosition] = None,
+        limit: Optional[int] = None,
+    ) -> List[User]:
+        """Страница пользователей, упорядоченных по `field` (см. `SORT_KEYS`), затем по ID.
+
+        `after` — позиция последнего пользователя предыдущей страницы.
+        Стоимость O(log n + limit).
+        """
+
+    @abstractmethod
+    def domain_stats(self, limit: Optional[int] = None) -> List[Tuple[str, int]]:
+        """Домены email и число их пользователей, от самых частых.
+
+        Счётчики ведутся при записи, пользователи не перебираются.
+        """
+
+    @abstractmethod
+    def export(self) -> Generator[User, None, None]:
+        """Генератор по согласованному снимку всех пользователей.
+
+        Снимок фиксируется при первом `next()` и не блокирует запись.
+        Недочитанный генератор нужно закрыть (`close()`): снимок держит
+        ресурсы хранилища.
+        """
+
+    @abstractmethod
+    def search(self, query: str, after: Optional[search.Position] = None, limit: int = 20) -> List[Tuple[int, User]]:
+        """Пользователи по запросу к имени и email в порядке `search.top`.
+
+        Возвращает пары (ранг, пользователь), начиная с позиции после `after`.
+        """
+
+    @abstractmethod
+    def changes(self, since: int, limit: int) -> List[ChangeRecord]:
+        """До `limit` записей журнала изменений с seq больше `since`, по возрастанию seq.
+
+        Бросает `ChangesExpiredError`, если изменения после `since` уже
+        вытеснены из журнала (или `since` не из этого хранилища).
+        """
+
+    @abstractmethod
+    def create(self, payload: UserCreate) -> User:
+        """Создать пользователя. Бросает `EmailAlreadyExistsError`."""
+
+    @abstractmethod
+    def create_many(self, payloads: List[UserCreate], atomic: bool = False) -> List[Optional[User]]:
+        """Создать пачку пользователей за одну блокировку/транзакцию.
+
+        Возвращает список той же длины: созданный `User` или `None`, если
+        email занят (в хранилище или более ранним элементом пачки). С
+        `atomic=True` при любом конфликте ничего не создаётся и бросается
+        `BulkConflictError`.
+        """
+
+    @abstractmethod
+    def update(self, user_id: int, payload: UserUpdate) -> Optional[User]:
+        """Частично обновить пользователя; `None`, если он не найден.
+
+        Бросает `EmailAlreadyExistsError`, если новый email занят.
+        """
+
+    @abstractmethod
+    def update_many(self, changes: List[UserChange], atomic: bool = False) -> List[BulkResult]:
+        """Обновить пачку пользователей за одну блокировку/транзакцию.
+
+        Возвращает список той же длины: обновлённый `User` или ошибку
+        (`UserNotFoundError`, `EmailAlreadyExistsError`, `DuplicateIdError`).
+        Уникальность email проверяется по итогу всей пачки (см.
+        `plan_updates`). С `atomic=True` при любой ошибке ничего не
+        меняется и бросается `BulkConflictError`.
+        """
+
+    @abstractmethod
+    def delete(self, user_id: int) -> bool:
+        """Удалить пользователя; `False`, если он не найден."""
+
+    @abstractmethod
+    def delete_many(self, user_ids: List[int]) -> List[int]:
+        """Удалить пачку пользователей; вернуть ID, которые были удалены."""
+
+    @abstractmethod
+    def email_exists(self, email: str) -> bool:
+        """Занят ли email."""
+
+    @abstractmethod
+    def count(self) -> int:
+        """Количество пользователей."""
+
+    @abstractmethod
+    def version(self) -> int:
+        """Глобальная версия хранилища: растёт на единицу при каждом изменении.
+
+        Это же номер последнего изменения в журнале изменений (`changes`).
+        """
+
+    @abstractmethod
+    def user_version(self, user_id: int) -> Optional[int]:
+        """Версия пользователя (`User.seq`) или `None`, если его нет.
+
+        Меняется при каждом изменении пользователя. Читать версию нужно
+        до самих данных: тогда она может оказаться старее данных, но не новее.
+        """
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Удалить все данные (используется в тестах)."""
+
+    def close(self) -> None:
+        """Освободить ресурсы движка (соединения, файлы)."""
+
+    def encode(self, user: User) -> bytes:
+        """JSON-представление пользователя, как его отдаёт API."""
+        return user.__pydantic_serializer__.to_json(user)
+
+
+# Начиная с какого размера пачки вставок или удалений упорядоченные
+# индексы пересобираются целиком.
+BULK_REINDEX_THRESHOLD = 64
+# Сколько записей индекса email просматривать за один срез при поиске по префиксу.
+SEARCH_SCAN_CHUNK = 256
+
+
+class InMemoryUserStorage(UserStorage):
+    """Хранилище в памяти процесса поверх словарей из `database`.
+
+    Эндпоинты могут выполняться параллельно в threadpool, поэтому все
+    изменения идут под одной блокировкой записи: проверка email, выдача ID, вставка и
+    запись в журнал атомарны относительно друг друга. Чтение идёт без
+    блокировки — отдельные операции со словарём атомарны.
+
+    С журналом (`journal.Journal`) состояние восстанавливается при старте,
+    а каждая операция записи дописывается в журнал до изменения памяти.
+    """
+
+    def __init__(self, journal: Optional[Journal] = None):
+        self._journal = journal
+        self._lock = threading.Lock()
+        # Без журнала операции — только работа со словарями. С журналом
+        # запись — системный вызов, а снимок (`Journal.snapshot`) пишет
+        # на диск всё хранилище, поэтому в event loop ей не место.
+        self.blocking = journal is not None
+        if journal is not None:
+            restored, next_id = journal.replay()
+            database.reset()
+            for user in restored:
+                # Журнал изменений не переживает рестарт: seq выдаются заново,
+                # а клиенты с seq прошлого запуска получат полную синхронизацию.
+                self._insert(user.model_copy(update={"seq": self._next_seq()}), reindex=False)
+            self._merge_sorted(restored)
+            database.changes.clear()
+            database.changes_floor = database.version
+            database.next_id = next_id
+
+    def get(self, user_id: int) -> Optional[User]:
+        return database.users.get(user_id)
+
+    def get_many(self, user_ids: List[int]) -> Dict[int, User]:
+        users = database.users
+        found = ((user_id, users.get(user_id)) for user_id in user_ids)
+        return {user_id: user for user_id, user in found if user is not None}
+
+    def list(self) -> List[User]:
+        return list(database.users.values())
+
+    def page(self, after: Optional[int] = None, limit: Optional[int] = None, domain: Optional[str] = None) -> List[User]:
+        ids = database.ids if domain is None else database.domains.get(domain.lower(), [])
+        start = bisect.bisect_right(ids, after) if after is not None else 0
+        stop = start + limit if limit is not None else None
+        users = database.users
+        # Между срезом индекса и чтением users запись могла быть удалена.
+        return [user for user in map(users.get, ids[start:stop]) if user is not None]
+
+    def page_by(
+        self,
+        field: str,
+        descending: bool = False,
+        after: Optional[SortPosition] = None,
+        limit: Optional[int] = None,
+    ) -> List[User]:
+        if field == "id":
+            index, position = database.ids, after[1] if after is not None else None
+        else:
+            index, position = database.sorted_indexes[field], after
+        if descending:
+            stop = bisect.bisect_left(index, position) if position is not None else len(index)
+            start = max(stop - limit, 0) if limit is not None else 0
+            entries = index[start:stop][::-1]
+        else:
+            start = bisect.bisect_right(index, position) if position is not None else 0
+            entries = index[start:start + limit] if limit is not None else index[start:]
+        user_ids = entries if field == "id" else [user_id for _, user_id in entries]
+        return [user for user in map(database.users.get, user_ids) if user is not None]
+
+    def domain_stats(self, limit: Optional[int] = None) -> List[Tuple[str, int]]:
+        counts = [(domain, len(ids)) for domain, ids in list(database.domains.items())]
+        counts.sort(key=lambda item: (-item[1], item[0]))
+        return counts[:limit]
+
+    def export(self) -> Generator[User, None, None]:
+        # Объекты User не изменяются (update кладёт новый объект), поэтому
+        # копии ссылок достаточно для снимка; list() по словарю атомарен.
+        yield from list(database.users.values())
+
+    def search(self, query: str, after: Optional[search.Position] = None, limit: int = 20) -> List[Tuple[int, User]]:
+        query = search.normalize(query)
+        if not query:
+            return []
+        found = self._match_email_prefix(query) | self._match_name(query)
+        return search.top(filter(None, map(database.users.get, found)), query, after, limit)
+
+    def changes(self, since: int, limit: int) -> List[ChangeRecord]:
+        # Под блокировкой: вытеснение сдвигает список, и срез по найденной
+        # позиции иначе мог бы пропустить записи.
+        with self._lock:
+            if not database.changes_floor <= since <= database.version:
+                raise ChangesExpiredError(since)
+            log = database.changes
+            start = bisect.bisect_right(log, since, key=itemgetter(0))
+            return log[start:start + limit]
+
+    def create(self, payload: UserCreate) -> User:
+        with self._lock:
+            if payload.email in database.emails:
+                raise EmailAlreadyExistsError(payload.email)
+
+            (user_id,) = self._allocate_ids(1)
+            now = utcnow()
+            # Поля payload уже проверены (`UserCreate`): повторная проверка
+            # email под блокировкой записи заняла бы большую часть её времени.
+            user = User.model_construct(
+                id=user_id, name=payload.name, email=payload.email,
+                created_at=now, updated_at=now, seq=self._next_seq(),
+            )
+            seq = self._log("create", user=user.model_dump(mode="json"))
+            self._insert(user)
+            self._snapshot_if_due()
+        self._commit(seq)
+        return user
+
+    def create_many(self, payloads: List[UserCreate], atomic: bool = False) -> List[Optional[User]]:
+        with self._lock:
+            # Один проход: конфликты с хранилищем и внутри пачки.
+            seen = set()
+            conflicts = []
+            for index, payload in enumerate(payloads):
+                if payload.email in database.emails or payload.email in seen:
+                    conflicts.append(index)
+                else:
+                    seen.add(payload.email)
+            if atomic and conflicts:
+                raise BulkConflictError({i: EmailAlreadyExistsError(payloads[i].email) for i in conflicts})
+
+            new_ids = iter(self._allocate_ids(len(payloads) - len(conflicts)))
+            skip = set(conflicts)
+            rebuild = len(payloads) - len(skip) > BULK_REINDEX_THRESHOLD
+            results: List[Optional[User]] = []
+            seq = None
+            now = utcnow()
+            try:
+                for index, payload in enumerate(payloads):
+                    if index in skip:
+                        results.append(None)
+                        continue
+                    user = User.model_construct(
+                        id=next(new_ids), name=payload.name, email=payload.email,
+                        created_at=now, updated_at=now, seq=self._next_seq(),
+                    )
+                    seq = self._log("create", user=user.model_dump(mode="json"))
+                    self._insert(user, reindex=not rebuild)
+                    results.append(user)
+            finally:
+                # Если журнал отказал посреди пачки, уже вставленные
+                # пользователи всё равно должны попасть в индексы.
+                if rebuild:
+                    self._merge_sorted([user for user in results if user is not None])
+            self._snapshot_if_due()
+        self._commit(seq)
+        return results
+
+    def update(self, user_id: int, payload: UserUpdate) -> Optional[User]:
+        with self._lock:
+            user = database.users.get(user_id)
+            if user is None:
+                return None
+
+            new_name = payload.name if payload.name is not None else user.name
+            new_email = payload.email if payload.email is not None else user.email
+
+            if new_email != user.email and new_email in database.emails:
+                raise EmailAlreadyExistsError(new_email)
+
+            updated = user.model_copy(update={
+                "name": new_name, "email": new_email, "updated_at": utcnow(), "seq": self._next_seq(),
+            })
+            seq = self._log("update", user=updated.model_dump(mode="json"))
+            self._replace(user, updated)
+            self._snapshot_if_due()
+        self._commit(seq)
+        return updated
+
+    def update_many(self, changes: List[UserChange], atomic: bool = False) -> List[BulkResult]:
+        with self._lock:
+            accepted, errors = plan_updates(changes, database.users.get, database.emails.get)
+            if atomic and errors:
+                raise BulkConflictError(errors)
+            seq = None
+            for index, (old, new) in accepted.items():
+                new = new.model_copy(update={"seq": self._next_seq()})
+                accepted[index] = (old, new)
+                seq = self._log("update", user=new.model_dump(mode="json"))
+                self._replace(old, new)
+            self._snapshot_if_due()
+        self._commit(seq)
+        return [errors[i] if i in errors else accepted[i][1] for i in range(len(changes))]
+
+    def delete(self, user_id: int) -> bool:
+        with self._lock:
+            user = database.users.get(user_id)
+            if user is None:
+                return False
+            seq = self._log("delete", id=user_id)
+            self._remove(user)
+            self._snapshot_if_due()
+        self._commit(seq)
+        return True
+
+    def delete_many(self, user_ids: List[int]) -> List[int]:
+        with self._lock:
+            doomed = [u for u in map(database.users.get, dict.fromkeys(user_ids)) if u is not None]
+            # Точечное удаление из упорядоченного индекса — сдвиг списка на
+            # каждый ID; для большой пачки дешевле один раз пересобрать индекс.
+            rebuild = len(doomed) > BULK_REINDEX_THRESHOLD
+            seq = None
+            try:
+                for user in doomed:
+                    seq = self._log("delete", id=user.id)
+                    self._remove(user, reindex=not rebuild)
+            finally:
+                if rebuild:
+                    database.ids[:] = [i for i in database.ids if i in database.users]
+                    for index in database.sorted_indexes.values():
+                        index[:] = [entry for entry in index if entry[1] in database.users]
+                    for domain in {email_domain(user.email) for user in doomed}:
+                        ids = [i for i in database.domains[domain] if i in database.users]
+                        if ids:
+                            database.domains[domain][:] = ids
+                        else:
+                            del database.domains[domain]
+            self._snapshot_if_due()
+        self._commit(seq)
+        return [user.id for user in doomed]
+
+    def email_exists(self, email: str) -> bool:
+        return email in database.emails
+
+    def count(self) -> int:
+        return len(database.users)
+
+    def version(self) -> int:
+        return database.version
+
+    def user_version(self, user_id: int) -> Optional[int]:
+        user = database.users.get(user_id)
+        return user.seq if user is not None else None
+
+    def encode(self, user: User) -> bytes:
+        # Снимок (`export`) и конкурентные чтения могут держать уже
+        # заменённый объект: его байты в кеше другие.
+        cached = database.json_cache.get(user.id)
+        if cached is not None and cached[0] is user:
+            return cached[1]
+        return super().encode(user)
+
+    def clear(self) -> None:
+        with self._lock:
+            database.reset()
+            if self._journal is not None:
+                self._journal.reset()
+
+    def close(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+
+    def _commit(self, seq: Optional[int]) -> None:
+        """Дождаться fsync операции. Вызывать после выхода из `self._lock`."""
+        if seq is not None:
+            self._journal.commit(seq)
+
+    # Поддержка индексов. Все методы ниже вызываются только под `self._lock`.
+    # Версия хранилища обновляется последней (`_publish`): читатель, взявший
+    # версию до данных, не увидит новую версию вместе со старыми данными.
+    # `seq` нового объекта User выдаёт `_next_seq` до вызова `_insert`/`_replace`.
+
+    def _insert(self, user: User, reindex: bool = True) -> None:
+        """`reindex=False` — упорядоченные индексы имён и email дополнит вызывающий."""
+        database.users[user.id] = user
+        database.emails[user.email] = user.id
+        # ID выдаются по возрастанию, поэтому индекс остаётся отсортированным.
+        database.ids.append(user.id)
+        if reindex:
+            for field in database.sorted_indexes:
+                self._index_sorted(user, field)
+        self._index_domain(user)
+        self._index_name(user, add=True)
+        database.json_cache[user.id] = (user, super().encode(user))
+        self._publish(user.seq, user.id, "create")
+
+    def _replace(self, old: User, new: User) -> None:
+        database.users[new.id] = new
+        if new.email != old.email:
+            # При обмене email в пачке старый email мог уже перейти к другому.
+            if database.emails.get(old.email) == old.id:
+                del database.emails[old.email]
+            database.emails[new.email] = new.id
+            if email_domain(new.email) != email_domain(old.email):
+                self._unindex_domain(old)
+                self._index_domain(new)
+        if new.name != old.name:
+            self._index_name(old, add=False)
+            self._index_name(new, add=True)
+        for field in database.sorted_indexes:
+            if SORT_KEYS[field](new) != SORT_KEYS[field](old):
+                self._unindex_sorted(old, field)
+                self._index_sorted(new, field)
+        database.json_cache[new.id] = (new, super().encode(new))
+        self._publish(new.seq, new.id, "update")
+
+    def _remove(self, user: User, reindex: bool = True) -> None:
+        """`reindex=False` — упорядоченные индексы (ID, имена, email, домены) пересоберёт вызывающий."""
+        del database.users[user.id]
+        del database.emails[user.email]
+        if reindex:
+            del database.ids[bisect.bisect_left(database.ids, user.id)]
+            for field in database.sorted_indexes:
+                self._unindex_sorted(user, field)
+            self._unindex_domain(user)
+        self._index_name(user, add=False)
+        del database.json_cache[user.id]
+        self._publish(self._next_seq(), user.id, "delete")
+
+    def _index_name(self, user: User, add: bool) -> None:
+        """Добавить пользователя в списки триграмм его имени или убрать из них."""
+        for gram in search.trigrams(search.normalize(user.name)):
+            if add:
+                database.name_trigrams.setdefault(gram, set()).add(user.id)
+                continue
+            postings = database.name_trigrams[gram]
+            postings.discard(user.id)
+            if not postings:
+                del database.name_trigrams[gram]
+
+    def _index_domain(self, user: User) -> None:
+        ids = database.domains.setdefault(email_domain(user.email), [])
+        # Новые ID больше всех выданных; insort нужен только при смене email.
+        if not ids or ids[-1] < user.id:
+            ids.append(user.id)
+        else:
+            bisect.insort(ids, user.id)
+
+    def _unindex_domain(self, user: User) -> None:
+        domain = email_domain(user.email)
+        ids = database.domains[domain]
+        del ids[bisect.bisect_left(ids, user.id)]
+        if not ids:
+            del database.domains[domain]
+
+    def _index_sorted(self, user: User, field: str) -> None:
+        bisect.insort(database.sorted_indexes[field], (SORT_KEYS[field](user), user.id))
+
+    def _unindex_sorted(self, user: User, field: str) -> None:
+        index = database.sorted_indexes[field]
+        del index[bisect.bisect_left(index, (SORT_KEYS[field](user), user.id))]
+
+    def _merge_sorted(self, users: List[User]) -> None:
+        """Добавить пачку в упорядоченные индексы одной сортировкой, а не insort на каждого."""
+        for field, index in database.sorted_indexes.items():
+            key = SORT_KEYS[field]
+            merged = index + [(key(u), u.id) for u in users]
+            merged.sort()
+            index[:] = merged
+
+    # Поиск читает индексы без блокировки: срез списка, копия и пересечение
+    # множеств атомарны, а кандидатов всё равно перепроверяет `search.rank`.
+
+    def _match_email_prefix(self, query: str) -> Set[int]:
+        index = database.email_index
+        start = bisect.bisect_left(index, (query,))
+        found: Set[int] = set()
+        while True:
+            chunk = index[start:start + SEARCH_SCAN_CHUNK]
+            matched = [user_id for email, user_id in chunk if email.startswith(query)]
+            found.update(matched)
+            if len(matched) < SEARCH_SCAN_CHUNK:
+                return found
+            start += SEARCH_SCAN_CHUNK
+
+    def _match_name(self, query: str) -> Set[int]:
+        postings = [database.name_trigrams.get(gram) for gram in search.trigrams(query)]
+        if not postings or not all(postings):
+            return set()
+        # Начинаем с самого короткого списка: пересечение не больше него.
+        postings.sort(key=len)
+        found = set(postings[0])
+        for other in postings[1:]:
+            found &= other
+        return found
+
+    def _next_seq(self) -> int:
+        """Номер следующего изменения."""
+        return database.version + 1
+
+    def _publish(self, seq: int, user_id: int, op: str) -> None:
+        """Записать изменение в журнал изменений и сделать его версию текущей."""
+        log = database.changes
+        log.append((seq, user_id, op))
+        if len(log) >= 2 * config.CHANGELOG_SIZE:
+            # Вытесняем сразу половину: сдвиг списка амортизируется.
+            cut = len(log) - config.CHANGELOG_SIZE
+            database.changes_floor = log[cut - 1][0]
+            del log[:cut]
+        database.version = seq
+
+    def _allocate_ids(self, count: int) -> range:
+        """Выдать `count` последовательных ID."""
+        start = database.next_id
+        database.next_id += count
+        return range(start, start + count)
+
+    def _log(self, op: str, **fields) -> Optional[int]:
+        """Записать операцию в журнал — до изменения памяти.
+
+        Если запись не удалась, исключение уходит вызывающему, а память
+        остаётся прежней: в ней нет операций, которых не было бы в журнале.
+        """
+        if self._journal is None:
+            return None
+        return self._journal.append(op, **fields)
+
+    def _snapshot_if_due(self) -> None:
+        """Начать снапшот журнала, если пора. Вызывать после изменения памяти.
+
+        Под блокировкой — только копия ссылок на пользователей; кодирование
+        и запись на диск идут в фоновом потоке журнала.
+        """
+        if self._journal is not None and self._journal.snapshot_due():
+            self._journal.snapshot(list(database.users.values()), database.next_id)
+
+
+class SQLiteUserStorage(UserStorage):
+    """Хранилище в файле SQLite (переживает рестарт, общее для воркеров).
+
+    Уникальность email обеспечивает UNIQUE-индекс. Соединения берутся из
+    пула: поток эндпоинта получает соединение в монопольное пользование
+    на время одной операции, так что их число не превышает `pool_size`.
+    """
+
+    def __init__(self, path: str, pool_size: int = config.SQLITE_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            with conn:
+                conn.execute(models.CREATE_USERS)
+                conn.execute(models.CREATE_STORE_META)
+                added = set()
+                for table, column, statements in models.MIGRATIONS:
+                    if (column,) not in conn.execute(models.TABLE_COLUMNS, (table,)).fetchall():
+                        for statement in statements:
+                            conn.execute(statement)
+                        added.add((table, column))
+                if ("users", "email_folded") in added:
+                    conn.executemany(
+                        models.SET_EMAIL_FOLDED,
+                        [(search.normalize(email), user_id) for user_id, email in conn.execute(models.SELECT_EMAILS)],
+                    )
+                conn.execute(models.CREATE_USERS_EMAIL_INDEX)
+                conn.execute(models.INIT_STORE_META)
+                conn.execute(models.CREATE_USER_CHANGES)
+                conn.execute(models.SET_CHANGES_KEPT, (config.CHANGELOG_SIZE,))
+                for trigger in models.RETIRED_TRIGGERS + models.REPLACED_TRIGGERS:
+                    conn.execute(models.DROP_TRIGGER.format(trigger))
+                for trigger in models.CREATE_VERSION_TRIGGERS:
+                    conn.execute(trigger)
+                conn.execute(models.CREATE_USERS_DOMAIN_INDEX)
+                conn.execute(models.CREATE_USERS_NAME_INDEX)
+                stats_exist = conn.execute(models.TABLE_EXISTS, ("domain_stats",)).fetchone()
+                conn.execute(models.CREATE_DOMAIN_STATS)
+                if not stats_exist:
+                    conn.execute(models.FILL_DOMAIN_STATS)
+                for trigger in models.CREATE_DOMAIN_STATS_TRIGGERS:
+                    conn.execute(trigger)
+                for index in models.RETIRED_INDEXES:
+                    conn.execute(models.DROP_INDEX.format(index))
+                conn.execute(models.CREATE_USERS_EMAIL_FOLDED_INDEX)
+                fts_exists = conn.execute(models.TABLE_EXISTS, (models.USERS_NAME_FTS,)).fetchone()
+                conn.execute(models.CREATE_USERS_NAME_FTS)
+                if not fts_exists:
+                    # База из версии без поиска: проиндексировать уже сохранённые имена.
+                    conn.execute(models.REBUILD_USERS_NAME_FTS)
+                for trigger in models.CREATE_SEARCH_TRIGGERS:
+                    conn.execute(trigger)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=64,
+        )
+        for pragma in models.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.pool_size
+                if can_open:
+                    self._opened += 1
+            conn = self._connect() if can_open else self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @staticmethod
+    def _to_user(row) -> User:
+        # Строки из базы уже прошли валидацию при записи.
+        return User.model_construct(
+            id=row[0],
+            name=row[1],
+            email=row[2],
+            created_at=datetime.fromisoformat(row[3]),
+            updated_at=datetime.fromisoformat(row[4]),
+            seq=row[5],
+        )
+
+    def get(self, user_id: int) -> Optional[User]:
+        with self._connection() as conn:
+            row = conn.execute(models.SELECT_USER, (user_id,)).fetchone()
+        return self._to_user(row) if row else None
+
+    def get_many(self, user_ids: List[int]) -> Dict[int, User]:
+        with self._connection() as conn:
+            rows = conn.execute(models.SELECT_USERS_BY_IDS, (json.dumps(user_ids),)).fetchall()
+        return {row[0]: self._to_user(row) for row in rows}
+
+    def list(self) -> List[User]:
+        with self._connection() as conn:
+            rows = conn.execute(models.SELECT_USERS).fetchall()
+        return [self._to_user(row) for row in rows]
+
+    def page(self, after: Optional[int] = None, limit: Optional[int] = None, domain: Optional[str] = None) -> List[User]:
+        # LIMIT -1 в SQLite означает «без ограничения».
+        params = (after if after is not None else 0, limit if limit is not None else -1)
+        with self._connection() as conn:
+            if domain is None:
+                rows = conn.execute(models.SELECT_USERS_PAGE, params).fetchall()
+            else:
+                rows = conn.execute(models.SELECT_USERS_PAGE_BY_DOMAIN, (domain.lower(), *params)).fetchall()
+        return [self._to_user(row) for row in rows]
+
+    def page_by(
+        self,
+        field: str,
+        descending: bool = False,
+        after: Optional[SortPosition] = None,
+        limit: Optional[int] = None,
+    ) -> List[User]:
+        sql = models.SELECT_USERS_SORTED[field, descending, after is not None]
+        position = (after[0], *after) if after is not None else ()
+        params = (*position, limit if limit is not None else -1)
+        with self._connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [self._to_user(row) for row in rows]
+
+    def domain_stats(self, limit: Optional[int] = None) -> List[Tuple[str, int]]:
+        with self._connection() as conn:
+            return conn.execute(models.SELECT_DOMAIN_STATS, (limit if limit is not None else -1,)).fetchall()
+
+    def export(self) -> Generator[User, None, None]:
+        # Читающая транзакция в WAL видит снимок базы на момент первого
+        # SELECT и не мешает писателям. Выгрузка длится, пока её читает
+        # клиент, поэтому соединение у неё своё, а не из пула: медленные
+        # клиенты не занимают соединения остальных запросов.
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN")
+            for row in conn.execute(models.SELECT_USERS):
+                yield self._to_user(row)
+        finally:
+            conn.close()
+
+    def search(self, query: str, after: Optional[search.Position] = None, limit: int = 20) -> List[Tuple[int, User]]:
+        query = search.normalize(query)
+        if not query:
+            return []
+        with self._connection() as conn:
+            rows = conn.execute(models.SEARCH_USERS_BY_EMAIL_PREFIX, (query, query + "\U0010ffff")).fetchall()
+            if len(query) >= search.MIN_NAME_QUERY:
+                phrase = '"' + query.replace('"', '""') + '"'
+                rows += conn.execute(models.SEARCH_USERS_BY_NAME, (phrase,)).fetchall()
+        candidates = {row[0]: row for row in rows}
+        return search.top(map(self._to_user, candidates.values()), query, after, limit)
+
+    def changes(self, since: int, limit: int) -> List[ChangeRecord]:
+        # Одна читающая транзакция: границы журнала и записи из одного снимка.
+        with self._connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                floor, version = conn.execute(models.SELECT_CHANGES_RANGE).fetchone()
+                if not floor <= since <= version:
+                    raise ChangesExpiredError(since)
+                return conn.execute(models.SELECT_CHANGES, (since, limit)).fetchall()
+            finally:
+                conn.execute("COMMIT")
+
+    def create(self, payload: UserCreate) -> User:
+        now = utcnow().isoformat()
+        try:
+            with self._connection() as conn:
+                # seq ставит AFTER-триггер, RETURNING его ещё не видит:
+                # строку перечитываем в той же транзакции.
+                conn.execute("BEGIN IMMEDIATE")
+                with conn:
+                    (user_id,) = conn.execute(
+                        models.INSERT_USER, (payload.name, payload.email, search.normalize(payload.email), now, now)
+                    ).fetchone()
+                    row = conn.execute(models.SELECT_USER, (user_id,)).fetchone()
+        except sqlite3.IntegrityError:
+            raise EmailAlreadyExistsError(payload.email)
+        return self._to_user(row)
+
+    def create_many(self, payloads: List[UserCreate], atomic: bool = False) -> List[Optional[User]]:
+        with self._connection() as conn:
+            # IMMEDIATE блокирует других писателей до конца транзакции: между
+            # проверкой email и вставкой никто не вклинится, а AUTOINCREMENT
+            # выдаст вставленным строкам сплошной блок ID.
+            conn.execute("BEGIN IMMEDIATE")
+            with conn:
+                seen = set()
+                conflicts = []
+                for index, payload in enumerate(payloads):
+                    if payload.email in seen or conn.execute(models.EMAIL_EXISTS, (payload.email,)).fetchone():
+                        conflicts.append(index)
+                    else:
+                        seen.add(payload.email)
+                if atomic and conflicts:
+                    # Исключение откатывает транзакцию в `with conn`.
+                    raise BulkConflictError({i: EmailAlreadyExistsError(payloads[i].email) for i in conflicts})
+
+                skip = set(conflicts)
+                accepted = [p for index, p in enumerate(payloads) if index not in skip]
+                now = utcnow().isoformat()
+                conn.executemany(models.INSERT_USER_NO_RETURNING, [(p.name, p.email, search.normalize(p.email), now, now) for p in accepted])
+                last_id = conn.execute(models.SELECT_USERS_SEQUENCE).fetchone()[0] if accepted else 0
+                rows = conn.execute(models.SELECT_USERS_PAGE, (last_id - len(accepted), len(accepted))).fetchall()
+
+        created = iter(map(self._to_user, rows))
+        return [None if index in skip else next(created) for index in range(len(payloads))]
+
+    def update(self, user_id: int, payload: UserUpdate) -> Optional[User]:
+        folded = search.normalize(payload.email) if payload.email is not None else None
+        params = (payload.name, payload.email, folded, utcnow().isoformat(), user_id)
+        try:
+            with self._connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                with conn:
+                    if conn.execute(models.UPDATE_USER, params).rowcount == 0:
+                        return None
+                    row = conn.execute(models.SELECT_USER, (user_id,)).fetchone()
+        except sqlite3.IntegrityError:
+            raise EmailAlreadyExistsError(payload.email)
+        return self._to_user(row)
+
+    def update_many(self, changes: List[UserChange], atomic: bool = False) -> List[BulkResult]:
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            with conn:
+                def current(user_id: int) -> Optional[User]:
+                    row = conn.execute(models.SELECT_USER, (user_id,)).fetchone()
+                    return self._to_user(row) if row else None
+
+                def email_owner(email: str) -> Optional[int]:
+                    row = conn.execute(models.SELECT_USER_ID_BY_EMAIL, (email,)).fetchone()
+                    return row[0] if row else None
+
+                accepted, errors = plan_updates(changes, current, email_owner)
+                if atomic and errors:
+                    raise BulkConflictError(errors)
+                # UNIQUE проверяется на каждой строке, поэтому при обмене email
+                # сначала уводим меняющиеся email во временные значения.
+                conn.executemany(
+                    models.UPDATE_USER_EMAIL,
+                    [(models.placeholder_email(old.id), old.id) for old, new in accepted.values() if old.email != new.email],
+                )
+                conn.executemany(
+                    models.UPDATE_USER_FIELDS,
+                    [
+                        (new.name, new.email, search.normalize(new.email), new.updated_at.isoformat(), new.id)
+                        for _, new in accepted.values()
+                    ],
+                )
+                ids = [new.id for _, new in accepted.values()]
+                rows = conn.execute(models.SELECT_USERS_BY_IDS, (json.dumps(ids),)).fetchall()
+        updated = {row[0]: self._to_user(row) for row in rows}
+        return [errors[i] if i in errors else updated[accepted[i][1].id] for i in range(len(changes))]
+
+    def delete(self, user_id: int) -> bool:
+        with self._connection() as conn:
+            return conn.execute(models.DELETE_USER, (user_id,)).rowcount > 0
+
+    def delete_many(self, user_ids: List[int]) -> List[int]:
+        with self._connection() as conn:
+            rows = conn.execute(models.DELETE_USERS_BY_IDS, (json.dumps(user_ids),)).fetchall()
+        deleted = {row[0] for row in rows}
+        return [user_id for user_id in dict.fromkeys(user_ids) if user_id in deleted]
+
+    def email_exists(self, email: str) -> bool:
+        with self._connection() as conn:
+            return conn.execute(models.EMAIL_EXISTS, (email,)).fetchone() is not None
+
+    def count(self) -> int:
+        with self._connection() as conn:
+            return conn.execute(models.COUNT_USERS).fetchone()[0]
+
+    def version(self) -> int:
+        with self._connection() as conn:
+            return conn.execute(models.SELECT_STORE_VERSION).fetchone()[0]
+
+    def user_version(self, user_id: int) -> Optional[int]:
+        with self._connection() as conn:
+            row = conn.execute(models.SELECT_USER_VERSION, (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def clear(self) -> None:
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            with conn:
+                conn.execute(models.DELETE_ALL_USERS)
+                conn.execute(models.RESET_USERS_SEQUENCE)
+                conn.execute(models.DELETE_ALL_CHANGES)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._opened = 0
+
+
+class AsyncUserStorage:
+    """Асинхронный интерфейс к `UserStorage` для кода в event loop.
+
+    Чтение неблокирующего хранилища в режиме `async` (`config.API_MODE`)
+    вызывается напрямую, без перехода в поток; иначе — через threadpool,
+    чтобы не останавливать event loop. Запись и журнал изменений всегда
+    идут через threadpool: они ждут блокировку записи хранилища, которую
+    пакетная операция может держать секунды.
+    """
+
+    def __init__(self, storage: UserStorage):
+        self.storage = storage
+
+    async def _call(self, method: Callable[..., Any], *args: Any) -> Any:
+        if self.storage.blocking or config.API_MODE != "async":
+            return await run_in_threadpool(method, *args)
+        return method(*args)
+
+    async def _offload(self, method: Callable[..., Any], *args: Any) -> Any:
+        """Вызов, который может ждать блокировку записи, — всегда в threadpool."""
+        return await run_in_threadpool(method, *args)
+
+    async def get(self, user_id: int) -> Optional[User]:
+        return await self._call(self.storage.get, user_id)
+
+    async def get_many(self, user_ids: List[int]) -> Dict[int, User]:
+        return await self._call(self.storage.get_many, user_ids)
+
+    async def list(self) -> List[User]:
+        return await self._call(self.storage.list)
+
+    async def page(
+        self, after: Optional[int] = None, limit: Optional[int] = None, domain: Optional[str] = None
+    ) -> List[User]:
+        return await self._call(self.storage.page, after, limit, domain)
+
+    async def page_by(
+        self,
+        field: str,
+        descending: bool = False,
+        after: Optional[SortPosition] = None,
+        limit: Optional[int] = None,
+    ) -> List[User]:
+        return await self._call(self.storage.page_by, field, descending, after, limit)
+
+    async def domain_stats(self, limit: Optional[int] = None) -> List[Tuple[str, int]]:
+        return await self._call(self.storage.domain_stats, limit)
+
+    async def search(
+        self, query: str, after: Optional[search.Position] = None, limit: int = 20
+    ) -> List[Tuple[int, User]]:
+        return await self._call(self.storage.search, query, after, limit)
+
+    async def changes(self, since: int, limit: int) -> List[ChangeRecord]:
+        return await self._offload(self.storage.changes, since, limit)
+
+    async def create(self, payload: UserCreate) -> User:
+        return await self._offload(self.storage.create, payload)
+
+    async def create_many(self, payloads: List[UserCreate], atomic: bool = False) -> List[Optional[User]]:
+        return await self._offload(self.storage.create_many, payloads, atomic)
+
+    async def update(self, user_id: int, payload: UserUpdate) -> User:
+        return await self._offload(self.storage.update, user_id, payload)
+
+    async def update_many(self, changes: List[UserChange], atomic: bool = False) -> List[BulkResult]:
+        return await self._offload(self.storage.update_many, changes, atomic)
+
+    async def delete(self, user_id: int) -> bool:
+        return await self._offload(self.storage.delete, user_id)
+
+    async def delete_many(self, user_ids: List[int]) -> List[int]:
+        return await self._offload(self.storage.delete_many, user_ids)
+
+    async def email_exists(self, email: str) -> bool:
+        return await self._call(self.storage.email_exists, email)
+
+    async def count(self) -> int:
+        return await self._call(self.storage.count)
+
+    async def version(self) -> int:
+        return await self._call(self.storage.version)
+
+    async def user_version(self, user_id: int) -> Optional[int]:
+        return await self._call(self.storage.user_version, user_id)
+
+    async def encode(self, user: User) -> bytes:
+        return await self._call(self.storage.encode, user)
+
+
+def build_storage() -> UserStorage:
+    """Создать хранилище по настройке `config.STORAGE_BACKEND`."""
+    if config.STORAGE_BACKEND == "memory":
+        journal = None
+        if config.JOURNAL_DIR:
+            journal = Journal(
+                config.JOURNAL_DIR,
+                fsync=config.JOURNAL_FSYNC,
+                fsync_interval_ms=config.JOURNAL_FSYNC_INTERVAL_MS,
+                snapshot_every=config.JOURNAL_SNAPSHOT_EVERY,
+            )
+        return InMemoryUserStorage(journal)
+    if config.STORAGE_BACKEND == "sqlite":
+        return SQLiteUserStorage(config.SQLITE_PATH)
+    raise ValueError(f"Unknown storage backend: {config.STORAGE_BACKEND!r}")
+
+
+_storage: UserStorage = build_storage()
+
+
+def get_storage() -> UserStorage:
+    """Текущее хранилище пользователей."""
+    return _storage
+
+
+def get_async_storage() -> AsyncUserStorage:
+    """Текущее хранилище с асинхронным интерфейсом."""
+    return AsyncUserStorage(_storage)
+
+
+def set_storage(storage: UserStorage) -> None:
+    """Заменить хранилище (другой движок, бенчмарки, тесты)."""
+    global _storage
+    _storage = storage
@@ -1,6 +1,61 @@
-from typing import Dict
+import time
+from typing import Dict, List, Set, Tuple
 from schemas import User
 
 
 users: Dict[int, User] = {}
+# Индекс email -> id: проверка уникальности за O(1) вместо перебора users.
+emails: Dict[str, int] = {}
+# Упорядоченный индекс ID для keyset-пагинации (bisect по `after`).
+ids: List[int] = []
+# Готовые JSON-байты каждого пользователя: кодируем при записи, а не при чтении.
+# Хранится пара (объект, байты): байты годятся только для того же объекта.
+json_cache: Dict[int, Tuple[User, bytes]] = {}
+# Поиск (см. `search`): триграмма имени -> ID.
+name_trigrams: Dict[str, Set[int]] = {}
+# Упорядоченные индексы (ключ, ID) для сортировки списка (`?sort=`) через
+# bisect; индекс email (в нижнем регистре) служит и поиску по префиксу.
+name_index: List[Tuple[str, int]] = []
+email_index: List[Tuple[str, int]] = []
+sorted_indexes: Dict[str, List[Tuple[str, int]]] = {"name": name_index, "email": email_index}
+# Домен email -> упорядоченный список ID его пользователей: фильтр
+# `?domain=` с keyset-пагинацией и гистограмма доменов (длины списков).
+domains: Dict[str, List[int]] = {}
 next_id = 1
+
+
+def initial_version() -> int:
+    """Стартовая версия — текущее время в микросекундах.
+
+    In-memory данные не переживают рестарт, а версии должны: иначе клиент
+    с ETag из прошлой жизни процесса получит ложный `304`.
+    """
+    return time.time_ns() // 1000
+
+
+# Версия для ETag и номер изменения для синхронизации: растёт на единицу при
+# каждом изменении; у пользователя (`User.seq`) — значение на момент его
+# последнего изменения.
+version = initial_version()
+# Журнал изменений (`/users/changes`): (seq, ID, операция) по возрастанию
+# seq, без пропусков. Изменения с seq <= changes_floor уже вытеснены из
+# журнала (или случились до старта процесса).
+changes: List[Tuple[int, int, str]] = []
+changes_floor = version
+
+
+def reset() -> None:
+    """Очистить хранилище и все индексы (используется в тестах)."""
+    global next_id, version, changes_floor
+    users.clear()
+    emails.clear()
+    ids.clear()
+    json_cache.clear()
+    name_trigrams.clear()
+    name_index.clear()
+    email_index.clear()
+    domains.clear()
+    next_id = 1
+    version = max(version + 1, initial_version())
+    changes.clear()
+    changes_floor = version
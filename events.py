@@ -0,0 +1,237 @@
+"""Лента изменений пользователей для Server-Sent Events (`GET /users/stream`).
+
+Эндпоинты записи вызывают `feed.notify()`. Один фоновый таск на процесс
+(`ChangeFeed._pump`) дочитывает журнал изменений хранилища
+(`UserStorage.changes`), один раз кодирует новые изменения в кадры SSE и
+раскладывает их по очередям подписчиков: цена изменения — один проход по
+журналу и копирование байтов в очереди, а не чтение списка каждым клиентом.
+
+- `id` события — seq изменения. Переподключившийся клиент присылает его в
+  `Last-Event-ID` и дочитывает пропущенное из того же журнала изменений;
+  если журнал уже вытеснил эту точку, приходит событие `reset` — клиенту
+  нужна полная загрузка списка.
+- Очереди подписчиков ограничены (`config.STREAM_QUEUE_SIZE`). Клиент,
+  не успевающий читать, отключается; после переподключения он догоняет
+  по `Last-Event-ID`.
+- Без записей лента раз в `config.STREAM_HEARTBEAT_SECONDS` рассылает
+  комментарий (держит соединение через прокси) и заодно проверяет журнал:
+  так видны изменения, сделанные другими процессами.
+- Ошибка чтения хранилища не останавливает насос: она пишется в лог,
+  а насос повторяет попытку на следующем пробуждении.
+"""
+
+import asyncio
+import logging
+from typing import AsyncIterator, List, Optional, Set, Tuple
+
+import config
+from crud import (
+    AsyncUserStorage,
+    ChangeRecord,
+    ChangesExpiredError,
+    changed_ids,
+    collapse_changes,
+    get_async_storage,
+    resolve_changes,
+)
+from responses import dumps
+
+logger = logging.getLogger(__name__)
+
+
+# Сколько записей журнала изменений читать за раз.
+FEED_BATCH = 500
+# Задержка переподключения EventSource, мс.
+RETRY_MS = 2000
+
+HEARTBEAT = b": ping\n\n"
+RESET = b"event: reset\ndata: {}\n\n"
+
+# Кадр в очереди подписчика: (seq, байты); у служебных кадров seq — None.
+Frame = Tuple[Optional[int], bytes]
+
+
+async def encode_changes(storage: AsyncUserStorage, records: List[ChangeRecord]) -> List[Frame]:
+    """Кадры SSE для записей журнала: одно событие на пользователя."""
+    collapsed = collapse_changes(records)
+    users = await storage.get_many(changed_ids(collapsed))
+    frames = []
+    for seq, op, user_id, user in resolve_changes(collapsed, users):
+        # encode — без ввода-вывода, даже у блокирующего хранилища.
+        data = storage.storage.encode(user) if user is not None else dumps({"id": user_id})
+        frames.append((seq, b"id: %d\nevent: %s\ndata: %s\n\n" % (seq, op.encode(), data)))
+    return frames
+
+
+class Subscription:
+    """Очередь кадров одного клиента."""
+
+    def __init__(self, size: int):
+        self.queue: "asyncio.Queue[Optional[Frame]]" = asyncio.Queue(maxsize=size)
+        # Позиция насоса на момент подписки: все изменения после неё придут
+        # в очередь. Пока насос не прочитал стартовую позицию — не готова.
+        self.start: "asyncio.Future[int]" = asyncio.get_running_loop().create_future()
+
+    def offer(self, frame: Frame) -> bool:
+        """Положить кадр; `False`, если очередь переполнена."""
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def close(self) -> None:
+        """Завершить поток клиента: очередь сбрасывается, читатель получит `None`."""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class ChangeFeed:
+    """Рассылка изменений подписчикам внутри процесса.
+
+    Насос работает, пока есть подписчики, в event loop первого из них.
+    """
+
+    def __init__(self):
+        self._subscriptions: Set[Subscription] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump_task: Optional["asyncio.Task[None]"] = None
+        # Seq последнего разосланного изменения; None, пока насос не запущен.
+        self._position: Optional[int] = None
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscriptions)
+
+    def notify(self) -> None:
+        """Сообщить о записи в хранилище. Можно вызывать из любого потока."""
+        loop, wakeup = self._loop, self._wakeup
+        if loop is None or wakeup is None:
+            return
+        try:
+            loop.call_soon_threadsafe(wakeup.set)
+        except RuntimeError:
+            # Event loop насоса уже закрыт (например, между тестами).
+            pass
+
+    def subscribe(self) -> Subscription:
+        """Новый подписчик; получит все изменения после `Subscription.start`."""
+        subscription = Subscription(config.STREAM_QUEUE_SIZE)
+        self._subscriptions.add(subscription)
+        if self._pump_task is None or self._pump_task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._position = None
+            self._pump_task = asyncio.create_task(self._pump())
+        elif self._position is not None:
+            subscription.start.set_result(self._position)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions.discard(subscription)
+        if not self._subscriptions and self._pump_task is not None:
+            self._pump_task.cancel()
+            self._pump_task = self._loop = self._wakeup = self._position = None
+
+    def _broadcast(self, frame: Frame) -> None:
+        for subscription in list(self._subscriptions):
+            if not subscription.offer(frame):
+                # Медленный клиент: отключаем, чтобы память не росла без предела.
+                subscription.close()
+                self._subscriptions.discard(subscription)
+
+    def _advance(self, position: int) -> None:
+        """Сдвинуть позицию насоса; ждущие подписчики стартуют с неё."""
+        self._position = position
+        for subscription in self._subscriptions:
+            if not subscription.start.done():
+                subscription.start.set_result(position)
+
+    async def _pump(self) -> None:
+        storage = get_async_storage()
+        wakeup = self._wakeup
+        while True:
+            try:
+                if self._position is None:
+                    # Стартовая позиция читается здесь, а не в `subscribe`:
+                    # хранилище может блокировать. Подписчики ждут её
+                    # (`Subscription.start`), поэтому изменения между подпиской
+                    # и чтением позиции не теряются.
+                    self._advance(await storage.version())
+                else:
+                    await self._drain(storage)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Change feed pump failed, retrying on next wakeup")
+            try:
+                await asyncio.wait_for(wakeup.wait(), config.STREAM_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                self._broadcast((None, HEARTBEAT))
+            wakeup.clear()
+
+    async def _drain(self, storage: AsyncUserStorage) -> None:
+        """Разослать все изменения журнала после текущей позиции."""
+        while True:
+            try:
+                records = await storage.changes(self._position, FEED_BATCH)
+            except ChangesExpiredError:
+                # Насос отстал от журнала или хранилище очищено.
+                self._advance(await storage.version())
+                self._broadcast((None, RESET))
+                return
+            for frame in await encode_changes(storage, records):
+                self._broadcast(frame)
+            if records:
+                self._advance(records[-1][0])
+            if len(records) < FEED_BATCH:
+                return
+
+
+async def stream(feed: ChangeFeed, last_event_id: Optional[int] = None) -> AsyncIterator[bytes]:
+    """Поток кадров SSE для одного клиента.
+
+    С `last_event_id` сначала дочитывает журнал изменений после него, затем
+    отдаёт кадры насоса, пропуская уже отправленные.
+    """
+    subscription = feed.subscribe()
+    storage = get_async_storage()
+    try:
+        # Насос разошлёт всё после `start`; догон по журналу начинается не
+        # раньше, чем насос узнал свою позицию, поэтому между ними нет пропуска.
+        start = await subscription.start
+        position = start if last_event_id is None else last_event_id
+        yield b"retry: %d\n\n" % RETRY_MS
+        if last_event_id is not None:
+            while True:
+                try:
+                    records = await storage.changes(position, FEED_BATCH)
+                except ChangesExpiredError:
+                    position = await storage.version()
+                    yield RESET
+                    break
+                for _, frame in await encode_changes(storage, records):
+                    yield frame
+                if records:
+                    position = records[-1][0]
+                if len(records) < FEED_BATCH:
+                    break
+
+        while True:
+            item = await subscription.queue.get()
+            if item is None:
+                return
+            seq, frame = item
+            if seq is not None:
+                # Насос мог разослать то, что клиент уже получил при догоне.
+                if seq <= position:
+                    continue
+                position = seq
+            yield frame
+    finally:
+        feed.unsubscribe(subscription)
+
+
+feed = ChangeFeed()
@@ -0,0 +1,213 @@
+"""Форматы тел запросов и ответов: JSON, MessagePack, CBOR.
+
+Формат ответа выбирается по `Accept`, формат тела запроса — по
+`Content-Type`. JSON — формат по умолчанию; MessagePack
+(`application/msgpack`) и CBOR (`application/cbor`) доступны, если
+установлены `msgpack` и `cbor2` (`pip install tupak-api[binary]`).
+
+Маршруты `routers/api.py` (`routing.StorageRoute`) выбирают формат ответа
+на каждый запрос (`response_codec`), а бинарное тело разбирают сразу в
+значения Python — FastAPI валидирует их в `UserCreate`/`UserUpdate` так же,
+как разобранный JSON.
+"""
+
+import json
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import Request
+
+from responses import FastJSONResponse, dumps, orjson
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - зависит от окружения
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # pragma: no cover - зависит от окружения
+    cbor2 = None
+
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+CBOR_MEDIA_TYPE = "application/cbor"
+
+
+class Codec:
+    """Формат тела: кодирование значения и массива из уже закодированных элементов."""
+
+    def __init__(
+        self,
+        name: str,
+        media_type: str,
+        dumps: Callable[[Any], bytes],
+        loads: Callable[[bytes], Any],
+        array_header: Optional[Callable[[int], bytes]] = None,
+        json_values: bool = True,
+    ):
+        self.name = name
+        self.media_type = media_type
+        self.dumps = dumps
+        self._loads = loads
+        self._array_header = array_header
+        # Даёт ли разбор только значения JSON. MessagePack и CBOR умеют
+        # больше (байтовые строки, расширения, теги), а значения тела
+        # попадают и в ответ `422`, который кодируется в JSON.
+        self._json_values = json_values
+
+    def loads(self, data: bytes) -> Any:
+        """Разобрать тело; любая ошибка разбора — `ValueError`."""
+        try:
+            value = self._loads(data)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise ValueError(f"Invalid {self.name}") from e
+        if not self._json_values and not is_json_value(value):
+            raise ValueError(f"Invalid {self.name}: only JSON-compatible values are supported")
+        return value
+
+    def array(self, items: List[bytes]) -> bytes:
+        """Массив из закодированных элементов: без повторного кодирования."""
+        if self._array_header is None:
+            return b"[" + b",".join(items) + b"]"
+        return self._array_header(len(items)) + b"".join(items)
+
+
+def is_json_value(value: Any) -> bool:
+    """Состоит ли значение только из типов JSON (ключи объектов — строки)."""
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            if not all(isinstance(key, str) for key in item):
+                return False
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+        elif item is not None and not isinstance(item, (str, int, float)):
+            # bool — подкласс int.
+            return False
+    return True
+
+
+def msgpack_array_header(size: int) -> bytes:
+    if size < 16:
+        return bytes((0x90 | size,))
+    if size < 1 << 16:
+        return b"\xdc" + size.to_bytes(2, "big")
+    return b"\xdd" + size.to_bytes(4, "big")
+
+
+def cbor_array_header(size: int) -> bytes:
+    if size < 24:
+        return bytes((0x80 | size,))
+    for marker, length in ((0x98, 1), (0x99, 2), (0x9A, 4)):
+        if size < 1 << (8 * length):
+            return bytes((marker,)) + size.to_bytes(length, "big")
+    return b"\x9b" + size.to_bytes(8, "big")
+
+
+JSON = Codec("JSON", JSON_MEDIA_TYPE, dumps, orjson.loads if orjson is not None else json.loads)
+
+# Поддерживаемые форматы по типу содержимого (включая устаревшие синонимы).
+CODECS: Dict[str, Codec] = {JSON_MEDIA_TYPE: JSON}
+if msgpack is not None:
+    MSGPACK = Codec("MessagePack", MSGPACK_MEDIA_TYPE, msgpack.packb, msgpack.unpackb, msgpack_array_header, json_values=False)
+    CODECS[MSGPACK_MEDIA_TYPE] = CODECS["application/x-msgpack"] = MSGPACK
+if cbor2 is not None:
+    CBOR = Codec("CBOR", CBOR_MEDIA_TYPE, cbor2.dumps, cbor2.loads, cbor_array_header, json_values=False)
+    CODECS[CBOR_MEDIA_TYPE] = CBOR
+
+
+def media_type_of(content_type: str) -> str:
+    """Тип содержимого без параметров (`charset` и т. п.)."""
+    return content_type.split(";")[0].strip().lower()
+
+
+def body_codec(content_type: Optional[str]) -> Optional[Codec]:
+    """Формат тела запроса по `Content-Type`; `None` — не наш формат."""
+    if content_type is None:
+        return None
+    return CODECS.get(media_type_of(content_type))
+
+
+@lru_cache(maxsize=256)
+def negotiate(accept: Optional[str]) -> Codec:
+    """Формат ответа по `Accept`: поддерживаемый тип с наибольшим `q`.
+
+    Без заголовка, с `*/*` или без поддерживаемых типов — JSON. Значения
+    `Accept` у клиентов повторяются, поэтому разбор кешируется.
+    """
+    if not accept:
+        return JSON
+    # При равном q явно названный тип важнее маски (`*/*`).
+    best, best_rank = JSON, (0.0, False)
+    for entry in accept.split(","):
+        media_type, *params = entry.split(";")
+        media_type = media_type.strip().lower()
+        codec = JSON if media_type in ("*/*", "application/*") else CODECS.get(media_type)
+        if codec is None:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        rank = (q, "*" not in media_type)
+        if q > 0 and rank > best_rank:
+            best, best_rank = codec, rank
+    return best
+
+
+_response_codec: ContextVar[Codec] = ContextVar("response_codec", default=JSON)
+
+
+def response_codec() -> Codec:
+    """Формат ответа текущего запроса (выбирает `routing.StorageRoute`)."""
+    return _response_codec.get()
+
+
+def use_codec(codec: Codec):
+    """Назначить формат ответа текущего запроса; вернёт токен для `reset_codec`."""
+    return _response_codec.set(codec)
+
+
+def reset_codec(token) -> None:
+    _response_codec.reset(token)
+
+
+class DecodedBodyRequest(Request):
+    """Запрос с телом в MessagePack/CBOR, которое FastAPI читает как JSON.
+
+    FastAPI разбирает тело для `Body`-параметров только при JSON-типе
+    содержимого, поэтому тип подменяется, а `json()` разбирает исходный формат.
+    """
+
+    def __init__(self, request: Request, codec: Codec):
+        headers = [(name, value) for name, value in request.scope["headers"] if name != b"content-type"]
+        headers.append((b"content-type", JSON_MEDIA_TYPE.encode()))
+        super().__init__({**request.scope, "headers": headers}, request.receive)
+        self.codec = codec
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = self.codec.loads(await self.body())
+        return self._json
+
+
+class NegotiatedResponse(FastJSONResponse):
+    """Ответ в формате текущего запроса (`response_codec`); по умолчанию JSON."""
+
+    def render(self, content: Any) -> bytes:
+        codec = response_codec()
+        if codec is JSON:
+            return super().render(content)
+        self.media_type = codec.media_type
+        return codec.dumps(content)
@@ -0,0 +1,307 @@
+"""Схема таблиц и SQL-запросы для SQLite-хранилища пользователей.
+
+Запросы держим константами: модуль `sqlite3` кэширует скомпилированные
+(prepared) выражения на соединении по тексту запроса.
+"""
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# AUTOINCREMENT — чтобы ID удалённых пользователей не переиспользовались,
+# как и в in-memory хранилище.
+CREATE_USERS = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    email_folded TEXT NOT NULL DEFAULT '',
+    domain TEXT GENERATED ALWAYS AS (lower(substr(email, instr(email, '@') + 1))) VIRTUAL
+)
+"""
+CREATE_USERS_EMAIL_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email)"
+# Колонки для `User`: seq пользователя — его версия.
+USER_COLUMNS = "id, name, email, created_at, updated_at, version"
+
+# Глобальная версия хранилища (для ETag и синхронизации) и число
+# пользователей. Ведутся триггерами, поэтому одинаковы для всех воркеров,
+# работающих с файлом. changes_kept — сколько изменений хранить в user_changes.
+CREATE_STORE_META = """
+CREATE TABLE IF NOT EXISTS store_meta (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL,
+    user_count INTEGER NOT NULL DEFAULT 0,
+    changes_kept INTEGER NOT NULL DEFAULT 100000
+)
+"""
+INIT_STORE_META = """
+INSERT OR IGNORE INTO store_meta (id, version, user_count)
+VALUES (1, 0, (SELECT COUNT(*) FROM users))
+"""
+
+# Счётчики пользователей по доменам email для гистограммы; ведутся триггерами.
+CREATE_DOMAIN_STATS = """
+CREATE TABLE IF NOT EXISTS domain_stats (
+    domain TEXT PRIMARY KEY,
+    users INTEGER NOT NULL
+) WITHOUT ROWID
+"""
+FILL_DOMAIN_STATS = "INSERT INTO domain_stats (domain, users) SELECT domain, COUNT(*) FROM users GROUP BY domain"
+
+# Журнал изменений для синхронизации (`/users/changes`): seq — версия
+# хранилища после изменения. INTEGER PRIMARY KEY — это rowid, так что
+# выборка «после since» идёт по B-дереву таблицы без отдельного индекса.
+CREATE_USER_CHANGES = """
+CREATE TABLE IF NOT EXISTS user_changes (
+    seq INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    op TEXT NOT NULL
+)
+"""
+SET_CHANGES_KEPT = "UPDATE store_meta SET changes_kept = ? WHERE id = 1"
+# Изменения после «пола» есть в журнале все: seq идут подряд. Пустой журнал
+# (новая база или только что очищенная) начинается с текущей версии.
+SELECT_CHANGES_RANGE = """
+SELECT COALESCE((SELECT MIN(seq) FROM user_changes) - 1, version), version
+FROM store_meta WHERE id = 1
+"""
+SELECT_CHANGES = "SELECT seq, user_id, op FROM user_changes WHERE seq > ? ORDER BY seq LIMIT ?"
+DELETE_ALL_CHANGES = "DELETE FROM user_changes"
+
+# Колонки, добавленные после первой версии схемы:
+# (таблица, колонка, выражения для добавления и заполнения).
+MIGRATIONS = (
+    ("users", "version", ("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0",)),
+    # Домен — до первой «@», в нижнем регистре (как `crud.email_domain`).
+    (
+        "users",
+        "domain",
+        (
+            "ALTER TABLE users ADD COLUMN domain TEXT"
+            " GENERATED ALWAYS AS (lower(substr(email, instr(email, '@') + 1))) VIRTUAL",
+        ),
+    ),
+    (
+        "store_meta",
+        "user_count",
+        (
+            "ALTER TABLE store_meta ADD COLUMN user_count INTEGER NOT NULL DEFAULT 0",
+            "UPDATE store_meta SET user_count = (SELECT COUNT(*) FROM users)",
+        ),
+    ),
+    ("store_meta", "changes_kept", ("ALTER TABLE store_meta ADD COLUMN changes_kept INTEGER NOT NULL DEFAULT 100000",)),
+    # Время создания уже сохранённых пользователей неизвестно: ставим время миграции.
+    (
+        "users",
+        "created_at",
+        (
+            "ALTER TABLE users ADD COLUMN created_at TEXT NOT NULL DEFAULT ''",
+            "UPDATE users SET created_at = strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')",
+        ),
+    ),
+    (
+        "users",
+        "updated_at",
+        (
+            "ALTER TABLE users ADD COLUMN updated_at TEXT NOT NULL DEFAULT ''",
+            "UPDATE users SET updated_at = created_at",
+        ),
+    ),
+    # Заполняет `SQLiteUserStorage` (свёртка email — функция Python).
+    ("users", "email_folded", ("ALTER TABLE users ADD COLUMN email_folded TEXT NOT NULL DEFAULT ''",)),
+)
+# table_xinfo, а не table_info: только он показывает генерируемые колонки.
+TABLE_COLUMNS = "SELECT name FROM pragma_table_xinfo(?)"
+
+# Триггеры до журнала изменений: их работу делают users_change_*. Версия
+# и запись журнала должны меняться в одном триггере, порядок срабатывания
+# разных триггеров SQLite не гарантирует.
+RETIRED_TRIGGERS = ("users_version_insert", "users_version_update", "users_version_delete")
+# Триггеры, чьё определение менялось: CREATE TRIGGER IF NOT EXISTS старое
+# не заменит, поэтому при открытии базы они создаются заново.
+REPLACED_TRIGGERS = ("users_change_update", "users_domain_update")
+DROP_TRIGGER = "DROP TRIGGER IF EXISTS {}"
+# Временные email пакетного обмена (`placeholder_email`) — не изменения:
+# ни версии, ни записи журнала, ни счётчиков доменов.
+IS_REAL_EMAIL = "{}.email NOT LIKE char(0) || '%'"
+
+# Каждое изменение: версия хранилища +1, версия пользователя, запись в
+# журнал изменений и вытеснение записей старше changes_kept.
+# Триггер на UPDATE смотрит только на name/email: его собственный
+# UPDATE колонки version не запускает его повторно. Шаг обмена email
+# через временное значение он пропускает: пользователь получает одну
+# версию — на шаге с итоговым email.
+CREATE_VERSION_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS users_change_insert AFTER INSERT ON users BEGIN
+        UPDATE store_meta SET version = version + 1 WHERE id = 1;
+        UPDATE users SET version = (SELECT version FROM store_meta WHERE id = 1) WHERE id = NEW.id;
+        INSERT INTO user_changes (seq, user_id, op) SELECT version, NEW.id, 'create' FROM store_meta WHERE id = 1;
+        DELETE FROM user_changes WHERE seq <= (SELECT version - changes_kept FROM store_meta WHERE id = 1);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS users_change_update AFTER UPDATE OF name, email ON users
+    WHEN {IS_REAL_EMAIL.format("new")} BEGIN
+        UPDATE store_meta SET version = version + 1 WHERE id = 1;
+        UPDATE users SET version = (SELECT version FROM store_meta WHERE id = 1) WHERE id = NEW.id;
+        INSERT INTO user_changes (seq, user_id, op) SELECT version, NEW.id, 'update' FROM store_meta WHERE id = 1;
+        DELETE FROM user_changes WHERE seq <= (SELECT version - changes_kept FROM store_meta WHERE id = 1);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_change_delete AFTER DELETE ON users BEGIN
+        UPDATE store_meta SET version = version + 1 WHERE id = 1;
+        INSERT INTO user_changes (seq, user_id, op) SELECT version, OLD.id, 'delete' FROM store_meta WHERE id = 1;
+        DELETE FROM user_changes WHERE seq <= (SELECT version - changes_kept FROM store_meta WHERE id = 1);
+    END
+    """,
+    # Счётчик пользователей: COUNT(*) в SQLite — полный проход по индексу.
+    """
+    CREATE TRIGGER IF NOT EXISTS users_count_insert AFTER INSERT ON users BEGIN
+        UPDATE store_meta SET user_count = user_count + 1 WHERE id = 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_count_delete AFTER DELETE ON users BEGIN
+        UPDATE store_meta SET user_count = user_count - 1 WHERE id = 1;
+    END
+    """,
+)
+
+CREATE_USERS_DOMAIN_INDEX = "CREATE INDEX IF NOT EXISTS ix_users_domain ON users (domain, id)"
+CREATE_DOMAIN_STATS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS users_domain_insert AFTER INSERT ON users BEGIN
+        INSERT INTO domain_stats (domain, users) VALUES (new.domain, 1)
+        ON CONFLICT (domain) DO UPDATE SET users = users + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_domain_delete AFTER DELETE ON users BEGIN
+        UPDATE domain_stats SET users = users - 1 WHERE domain = old.domain;
+        DELETE FROM domain_stats WHERE domain = old.domain AND users = 0;
+    END
+    """,
+    # При обмене email пользователь уходит из старого домена на шаге к
+    # временному email, а в новый приходит на шаге от него.
+    f"""
+    CREATE TRIGGER IF NOT EXISTS users_domain_update AFTER UPDATE OF email ON users
+    WHEN old.domain IS NOT new.domain BEGIN
+        UPDATE domain_stats SET users = users - 1 WHERE domain = old.domain AND {IS_REAL_EMAIL.format("old")};
+        DELETE FROM domain_stats WHERE domain = old.domain AND users = 0;
+        INSERT INTO domain_stats (domain, users) SELECT new.domain, 1 WHERE {IS_REAL_EMAIL.format("new")}
+        ON CONFLICT (domain) DO UPDATE SET users = users + 1;
+    END
+    """,
+)
+# Сортированные страницы (`?sort=`): выражение ключа для каждого поля.
+# Индексы хранят rowid (= id), поэтому «ключ, id» читается по индексу.
+CREATE_USERS_NAME_INDEX = "CREATE INDEX IF NOT EXISTS ix_users_name ON users (name)"
+SORT_EXPRESSIONS = {"id": "id", "name": "name", "email": "email_folded"}
+# (поле, по убыванию, есть ли позиция) -> запрос; тексты фиксированы ради кэша statements.
+SELECT_USERS_SORTED = {
+    (field, descending, after): (
+        f"SELECT {USER_COLUMNS} FROM users"
+        # Отдельное условие на ключ — чтобы индекс по выражению дал диапазон;
+        # параметры: ключ, ключ, id, limit.
+        + (f" WHERE {expr} {'<=' if descending else '>='} ? AND ({expr}, id) {'<' if descending else '>'} (?, ?)"
+           if after else "")
+        + f" ORDER BY {expr} {'DESC' if descending else 'ASC'}"
+        + (f", id {'DESC' if descending else 'ASC'}" if field != "id" else "")
+        + " LIMIT ?"
+    )
+    for field, expr in SORT_EXPRESSIONS.items()
+    for descending in (False, True)
+    for after in (False, True)
+}
+SELECT_DOMAIN_STATS = "SELECT domain, users FROM domain_stats ORDER BY users DESC, domain LIMIT ?"
+SELECT_USERS_PAGE_BY_DOMAIN = f"SELECT {USER_COLUMNS} FROM users WHERE domain = ? AND id > ? ORDER BY id LIMIT ?"
+
+# Поиск (см. `search`): триграммный FTS5-индекс имён поверх таблицы users
+# (external content, синхронизируется триггерами) и индекс email без
+# учёта регистра для поиска по префиксу.
+#
+# Встроенный `lower` SQLite меняет регистр только у ASCII, а ключи
+# сортировки и запросы поиска приводит к нижнему регистру Python
+# (`search.normalize`). Поэтому свёрнутый email хранится в колонке
+# `email_folded`: её пишет приложение при вставке и изменении email, а
+# индекс по ней — обычный, и файл базы читается и меняется любым клиентом
+# SQLite без функций приложения.
+CREATE_USERS_EMAIL_FOLDED_INDEX = "CREATE INDEX IF NOT EXISTS ix_users_email_fold ON users (email_folded)"
+# Индексы прежних версий схемы, которые заменены новыми.
+RETIRED_INDEXES = ("ix_users_email_lower", "ix_users_email_folded")
+DROP_INDEX = "DROP INDEX IF EXISTS {}"
+SELECT_EMAILS = "SELECT id, email FROM users"
+SET_EMAIL_FOLDED = "UPDATE users SET email_folded = ? WHERE id = ?"
+USERS_NAME_FTS = "users_name_fts"
+CREATE_USERS_NAME_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS users_name_fts
+USING fts5(name, content='users', content_rowid='id', tokenize='trigram')
+"""
+REBUILD_USERS_NAME_FTS = "INSERT INTO users_name_fts (users_name_fts) VALUES ('rebuild')"
+TABLE_EXISTS = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+CREATE_SEARCH_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_name_fts (rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_name_fts (users_name_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF name ON users BEGIN
+        INSERT INTO users_name_fts (users_name_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO users_name_fts (rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+)
+# Диапазон [префикс, префикс + U+10FFFF) по индексу ix_users_email_fold.
+SEARCH_USERS_BY_EMAIL_PREFIX = f"SELECT {USER_COLUMNS} FROM users WHERE email_folded >= ? AND email_folded < ?"
+SEARCH_USERS_BY_NAME = f"""
+SELECT {USER_COLUMNS} FROM users
+WHERE id IN (SELECT rowid FROM users_name_fts WHERE users_name_fts MATCH ?)
+"""
+
+SELECT_USER = f"SELECT {USER_COLUMNS} FROM users WHERE id = ?"
+SELECT_USER_VERSION = "SELECT version FROM users WHERE id = ?"
+SELECT_STORE_VERSION = "SELECT version FROM store_meta WHERE id = 1"
+SELECT_USERS = f"SELECT {USER_COLUMNS} FROM users ORDER BY id"
+# Список ID передаётся одним JSON-параметром: текст запроса не зависит от
+# числа ID, и prepared statement переиспользуется.
+SELECT_USERS_BY_IDS = f"SELECT {USER_COLUMNS} FROM users WHERE id IN (SELECT value FROM json_each(?))"
+SELECT_USERS_PAGE = f"SELECT {USER_COLUMNS} FROM users WHERE id > ? ORDER BY id LIMIT ?"
+INSERT_USER = "INSERT INTO users (name, email, email_folded, created_at, updated_at) VALUES (?, ?, ?, ?, ?) RETURNING id"
+# Для executemany: RETURNING там не поддерживается, ID берём из sqlite_sequence.
+INSERT_USER_NO_RETURNING = "INSERT INTO users (name, email, email_folded, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+SELECT_USERS_SEQUENCE = "SELECT seq FROM sqlite_sequence WHERE name = 'users'"
+UPDATE_USER = """
+UPDATE users SET name = COALESCE(?, name), email = COALESCE(?, email),
+    email_folded = COALESCE(?, email_folded), updated_at = ?
+WHERE id = ?
+"""
+UPDATE_USER_FIELDS = "UPDATE users SET name = ?, email = ?, email_folded = ?, updated_at = ? WHERE id = ?"
+UPDATE_USER_EMAIL = "UPDATE users SET email = ? WHERE id = ?"
+SELECT_USER_ID_BY_EMAIL = "SELECT id FROM users WHERE email = ?"
+DELETE_USER = "DELETE FROM users WHERE id = ?"
+DELETE_USERS_BY_IDS = "DELETE FROM users WHERE id IN (SELECT value FROM json_each(?)) RETURNING id"
+EMAIL_EXISTS = "SELECT 1 FROM users WHERE email = ?"
+COUNT_USERS = "SELECT user_count FROM store_meta WHERE id = 1"
+DELETE_ALL_USERS = "DELETE FROM users"
+RESET_USERS_SEQUENCE = "DELETE FROM sqlite_sequence WHERE name = 'users'"
+
+
+def placeholder_email(user_id: int) -> str:
+    """Временный уникальный email на время пакетного обмена email.
+
+    Начинается с NUL — валидный email так начинаться не может.
+    """
+    return f"\x00{user_id}"
@@ -0,0 +1,28 @@
+"""Быстрый JSON-ответ: orjson, если установлен, иначе stdlib `json`.
+
+orjson — необязательная зависимость (`pip install tupak-api[fast]`).
+"""
+
+import json
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - зависит от окружения
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    """JSON в байтах; без orjson — stdlib с настройками `JSONResponse`."""
+    if orjson is None:
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+    return orjson.dumps(content)
+
+
+class FastJSONResponse(JSONResponse):
+    """`JSONResponse`, который кодирует через orjson при его наличии."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -1,11 +1,209 @@
 
-from typing import List
-from fastapi import Body, HTTPException, Path, APIRouter, status
-from schemas import ErrorResponse, User, UserCreate, UserUpdate
-from database import users
-import database
+import base64
+import binascii
+import json
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Callable, Generator, Iterator, List, Optional, Tuple
+from fastapi import Body, Header, HTTPException, Path, APIRouter, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from starlette.types import Receive, Scope, Send
+import config
+import events
+import media
+import search
+from schemas import (
+    BatchGetResponse,
+    BulkCreateResponse,
+    BulkDeleteResponse,
+    BulkItemResult,
+    BulkUpdateResponse,
+    ChangeEntry,
+    ChangesResponse,
+    DomainCount,
+    ErrorResponse,
+    User,
+    UserBulkUpdate,
+    UserCount,
+    UserCreate,
+    UserIdsRequest,
+    UserUpdate,
+)
+from crud import (
+    SORT_KEYS,
+    BulkConflictError,
+    ChangesExpiredError,
+    DuplicateIdError,
+    EmailAlreadyExistsError,
+    SortPosition,
+    UserNotFoundError,
+    UserStorage,
+    changed_ids,
+    collapse_changes,
+    get_storage,
+    resolve_changes,
+)
+from routing import StorageRoute, offload
+
+router = APIRouter(default_response_class=media.NegotiatedResponse, route_class=StorageRoute)
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+TOTAL_COUNT_HEADER = "X-Total-Count"
+CHANGE_SEQ_HEADER = "X-Change-Seq"
+# Размер страницы изменений по умолчанию и максимальный.
+CHANGES_PAGE_SIZE = 500
+CHANGES_MAX_PAGE_SIZE = 5000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Сколько строк NDJSON склеивать в один чанк ответа: каждый шаг sync-
+# генератора StreamingResponse — отдельный переход в threadpool.
+EXPORT_CHUNK_SIZE = 500
+
+
+def encode_cursor(**position: Any) -> str:
+    """Непрозрачный курсор «после этой позиции» (например, `id=` последнего)."""
+    raw = json.dumps(position, separators=(",", ":"), ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, **fields: type) -> Tuple[Any, ...]:
+    """Значения полей курсора заданных типов; `400`, если курсор повреждён."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        position = json.loads(raw)
+        values = tuple(position[name] for name in fields)
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not all(type(value) is kind for value, kind in zip(values, fields.values())):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+SORT_PATTERN = f"^-?({'|'.join(SORT_KEYS)})$"
+
+
+def decode_sort_cursor(cursor: str, sort: str) -> SortPosition:
+    """Позиция (ключ, ID) из курсора сортированного списка той же сортировки."""
+    key_type = int if sort.lstrip("-") == "id" else str
+    cursor_sort, key, user_id = decode_cursor(cursor, sort=str, key=key_type, id=int)
+    if cursor_sort != sort:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key, user_id
+
+
+def json_array(encode: Callable[[User], bytes], users: List[User]) -> bytes:
+    """JSON-массив из байтов пользователей (`encode` — обычно `storage.encode`)."""
+    return b"[" + b",".join(map(encode, users)) + b"]"
+
+
+USER_FIELDS = tuple(User.model_fields)
+FIELDS_DESCRIPTION = (
+    f"Вернуть только перечисленные поля через запятую ({', '.join(USER_FIELDS)}). "
+    "Без параметра — все поля."
+)
+
+
+def parse_fields(fields: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """Набор полей из `?fields=` в порядке модели; `None` — все поля."""
+    if fields is None:
+        return None
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = requested - set(USER_FIELDS)
+    if not requested:
+        raise HTTPException(status_code=400, detail="No fields requested")
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    if len(requested) == len(USER_FIELDS):
+        return None
+    return tuple(name for name in USER_FIELDS if name in requested)
+
+
+@lru_cache(maxsize=None)
+def fieldset_encoder(fields: Tuple[str, ...]) -> Callable[[User], bytes]:
+    """Сериализатор под набор полей: собирается один раз на комбинацию.
+
+    Кодирует сериализатор pydantic — даты в том же формате, что и в полном ответе.
+    """
+    include = set(fields)
+    serializer = User.__pydantic_serializer__
+    return lambda user: serializer.to_json(user, include=include)
+
+
+@lru_cache(maxsize=None)
+def binary_encoder(codec: media.Codec, fields: Optional[Tuple[str, ...]]) -> Callable[[User], bytes]:
+    """Сериализатор в MessagePack/CBOR: значения полей — как в JSON-ответе."""
+    include = set(fields) if fields is not None else None
+    serializer = User.__pydantic_serializer__
+    dumps = codec.dumps
+    return lambda user: dumps(serializer.to_python(user, mode="json", include=include))
+
+
+def user_encoder(storage: UserStorage, fields: Optional[Tuple[str, ...]]) -> Callable[[User], bytes]:
+    """Сериализатор в формате ответа запроса.
+
+    JSON со всеми полями — готовые байты из хранилища, иначе — проекция до кодирования.
+    """
+    codec = media.response_codec()
+    if codec is not media.JSON:
+        return binary_encoder(codec, fields)
+    return storage.encode if fields is None else fieldset_encoder(fields)
+
+
+def users_response(encode: Callable[[User], bytes], users: List[User], headers: Optional[dict] = None) -> Response:
+    """Массив пользователей в формате ответа запроса (`encode` — из `user_encoder`)."""
+    codec = media.response_codec()
+    return Response(codec.array(list(map(encode, users))), media_type=codec.media_type, headers=headers)
+
+
+def make_etag(version: int) -> str:
+    """Сильный ETag из версии хранилища или пользователя.
+
+    Представления в MessagePack и CBOR отличаются от JSON побайтово, поэтому
+    их ETag включает формат ответа; у JSON он остаётся просто версией.
+    """
+    codec = media.response_codec()
+    if codec is media.JSON:
+        return f'"{version}"'
+    return f'"{version}-{codec.name}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Совпадает ли ETag с `If-None-Match` (слабое сравнение, RFC 9110)."""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+
+# Пользователи для примеров ответов в документации.
+USER_EXAMPLES = [
+    {
+        "id": 1,
+        "name": "Иван Петров",
+        "email": "ivan.petrov@example.com",
+        "created_at": "2024-05-01T12:00:00Z",
+        "updated_at": "2024-05-01T12:00:00Z",
+        "seq": 1,
+    },
+    {
+        "id": 2,
+        "name": "Анна Иванова",
+        "email": "anna@example.com",
+        "created_at": "2024-05-01T12:00:00Z",
+        "updated_at": "2024-05-01T12:00:00Z",
+        "seq": 2,
+    },
+]
+IF_NONE_MATCH_DESCRIPTION = "ETag из предыдущего ответа. Если данные не менялись, вернётся `304` без тела."
+NOT_MODIFIED_RESPONSE = {"description": "Данные не изменились с указанного `ETag` (тело пустое)"}
+ETAG_HEADER_DOC = {"ETag": {"description": "Версия данных для `If-None-Match`.", "schema": {"type": "string"}}}
 
-router = APIRouter()
 
 @router.post(
     "/users",
@@ -25,7 +223,7 @@ router = APIRouter()
             "description": "Пользователь создан",
             "content": {
                 "application/json": {
-                    "example": {"id": 1, "name": "Иван Петров", "email": "ivan.petrov@example.com"}
+                    "example": USER_EXAMPLES[0]
                 }
             },
         },
@@ -37,6 +235,7 @@ router = APIRouter()
         422: {"description": "Ошибка валидации входных данных"},
     },
 )
+@offload()
 def create_user(
     payload: UserCreate = Body(
         ...,
@@ -49,43 +248,800 @@ def create_user(
         },
     )
 ):
-    """Создание пользователя (in-memory)."""
-    if any(u.email == payload.email for u in users.values()):
+    """Создание пользователя."""
+    try:
+        user = get_storage().create(payload)
+    except EmailAlreadyExistsError:
         raise HTTPException(status_code=400, detail="Email already exists")
-
-    user = User(id=database.next_id, name=payload.name, email=payload.email)
-    users[database.next_id] = user
-    database.next_id += 1
+    events.feed.notify()
     return user
 
 
+def parse_batch(body: bytes, content_type: str) -> List[Any]:
+    """Элементы пачки из массива (JSON, MessagePack, CBOR) или NDJSON (одна строка — один элемент)."""
+    media_type = media.media_type_of(content_type)
+    if media_type == NDJSON_MEDIA_TYPE:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                # Битая строка станет ошибкой валидации этого элемента.
+                items.append(line.decode("utf-8", "replace"))
+        return items
+    # Неизвестный тип содержимого разбирается как JSON.
+    codec = media.CODECS.get(media_type, media.JSON)
+    try:
+        items = codec.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {codec.name}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail=f"Expected a {codec.name} array")
+    return items
+
+
+def validation_detail(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, e['loc'])) or 'item'}: {e['msg']}" for e in error.errors())
+
+
+def validate_batch(items: List[Any], model) -> Tuple[List[Tuple[int, Any]], List[BulkItemResult]]:
+    """Провалидировать элементы: (индекс, модель) для валидных и ошибки `422`."""
+    check_batch_size(len(items))
+    valid, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, model.model_validate(item)))
+        except ValidationError as e:
+            errors.append(BulkItemResult(index=index, status=422, detail=validation_detail(e)))
+    return valid, errors
+
+
+def bulk_error(index: int, error: Exception) -> BulkItemResult:
+    """Ошибка хранилища для элемента пачки -> результат с HTTP-статусом."""
+    if isinstance(error, UserNotFoundError):
+        return BulkItemResult(index=index, status=404, detail="User not found")
+    if isinstance(error, DuplicateIdError):
+        return BulkItemResult(index=index, status=400, detail="Duplicate id in batch")
+    return BulkItemResult(index=index, status=400, detail="Email already exists")
+
+
+def check_batch_size(size: int) -> None:
+    if size > config.BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Too many items (max {config.BULK_MAX_ITEMS})")
+
+
+def bulk_create(body: bytes, content_type: str, atomic: bool, response: Response) -> BulkCreateResponse:
+    valid, errors = validate_batch(parse_batch(body, content_type), UserCreate)
+    if atomic and errors:
+        response.status_code = 422
+        return BulkCreateResponse(created=0, failed=len(errors), results=errors)
+
+    try:
+        created = get_storage().create_many([payload for _, payload in valid], atomic=atomic)
+    except BulkConflictError as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        conflicts = [bulk_error(valid[i][0], error) for i, error in sorted(e.errors.items())]
+        return BulkCreateResponse(created=0, failed=len(conflicts), results=conflicts)
+    events.feed.notify()
+
+    results = errors + [
+        BulkItemResult(index=index, status=201, user=user)
+        if user is not None
+        else bulk_error(index, EmailAlreadyExistsError(payload.email))
+        for (index, payload), user in zip(valid, created)
+    ]
+    results.sort(key=lambda r: r.index)
+    succeeded = sum(1 for r in results if r.status == 201)
+    response.status_code = status.HTTP_201_CREATED if succeeded == len(results) else status.HTTP_200_OK
+    return BulkCreateResponse(created=succeeded, failed=len(results) - succeeded, results=results)
+
+
+@router.post(
+    "/users/bulk",
+    response_model=BulkCreateResponse,
+    status_code=status.HTTP_201_CREATED,
+    tags=["users"],
+    summary="Создать пользователей пачкой",
+    description=f"""
+Создаёт много пользователей одним запросом (до {config.BULK_MAX_ITEMS} за раз).
+
+**Тело:** JSON-массив объектов `UserCreate` или NDJSON (`Content-Type: application/x-ndjson`,
+один объект на строку).
+
+**Режимы (`atomic`):**
+- `true` (по умолчанию) — всё или ничего: при любой ошибке ничего не создаётся,
+  в ответе перечислены ошибочные элементы (`400` — занятые email, `422` — ошибки валидации).
+- `false` — создаётся всё, что можно; результат по каждому элементу в `results`.
+  Код ответа `201`, если создано всё, иначе `200`.
+
+Дубли email проверяются за один проход — и с хранилищем, и внутри пачки
+(создаётся первое вхождение). Созданные пользователи получают сплошной блок ID.
+""",
+    responses={
+        200: {"model": BulkCreateResponse, "description": "Пачка обработана частично (`atomic=false`)"},
+        400: {"model": BulkCreateResponse, "description": "Атомарная пачка отклонена: email уже существует"},
+        413: {"model": ErrorResponse, "description": "Слишком большая пачка"},
+        422: {"model": BulkCreateResponse, "description": "Атомарная пачка отклонена: ошибки валидации"},
+    },
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {"type": "array", "items": {"$ref": "#/components/schemas/UserCreate"}},
+                    "example": [
+                        {"name": "Иван Петров", "email": "ivan.petrov@example.com"},
+                        {"name": "Анна Иванова", "email": "anna@example.com"},
+                    ],
+                },
+                NDJSON_MEDIA_TYPE: {
+                    "schema": {"type": "string"},
+                    "example": (
+                        '{"name":"Иван Петров","email":"ivan.petrov@example.com"}\n'
+                        '{"name":"Анна Иванова","email":"anna@example.com"}\n'
+                    ),
+                },
+            },
+        }
+    },
+)
+async def create_users_bulk(
+    request: Request,
+    response: Response,
+    atomic: bool = Query(True, description="Всё или ничего (`true`) или по возможности (`false`)."),
+):
+    """Пакетное создание пользователей."""
+    body = await request.body()
+    content_type = request.headers.get("content-type", "application/json")
+    # Разбор, валидация и запись — в threadpool, чтобы не держать event loop.
+    return await run_in_threadpool(bulk_create, body, content_type, atomic, response)
+
+
+def bulk_update(body: bytes, content_type: str, atomic: bool, response: Response) -> BulkUpdateResponse:
+    valid, errors = validate_batch(parse_batch(body, content_type), UserBulkUpdate)
+    if atomic and errors:
+        response.status_code = 422
+        return BulkUpdateResponse(updated=0, failed=len(errors), results=errors)
+
+    try:
+        # UserBulkUpdate — наследник UserUpdate, его можно передать как изменения.
+        updated = get_storage().update_many([(item.id, item) for _, item in valid], atomic=atomic)
+    except BulkConflictError as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        conflicts = [bulk_error(valid[i][0], error) for i, error in sorted(e.errors.items())]
+        return BulkUpdateResponse(updated=0, failed=len(conflicts), results=conflicts)
+    events.feed.notify()
+
+    results = errors + [
+        BulkItemResult(index=index, status=200, user=result)
+        if isinstance(result, User)
+        else bulk_error(index, result)
+        for (index, _), result in zip(valid, updated)
+    ]
+    results.sort(key=lambda r: r.index)
+    succeeded = sum(1 for r in results if r.status == 200)
+    return BulkUpdateResponse(updated=succeeded, failed=len(results) - succeeded, results=results)
+
+
+@router.patch(
+    "/users/bulk",
+    response_model=BulkUpdateResponse,
+    tags=["users"],
+    summary="Обновить пользователей пачкой",
+    description=f"""
+Частично обновляет много пользователей одним запросом (до {config.BULK_MAX_ITEMS} за раз).
+
+**Тело:** JSON-массив объектов `UserBulkUpdate` (`id` + поля для изменения) или NDJSON
+(`Content-Type: application/x-ndjson`).
+
+**Правила:**
+- Уникальность `email` проверяется по итоговому состоянию всей пачки:
+  например, два пользователя могут обменяться email в одном запросе.
+- `atomic=true` (по умолчанию) — всё или ничего: при любой ошибке ничего не меняется,
+  в ответе (`400`/`422`) перечислены ошибочные элементы.
+- `atomic=false` — применяется всё, что можно; результат по каждому элементу в `results`.
+""",
+    responses={
+        400: {"model": BulkUpdateResponse, "description": "Атомарная пачка отклонена: email занят, ID не найден или повторяется"},
+        413: {"model": ErrorResponse, "description": "Слишком большая пачка"},
+        422: {"model": BulkUpdateResponse, "description": "Атомарная пачка отклонена: ошибки валидации"},
+    },
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {"type": "array", "items": {"$ref": "#/components/schemas/UserBulkUpdate"}},
+                    "example": [
+                        {"id": 1, "email": "anna@example.com"},
+                        {"id": 2, "email": "ivan.petrov@example.com"},
+                        {"id": 3, "name": "Пётр Сидоров"},
+                    ],
+                },
+                NDJSON_MEDIA_TYPE: {
+                    "schema": {"type": "string"},
+                    "example": '{"id":1,"name":"Иван Петров"}\n{"id":2,"email":"anna@example.com"}\n',
+                },
+            },
+        }
+    },
+)
+async def update_users_bulk(
+    request: Request,
+    response: Response,
+    atomic: bool = Query(True, description="Всё или ничего (`true`) или по возможности (`false`)."),
+):
+    """Пакетное обновление пользователей."""
+    body = await request.body()
+    content_type = request.headers.get("content-type", "application/json")
+    return await run_in_threadpool(bulk_update, body, content_type, atomic, response)
+
+
+@router.delete(
+    "/users/bulk",
+    response_model=BulkDeleteResponse,
+    tags=["users"],
+    summary="Удалить пользователей пачкой",
+    description=f"""
+Удаляет пользователей по списку ID одним запросом (до {config.BULK_MAX_ITEMS} ID).
+
+- `deleted` — ID удалённых пользователей, `missing` — ID, которых не было.
+- Все удаления выполняются под одной блокировкой, индексы обновляются один раз.
+""",
+    responses={
+        200: {
+            "description": "Пользователи удалены",
+            "content": {"application/json": {"example": {"deleted": [1, 2], "missing": [3]}}},
+        },
+        422: {"description": "Ошибка валидации входных данных (в том числе ID < 1 или слишком много ID)"},
+    },
+)
+@offload()
+def delete_users_bulk(
+    payload: UserIdsRequest = Body(
+        ...,
+        description="Список ID для удаления.",
+        examples={"basic": {"summary": "Три пользователя", "value": {"ids": [1, 2, 3]}}},
+    )
+):
+    """Пакетное удаление пользователей."""
+    # Размер списка и ID проверены схемой (`UserIdsRequest`) до вызова.
+    user_ids = list(dict.fromkeys(payload.ids))
+    deleted = get_storage().delete_many(user_ids)
+    events.feed.notify()
+    deleted_set = set(deleted)
+    return BulkDeleteResponse(deleted=deleted, missing=[i for i in user_ids if i not in deleted_set])
+
+
 @router.get(
     "/users",
     response_model=List[User],
     tags=["users"],
     summary="Получить список пользователей",
     description="""
-Возвращает список всех пользователей.
+Возвращает список пользователей. По умолчанию — в порядке возрастания `id`
+(порядок добавления).
 
-- Порядок соответствует порядку добавления (для текущего in-memory хранения).
+**Сортировка:** `?sort=name`, `?sort=email`, `?sort=id`; с `-` — по убыванию
+(`?sort=-name`). При равных значениях порядок — по `id`. Имена сравниваются
+посимвольно, email — без учёта регистра. Страница читается из упорядоченного
+индекса, поэтому её стоимость не зависит от номера страницы. Сортировку
+нельзя сочетать с `domain`.
+
+**Пагинация (keyset):**
+- Без `limit` возвращаются все пользователи.
+- С `limit` возвращается не больше `limit` пользователей. Если есть ещё,
+  в заголовке `X-Next-Cursor` придёт курсор следующей страницы —
+  его нужно передать в `after`.
+- Стоимость страницы не зависит от её номера.
+
+**Фильтр по домену:** `?domain=example.com` вернёт только пользователей
+с email в этом домене (без учёта регистра). Фильтр идёт по индексу доменов
+и совместим с пагинацией.
+
+**Поля:** `?fields=id,name` вернёт только перечисленные поля — меньше данных
+для списков на мобильных экранах.
+
+**Условные запросы:** ответ содержит `ETag`; с `If-None-Match` вернётся `304`,
+если хранилище не менялось.
+
+**Синхронизация:** заголовок `X-Change-Seq` первой страницы — значение `since`
+для `GET /users/changes`: изменения, сделанные во время обхода страниц,
+придут оттуда.
 """,
     responses={
         200: {
             "description": "Список пользователей",
+            "headers": {
+                NEXT_CURSOR_HEADER: {
+                    "description": "Курсор следующей страницы (нет на последней странице).",
+                    "schema": {"type": "string"},
+                },
+                CHANGE_SEQ_HEADER: {
+                    "description": "Номер последнего изменения хранилища до чтения страницы.",
+                    "schema": {"type": "integer"},
+                },
+                **ETAG_HEADER_DOC,
+            },
             "content": {
                 "application/json": {
-                    "example": [
-                        {"id": 1, "name": "Иван Петров", "email": "ivan.petrov@example.com"},
-                        {"id": 2, "name": "Анна Иванова", "email": "anna@example.com"},
-                    ]
+                    "example": USER_EXAMPLES
+                }
+            },
+        },
+        400: {
+            "model": ErrorResponse,
+            "description": "Некорректный курсор, неизвестное поле в `fields` или `sort` вместе с `domain`",
+            "content": {"application/json": {"example": {"detail": "Invalid cursor"}}},
+        },
+        304: NOT_MODIFIED_RESPONSE,
+    },
+)
+@offload(when=lambda limit, **params: limit is None)
+def list_users(
+    limit: Optional[int] = Query(
+        None,
+        ge=1,
+        le=1000,
+        description="Размер страницы. Без параметра — весь список.",
+        examples=[50],
+    ),
+    after: Optional[str] = Query(
+        None,
+        description="Курсор из заголовка `X-Next-Cursor` предыдущей страницы.",
+    ),
+    domain: Optional[str] = Query(
+        None,
+        min_length=1,
+        description="Только пользователи с email в этом домене.",
+        examples=["example.com"],
+    ),
+    sort: str = Query(
+        "id",
+        pattern=SORT_PATTERN,
+        description="Поле сортировки (`id`, `name`, `email`); `-` перед полем — по убыванию.",
+        examples=["name", "-name"],
+    ),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION, examples=["id,name"]),
+    if_none_match: Optional[str] = Header(None, description=IF_NONE_MATCH_DESCRIPTION),
+):
+    """Список пользователей (с keyset-пагинацией и сортировкой)."""
+    storage = get_storage()
+    if domain is not None and sort != "id":
+        raise HTTPException(status_code=400, detail="Sorting is not supported with domain filter")
+    field = sort.lstrip("-")
+    if sort == "id":
+        after_id = decode_cursor(after, id=int)[0] if after is not None else None
+    else:
+        position = decode_sort_cursor(after, sort) if after is not None else None
+    encode = user_encoder(storage, parse_fields(fields))
+    # Версию берём до данных (см. UserStorage.user_version).
+    version = storage.version()
+    etag = make_etag(version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    headers = {"ETag": etag, CHANGE_SEQ_HEADER: str(version)}
+    # Лишний элемент показывает, есть ли следующая страница.
+    fetch = limit + 1 if limit is not None else None
+    if sort == "id":
+        page = storage.page(after_id, fetch, domain)
+    else:
+        page = storage.page_by(field, sort.startswith("-"), position, fetch)
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        last = page[-1]
+        if sort == "id":
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(id=last.id)
+        else:
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(sort=sort, key=SORT_KEYS[field](last), id=last.id)
+    return users_response(encode, page, headers)
+
+
+@router.head(
+    "/users",
+    tags=["users"],
+    summary="Количество пользователей и версия списка",
+    description="""
+Ответ без тела: число пользователей в заголовке `X-Total-Count` и `ETag`
+списка. Счётчик ведётся хранилищем, список не читается.
+
+С `If-None-Match` вернётся `304`, если хранилище не менялось.
+""",
+    responses={
+        200: {
+            "description": "Заголовки списка",
+            "headers": {
+                TOTAL_COUNT_HEADER: {"description": "Количество пользователей.", "schema": {"type": "integer"}},
+                **ETAG_HEADER_DOC,
+            },
+        },
+        304: NOT_MODIFIED_RESPONSE,
+    },
+)
+def head_users(if_none_match: Optional[str] = Header(None, description=IF_NONE_MATCH_DESCRIPTION)):
+    """Количество пользователей в заголовке (HEAD)."""
+    storage = get_storage()
+    etag = make_etag(storage.version())
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    return Response(headers={"ETag": etag, TOTAL_COUNT_HEADER: str(storage.count())})
+
+
+def iter_ndjson(storage: UserStorage, users: Iterator[User]) -> Iterator[bytes]:
+    """Пользователи построчно в NDJSON, чанками по `EXPORT_CHUNK_SIZE`."""
+    while True:
+        chunk = b"".join(storage.encode(u) + b"\n" for u in islice(users, EXPORT_CHUNK_SIZE))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ExportResponse(StreamingResponse):
+    """NDJSON-выгрузка, которая закрывает генератор снимка в конце ответа.
+
+    Клиент может отключиться посреди выгрузки, и тогда генератор ответа
+    не дочитывается до конца. Снимок SQLite держит соединение и читающую
+    транзакцию, поэтому он закрывается сразу, а не сборщиком мусора.
+    """
+
+    def __init__(self, storage: UserStorage, users: Generator[User, None, None]):
+        super().__init__(iter_ndjson(storage, users), media_type=NDJSON_MEDIA_TYPE)
+        self.users = users
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Закрытие — откат читающей транзакции, без ожидания диска;
+            # вызываем прямо здесь, чтобы отмена задачи его не пропустила.
+            self.users.close()
+
+
+@router.get(
+    "/users/export",
+    response_class=StreamingResponse,
+    tags=["users"],
+    summary="Выгрузить всех пользователей (NDJSON)",
+    description="""
+Потоково отдаёт всех пользователей в формате NDJSON — по одному JSON-объекту на строку.
+
+- Данные берутся из согласованного снимка хранилища на момент запроса;
+  запись в это время не блокируется.
+- Ответ не собирается в памяти целиком, поэтому подходит для полных выгрузок.
+""",
+    responses={
+        200: {
+            "description": "Пользователи, по одному на строку",
+            "content": {
+                NDJSON_MEDIA_TYPE: {
+                    "example": (
+                        '{"id":1,"name":"Иван Петров","email":"ivan.petrov@example.com",'
+                        '"created_at":"2024-05-01T12:00:00Z","updated_at":"2024-05-01T12:00:00Z","seq":1}\n'
+                        '{"id":2,"name":"Анна Иванова","email":"anna@example.com",'
+                        '"created_at":"2024-05-01T12:00:00Z","updated_at":"2024-05-01T12:00:00Z","seq":2}\n'
+                    )
                 }
             },
         }
     },
 )
-def list_users():
-    """Список пользователей."""
-    return list(users.values())
+def export_users():
+    """Потоковая выгрузка пользователей."""
+    storage = get_storage()
+    return ExportResponse(storage, storage.export())
+
+
+@router.head("/users/export", include_in_schema=False)
+def head_export_users():
+    """Заголовки выгрузки (HEAD): снимок хранилища не читается."""
+    return Response(media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.post(
+    "/users/batch-get",
+    response_model=BatchGetResponse,
+    tags=["users"],
+    summary="Получить нескольких пользователей по ID",
+    description=f"""
+Возвращает пользователей по списку ID за один запрос (до {config.BULK_MAX_ITEMS} ID).
+
+- `users` — найденные пользователи в порядке запроса (повторы ID игнорируются).
+- `missing` — ID, для которых пользователь не найден.
+""",
+    responses={
+        200: {
+            "description": "Найденные пользователи и отсутствующие ID",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "users": USER_EXAMPLES,
+                        "missing": [3],
+                    }
+                }
+            },
+        },
+        422: {"description": "Ошибка валидации входных данных (в том числе ID < 1 или слишком много ID)"},
+    },
+)
+@offload()
+def batch_get_users(
+    payload: UserIdsRequest = Body(
+        ...,
+        description="Список ID.",
+        examples={"basic": {"summary": "Три пользователя", "value": {"ids": [1, 2, 3]}}},
+    )
+):
+    """Пакетное получение пользователей."""
+    user_ids = list(dict.fromkeys(payload.ids))
+
+    storage = get_storage()
+    found = storage.get_many(user_ids)
+    users = [found[user_id] for user_id in user_ids if user_id in found]
+    missing = [user_id for user_id in user_ids if user_id not in found]
+    if media.response_codec() is not media.JSON:
+        return BatchGetResponse(users=users, missing=missing)
+    body = b'{"users":' + json_array(storage.encode, users) + b',"missing":' + json.dumps(missing).encode() + b"}"
+    return Response(body, media_type="application/json")
+
+
+@router.head("/users/search", include_in_schema=False)
+@router.get(
+    "/users/search",
+    response_model=List[User],
+    tags=["users"],
+    summary="Найти пользователей по имени или email",
+    description=f"""
+Ищет пользователей по строке `q` без учёта регистра:
+
+- по **префиксу email** (`ivan` найдёт `ivan.petrov@example.com`);
+- по **подстроке имени** — от {search.MIN_NAME_QUERY} символов (`етр` найдёт «Иван Петров»).
+
+**Порядок выдачи:** сначала точное совпадение email, затем email с префиксом
+`q`, имя, начинающееся с `q`, имя со словом, начинающимся с `q`, и остальные
+совпадения по имени; внутри группы — по возрастанию `id`.
+
+Поиск идёт по индексам (триграммы имён, упорядоченный индекс email), а не
+перебором всех пользователей.
+
+**Пагинация:** как у `GET /users` — курсор следующей страницы приходит
+в заголовке `X-Next-Cursor` и передаётся в `after`.
+""",
+    responses={
+        200: {
+            "description": "Найденные пользователи",
+            "headers": {
+                NEXT_CURSOR_HEADER: {
+                    "description": "Курсор следующей страницы (нет на последней странице).",
+                    "schema": {"type": "string"},
+                },
+            },
+            "content": {
+                "application/json": {
+                    "example": USER_EXAMPLES[:1]
+                }
+            },
+        },
+        400: {
+            "model": ErrorResponse,
+            "description": "Некорректный курсор или неизвестное поле в `fields`",
+            "content": {"application/json": {"example": {"detail": "Invalid cursor"}}},
+        },
+        422: {"description": "Пустой или слишком длинный запрос"},
+    },
+)
+def search_users(
+    q: str = Query(..., min_length=1, max_length=100, description="Строка поиска.", examples=["иван"]),
+    limit: int = Query(20, ge=1, le=100, description="Размер страницы."),
+    after: Optional[str] = Query(
+        None,
+        description="Курсор из заголовка `X-Next-Cursor` предыдущей страницы.",
+    ),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION, examples=["id,name"]),
+):
+    """Поиск пользователей по имени и email."""
+    storage = get_storage()
+    position = decode_cursor(after, rank=int, id=int) if after is not None else None
+    encode = user_encoder(storage, parse_fields(fields))
+
+    found = storage.search(q, position, limit + 1)
+    headers = {}
+    if len(found) > limit:
+        found = found[:limit]
+        rank, user = found[-1]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(rank=rank, id=user.id)
+    return users_response(encode, [user for _, user in found], headers)
+
+
+@router.head("/users/stats/domains", include_in_schema=False)
+@router.get(
+    "/users/stats/domains",
+    response_model=List[DomainCount],
+    tags=["users"],
+    summary="Распределение пользователей по доменам email",
+    description="""
+Возвращает домены email и число пользователей в каждом, от самых частых
+(при равенстве — по алфавиту). С `limit` — только первые `limit` доменов.
+
+Счётчики ведутся при создании, изменении и удалении пользователей, поэтому
+ответ не требует перебора всех пользователей.
+""",
+    responses={
+        200: {
+            "description": "Гистограмма доменов",
+            "content": {
+                "application/json": {
+                    "example": [{"domain": "example.com", "users": 42}, {"domain": "mail.ru", "users": 7}]
+                }
+            },
+        },
+    },
+)
+def domain_stats(
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Сколько самых частых доменов вернуть."),
+):
+    """Гистограмма доменов email."""
+    return [DomainCount(domain=domain, users=users) for domain, users in get_storage().domain_stats(limit)]
+
+
+@router.head("/users/count", include_in_schema=False)
+@router.get(
+    "/users/count",
+    response_model=UserCount,
+    tags=["users"],
+    summary="Количество пользователей",
+    description="""
+Возвращает число пользователей. Счётчик ведётся хранилищем, поэтому
+ответ не зависит от размера списка.
+""",
+    responses={
+        200: {"description": "Количество пользователей", "content": {"application/json": {"example": {"count": 42}}}},
+    },
+)
+def count_users():
+    """Количество пользователей."""
+    return UserCount(count=get_storage().count())
+
+
+@router.head("/users/changes", include_in_schema=False)
+@router.get(
+    "/users/changes",
+    response_model=ChangesResponse,
+    tags=["users"],
+    summary="Изменения после заданной точки (дельта-синхронизация)",
+    description=f"""
+Возвращает пользователей, созданных, изменённых и удалённых после изменения
+с номером `since`, — чтобы клиент с локальной копией не скачивал весь список.
+
+**Как синхронизироваться:**
+1. Полная загрузка: `GET /users`; заголовок `X-Change-Seq` первой страницы —
+   начальное значение `since`.
+2. Дальше `GET /users/changes?since=...`: применить `changes` (`create` и
+   `update` — записать `user`, `delete` — удалить пользователя `id`) и
+   сохранить `next_since`. Пока `has_more`, запросить следующую страницу.
+
+В странице у каждого пользователя одно изменение — последнее, с текущими
+данными; созданный и тут же удалённый пользователь в неё не попадает.
+
+Хранятся только {config.CHANGELOG_SIZE} последних изменений. Если `since`
+старше, вернётся `410`: нужна полная загрузка заново.
+""",
+    responses={
+        200: {
+            "description": "Изменения после `since`",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "changes": [
+                            {"seq": 3, "op": "update", "id": 1, "user": {**USER_EXAMPLES[0], "seq": 3}},
+                            {"seq": 4, "op": "delete", "id": 2, "user": None},
+                        ],
+                        "next_since": 4,
+                        "has_more": False,
+                    }
+                }
+            },
+        },
+        410: {
+            "model": ErrorResponse,
+            "description": "Изменения после `since` уже не хранятся — нужна полная синхронизация",
+            "content": {"application/json": {"example": {"detail": "Changes since this point are no longer available"}}},
+        },
+    },
+)
+@offload()
+def list_changes(
+    since: int = Query(
+        ...,
+        ge=0,
+        description="`next_since` прошлого ответа или `X-Change-Seq` полной загрузки.",
+        examples=[2],
+    ),
+    limit: int = Query(
+        CHANGES_PAGE_SIZE,
+        ge=1,
+        le=CHANGES_MAX_PAGE_SIZE,
+        description="Сколько записей журнала изменений разобрать за запрос.",
+    ),
+):
+    """Изменения пользователей после `since`."""
+    storage = get_storage()
+    try:
+        records = storage.changes(since, limit)
+    except ChangesExpiredError:
+        raise HTTPException(status_code=410, detail="Changes since this point are no longer available")
+
+    collapsed = collapse_changes(records)
+    changes = resolve_changes(collapsed, storage.get_many(changed_ids(collapsed)))
+    return ChangesResponse(
+        changes=[ChangeEntry(seq=seq, op=op, id=user_id, user=user) for seq, op, user_id, user in changes],
+        next_since=records[-1][0] if records else since,
+        has_more=len(records) == limit,
+    )
+
+
+@router.get(
+    "/users/stream",
+    response_class=StreamingResponse,
+    tags=["users"],
+    summary="Поток изменений пользователей (Server-Sent Events)",
+    description=f"""
+Держит соединение открытым и присылает события при создании, изменении
+и удалении пользователей — вместо периодического опроса `GET /users`.
+
+**Формат** (`text/event-stream`, подходит для `EventSource`):
+- `event: create` / `event: update` — в `data` пользователь целиком;
+- `event: delete` — в `data` объект `{{"id": ...}}`;
+- `id` события — номер изменения, как `seq` в `GET /users/changes`;
+- `event: reset` — пропущенные изменения уже не хранятся: нужно заново
+  загрузить список;
+- комментарий `: ping` раз в {config.STREAM_HEARTBEAT_SECONDS:g} с, если изменений нет.
+
+**Переподключение:** `EventSource` сам присылает `Last-Event-ID`, и поток
+начинается с изменений после этого события. Начальную точку можно взять из
+`X-Change-Seq` ответа `GET /users`.
+
+Если клиент не успевает читать (в очереди больше {config.STREAM_QUEUE_SIZE} событий),
+сервер закрывает поток; после переподключения клиент дочитает пропущенное.
+""",
+    responses={
+        200: {
+            "description": "Поток событий",
+            "content": {
+                "text/event-stream": {
+                    "example": (
+                        "id: 3\nevent: update\n"
+                        'data: {"id":1,"name":"Иван Петров","email":"new.email@example.com",'
+                        '"created_at":"2024-05-01T12:00:00Z","updated_at":"2024-05-01T12:05:00Z","seq":3}\n\n'
+                        'id: 4\nevent: delete\ndata: {"id":2}\n\n'
+                    )
+                }
+            },
+        },
+    },
+)
+async def stream_users(
+    last_event_id: Optional[int] = Header(
+        None,
+        ge=0,
+        description="`id` последнего полученного события (присылает `EventSource` при переподключении).",
+    ),
+):
+    """Поток изменений пользователей (SSE)."""
+    return StreamingResponse(
+        events.stream(events.feed, last_event_id),
+        media_type="text/event-stream",
+        # Без буферизации в прокси (nginx) события доходят сразу.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.head("/users/stream", include_in_schema=False)
+def head_stream_users():
+    """Заголовки потока (HEAD): подписки на изменения нет."""
+    return Response(media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
 @router.get(
@@ -97,21 +1053,33 @@ def list_users():
 Возвращает одного пользователя по `user_id`.
 
 Если пользователь не найден — вернётся `404`.
+
+**Поля:** `?fields=id,name` вернёт только перечисленные поля.
+
+**Условные запросы:** ответ содержит `ETag`; с `If-None-Match` вернётся `304`,
+если пользователь не менялся.
 """,
     responses={
         200: {
             "description": "Пользователь найден",
+            "headers": ETAG_HEADER_DOC,
             "content": {
                 "application/json": {
-                    "example": {"id": 1, "name": "Иван Петров", "email": "ivan.petrov@example.com"}
+                    "example": USER_EXAMPLES[0]
                 }
             },
         },
+        400: {
+            "model": ErrorResponse,
+            "description": "Неизвестное поле в `fields`",
+            "content": {"application/json": {"example": {"detail": "Unknown fields: password"}}},
+        },
         404: {
             "model": ErrorResponse,
             "description": "Пользователь не найден",
             "content": {"application/json": {"example": {"detail": "User not found"}}},
         },
+        304: NOT_MODIFIED_RESPONSE,
     },
 )
 def get_user(
@@ -120,13 +1088,64 @@ def get_user(
         ge=1,
         description="ID пользователя (целое число >= 1).",
         examples=[1],
-    )
+    ),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION, examples=["id,name"]),
+    if_none_match: Optional[str] = Header(None, description=IF_NONE_MATCH_DESCRIPTION),
 ):
     """Получить пользователя по ID."""
-    user = users.get(user_id)
+    storage = get_storage()
+    encode = user_encoder(storage, parse_fields(fields))
+    version = storage.user_version(user_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    etag = make_etag(version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    user = storage.get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    return Response(encode(user), media_type=media.response_codec().media_type, headers={"ETag": etag})
+
+
+@router.head(
+    "/users/{user_id}",
+    tags=["users"],
+    summary="Проверить существование пользователя",
+    description="""
+Ответ без тела: `200` с `ETag`, если пользователь есть, иначе `404`.
+Данные пользователя не читаются и не сериализуются.
+
+С `If-None-Match` вернётся `304`, если пользователь не менялся.
+""",
+    responses={
+        200: {"description": "Пользователь существует", "headers": ETAG_HEADER_DOC},
+        404: {"description": "Пользователь не найден (тело пустое)"},
+        304: NOT_MODIFIED_RESPONSE,
+    },
+)
+def head_user(
+    user_id: int = Path(
+        ...,
+        ge=1,
+        description="ID пользователя (целое число >= 1).",
+        examples=[1],
+    ),
+    if_none_match: Optional[str] = Header(None, description=IF_NONE_MATCH_DESCRIPTION),
+):
+    """Проверить существование пользователя (HEAD).
+
+    Маршрут ловит HEAD любого `/users/<сегмент>`: FastAPI не отвечает на
+    HEAD маршрутами GET, поэтому у остальных путей `/users/...` свои
+    HEAD-маршруты, объявленные выше этого.
+    """
+    version = get_storage().user_version(user_id)
+    if version is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
+    etag = make_etag(version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    return Response(headers={"ETag": etag})
 
 
 @router.put(
@@ -147,7 +1166,7 @@ def get_user(
             "description": "Пользователь обновлён",
             "content": {
                 "application/json": {
-                    "example": {"id": 1, "name": "Иван Петров", "email": "new.email@example.com"}
+                    "example": {**USER_EXAMPLES[0], "email": "new.email@example.com", "seq": 3}
                 }
             },
         },
@@ -164,6 +1183,7 @@ def get_user(
         422: {"description": "Ошибка валидации входных данных"},
     },
 )
+@offload()
 def update_user(
     user_id: int = Path(..., ge=1, description="ID пользователя для обновления.", examples=[1]),
     payload: UserUpdate = Body(
@@ -179,19 +1199,14 @@ def update_user(
         },
     ),
 ):
-    """Обновить пользователя (in-memory)."""
-    user = users.get(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    new_name = payload.name if payload.name is not None else user.name
-    new_email = payload.email if payload.email is not None else user.email
-
-    if new_email != user.email and any(u.email == new_email for u in users.values()):
+    """Обновить пользователя."""
+    try:
+        updated = get_storage().update(user_id, payload)
+    except EmailAlreadyExistsError:
         raise HTTPException(status_code=400, detail="Email already exists")
-
-    updated = User(id=user_id, name=new_name, email=new_email)
-    users[user_id] = updated
+    if updated is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    events.feed.notify()
     return updated
 
 
@@ -215,11 +1230,12 @@ def update_user(
         },
     },
 )
+@offload()
 def delete_user(
     user_id: int = Path(..., ge=1, description="ID пользователя для удаления.", examples=[1])
 ):
-    """Удалить пользователя (in-memory)."""
-    if user_id not in users:
+    """Удалить пользователя."""
+    if not get_storage().delete(user_id):
         raise HTTPException(status_code=404, detail="User not found")
-    del users[user_id]
+    events.feed.notify()
     return None
\ No newline at end of file
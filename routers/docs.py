@@ -0,0 +1,124 @@
+"""Схема OpenAPI и страницы документации из готовых байтов.
+
+FastAPI кеширует схему как dict, но на каждый запрос `/openapi.json`
+заново кодирует её в JSON, а HTML `/docs` и `/redoc` собирает из шаблона.
+Здесь все четыре документа (схема, Swagger UI, его OAuth2-redirect и ReDoc)
+собираются один раз — при старте приложения (`build`) или на первом
+запросе — вместе со сжатыми вариантами (gzip, brotli с максимальным
+уровнем). Запрос стоит выбора варианта по `Accept-Encoding` и сравнения
+ETag; `CompressionMiddleware` такие ответы уже не трогает.
+
+ETag — хеш содержимого, свой у каждого сжатого варианта. Схема меняется
+только с новой версией кода, поэтому ответы кешируются клиентами на
+`config.DOCS_CACHE_MAX_AGE` секунд, а после — проверяются по ETag.
+
+За прокси с префиксом пути (`--root-path`) или при монтировании в другое
+приложение документы зависят от `root_path`: схема получает его в
+`servers`, а страницы — в ссылках на схему и OAuth2-redirect (как у
+FastAPI). Поэтому набор документов собирается и кешируется на каждый
+`root_path`; его задаёт сервер, так что вариантов единицы.
+"""
+
+import hashlib
+from typing import Dict, Optional
+
+from fastapi import APIRouter, FastAPI, Request, Response
+from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html, get_swagger_ui_oauth2_redirect_html
+
+import compression
+import config
+from responses import dumps
+from routers.api import etag_matches
+
+router = APIRouter(include_in_schema=False)
+
+OPENAPI_URL = "/openapi.json"
+DOCS_URL = "/docs"
+OAUTH2_REDIRECT_URL = "/docs/oauth2-redirect"
+REDOC_URL = "/redoc"
+
+
+class CachedDocument:
+    """Тело ответа, закодированное и сжатое заранее, с ETag на каждый вариант."""
+
+    def __init__(self, body: bytes, media_type: str):
+        self.media_type = media_type
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        self.bodies: Dict[Optional[str], bytes] = {None: body}
+        self.etags: Dict[Optional[str], str] = {None: f'"{digest}"'}
+        for encoding in compression.ENCODINGS:
+            compressed = compression.compress(body, encoding)
+            if len(compressed) < len(body):
+                self.bodies[encoding] = compressed
+                self.etags[encoding] = f'"{digest}-{encoding}"'
+
+    def response(self, request: Request) -> Response:
+        accepted = compression.accepted_encodings(request.headers.get("accept-encoding"))
+        encoding = next((e for e in accepted if e in self.bodies), None)
+        etag = self.etags[encoding]
+        headers = {
+            "ETag": etag,
+            "Cache-Control": f"public, max-age={config.DOCS_CACHE_MAX_AGE}",
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        return Response(self.bodies[encoding], media_type=self.media_type, headers=headers)
+
+
+# root_path -> документы по URL; пусто, пока не вызван `build`.
+documents: Dict[str, Dict[str, CachedDocument]] = {}
+
+
+def build(app: FastAPI, root_path: str = "") -> Dict[str, CachedDocument]:
+    """Собрать схему и страницы документации приложения для `root_path`."""
+    schema = app.openapi()
+    if root_path and app.root_path_in_servers:
+        servers = schema.get("servers", [])
+        if root_path not in {server.get("url") for server in servers}:
+            schema = {**schema, "servers": [{"url": root_path}] + servers}
+    swagger = get_swagger_ui_html(
+        openapi_url=root_path + OPENAPI_URL,
+        title=f"{app.title} - Swagger UI",
+        oauth2_redirect_url=root_path + OAUTH2_REDIRECT_URL,
+    )
+    redoc = get_redoc_html(openapi_url=root_path + OPENAPI_URL, title=f"{app.title} - ReDoc")
+    documents[root_path] = {
+        OPENAPI_URL: CachedDocument(dumps(schema), "application/json"),
+        DOCS_URL: CachedDocument(swagger.body, "text/html; charset=utf-8"),
+        OAUTH2_REDIRECT_URL: CachedDocument(get_swagger_ui_oauth2_redirect_html().body, "text/html; charset=utf-8"),
+        REDOC_URL: CachedDocument(redoc.body, "text/html; charset=utf-8"),
+    }
+    return documents[root_path]
+
+
+def serve(request: Request, url: str) -> Response:
+    root_path = request.scope.get("root_path", "").rstrip("/")
+    cached = documents.get(root_path)
+    if cached is None:
+        # Первый запрос с этим root_path или приложение запущено без
+        # lifespan (например, в тестах).
+        cached = build(request.app, root_path)
+    return cached[url].response(request)
+
+
+@router.get(OPENAPI_URL)
+async def openapi(request: Request):
+    return serve(request, OPENAPI_URL)
+
+
+@router.get(DOCS_URL)
+async def swagger_ui(request: Request):
+    return serve(request, DOCS_URL)
+
+
+@router.get(OAUTH2_REDIRECT_URL)
+async def swagger_ui_redirect(request: Request):
+    return serve(request, OAUTH2_REDIRECT_URL)
+
+
+@router.get(REDOC_URL)
+async def redoc(request: Request):
+    return serve(request, REDOC_URL)
@@ -0,0 +1,170 @@
+"""WebSocket-канал CRUD-операций над пользователями (`/ws/users`).
+
+Одно соединение вместо отдельного HTTP-запроса с заголовками на каждую
+операцию. Сообщения — текстовые JSON-кадры:
+
+    → {"id": 7, "op": "update", "user_id": 1, "user": {"name": "Иван"}}
+    ← {"id": 7, "status": 200, "user": {...}}
+
+Операции: `create` (`user`), `get` (`user_id`), `update` (`user_id`,
+`user`), `delete` (`user_id`), `list` (`limit`, `after`; в ответе `users`
+и `next` — значение `after` следующей страницы или `null`). Коды `status`
+и тексты `detail` — как у REST-эндпоинтов (`routers/api.py`), валидация
+та же (`UserCreate`, `UserUpdate`), запись так же попадает в ленту
+`/users/stream`.
+
+Запросы можно отправлять, не дожидаясь ответов: ответ находят по `id`.
+На бинарный кадр приходит ответ `400` с `"id": null`.
+
+Uvicorn обслуживает WebSocket, если установлен пакет `websockets`
+(или `wsproto`), например через `uvicorn[standard]`.
+"""
+
+import json
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+
+import events
+from crud import AsyncUserStorage, EmailAlreadyExistsError, UserStorage, get_async_storage
+from responses import dumps
+from routers.api import json_array, validation_detail
+from schemas import WS_ID_MAX, WS_ID_MIN, UserCreate, UserUpdate, WsRequest
+
+router = APIRouter()
+
+# Ответ операции: (status, тело без `id` и `status` — готовые JSON-байты полей).
+Result = Tuple[int, bytes]
+
+
+class RequestError(Exception):
+    """Запрос не выполнен: статус и `detail` для ответа."""
+
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+def reply(request_id: Any, status: int, fields: bytes = b"") -> str:
+    """Кадр ответа: `id` запроса, `status` и поля операции."""
+    head = b'{"id":%s,"status":%d' % (dumps(request_id), status)
+    return (head + (b"," + fields if fields else b"") + b"}").decode()
+
+
+def error_fields(detail: str) -> bytes:
+    return b'"detail":' + dumps(detail)
+
+
+def require_user_id(request: WsRequest) -> int:
+    if request.user_id is None:
+        raise RequestError(422, "user_id: Field required")
+    return request.user_id
+
+
+async def create(storage: AsyncUserStorage, request: WsRequest) -> Result:
+    payload = UserCreate.model_validate(request.user or {})
+    try:
+        user = await storage.create(payload)
+    except EmailAlreadyExistsError:
+        raise RequestError(400, "Email already exists")
+    events.feed.notify()
+    return 201, b'"user":' + storage.storage.encode(user)
+
+
+async def get(storage: AsyncUserStorage, request: WsRequest) -> Result:
+    user = await storage.get(require_user_id(request))
+    if user is None:
+        raise RequestError(404, "User not found")
+    return 200, b'"user":' + storage.storage.encode(user)
+
+
+async def update(storage: AsyncUserStorage, request: WsRequest) -> Result:
+    user_id = require_user_id(request)
+    payload = UserUpdate.model_validate(request.user or {})
+    try:
+        user = await storage.update(user_id, payload)
+    except EmailAlreadyExistsError:
+        raise RequestError(400, "Email already exists")
+    if user is None:
+        raise RequestError(404, "User not found")
+    events.feed.notify()
+    return 200, b'"user":' + storage.storage.encode(user)
+
+
+async def delete(storage: AsyncUserStorage, request: WsRequest) -> Result:
+    if not await storage.delete(require_user_id(request)):
+        raise RequestError(404, "User not found")
+    events.feed.notify()
+    return 204, b""
+
+
+def full_list(storage: UserStorage, after: Optional[int]) -> bytes:
+    return json_array(storage.encode, storage.page(after, None))
+
+
+async def list_page(storage: AsyncUserStorage, request: WsRequest) -> Result:
+    limit = request.limit
+    if limit is None:
+        # Вся таблица — как `GET /users` без `limit`, не в event loop.
+        users = await run_in_threadpool(full_list, storage.storage, request.after)
+        return 200, b'"users":' + users + b',"next":null'
+    # Лишний элемент показывает, есть ли следующая страница.
+    page = await storage.page(request.after, limit + 1 if limit is not None else None)
+    next_after = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_after = page[-1].id
+    return 200, b'"users":' + json_array(storage.storage.encode, page) + b',"next":' + dumps(next_after)
+
+
+OPERATIONS: Dict[str, Callable[[AsyncUserStorage, WsRequest], Awaitable[Result]]] = {
+    "create": create,
+    "get": get,
+    "update": update,
+    "delete": delete,
+    "list": list_page,
+}
+
+
+async def handle(text: str) -> str:
+    """Выполнить один запрос и вернуть кадр ответа."""
+    try:
+        message = json.loads(text)
+    except ValueError:
+        return reply(None, 400, error_fields("Invalid JSON"))
+    request_id = message.get("id") if isinstance(message, dict) else None
+    if not isinstance(request_id, (int, str)) or isinstance(request_id, bool):
+        request_id = None
+    elif isinstance(request_id, int) and not WS_ID_MIN <= request_id <= WS_ID_MAX:
+        request_id = None
+    try:
+        request = WsRequest.model_validate(message)
+        status, fields = await OPERATIONS[request.op](get_async_storage(), request)
+    except ValidationError as e:
+        return reply(request_id, 422, error_fields(validation_detail(e)))
+    except RequestError as e:
+        return reply(request_id, e.status, error_fields(e.detail))
+    return reply(request_id, status, fields)
+
+
+@router.websocket("/ws/users")
+async def users_channel(websocket: WebSocket):
+    """CRUD-операции над пользователями через одно WebSocket-соединение."""
+    await websocket.accept()
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            text = message.get("text")
+            if text is None:
+                # Бинарный кадр: отвечаем ошибкой, соединение остаётся открытым.
+                frame = reply(None, 400, error_fields("Expected a text frame"))
+            else:
+                frame = await handle(text)
+            await websocket.send_text(frame)
+    except WebSocketDisconnect:
+        pass
@@ -0,0 +1,120 @@
+"""Где выполнять sync-эндпоинты: в threadpool или прямо в event loop.
+
+FastAPI запускает каждый `def`-эндпоинт в threadpool AnyIO (40 потоков).
+Для in-memory хранилища обработчик — несколько операций со словарями:
+переход в поток стоит дороже самой работы, а размер пула ограничивает
+число одновременно обрабатываемых запросов.
+
+`config.API_MODE`:
+- `sync` (по умолчанию) — каждый запрос в threadpool;
+- `async` — если хранилище не блокирует (`UserStorage.blocking`),
+  обработчик вызывается прямо в event loop; блокирующее хранилище
+  (SQLite, журнал) по-прежнему уходит в threadpool.
+
+Эндпоинты, работа которых растёт с размером запроса или хранилища
+(пакетные операции, список без `limit`), и эндпоинты, ждущие
+блокировку записи хранилища (запись, журнал изменений), помечены
+`offload` и уходят в threadpool в любом режиме: иначе один такой
+запрос останавливает event loop для всех соединений.
+
+Режим проверяется на каждом запросе, поэтому смена хранилища через
+`set_storage` учитывается сразу.
+
+Заодно маршрут выбирает формат тела ответа и разбирает бинарное тело
+запроса (см. `media`).
+"""
+
+import functools
+import inspect
+from typing import Any, Callable, Coroutine
+
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.routing import APIRoute
+
+import config
+import media
+from crud import get_storage
+
+
+API_MODES = ("sync", "async")
+
+if config.API_MODE not in API_MODES:
+    raise ValueError(f"Unknown API mode: {config.API_MODE!r}")
+
+
+def runs_inline() -> bool:
+    """Можно ли выполнить обработчик в event loop."""
+    return config.API_MODE == "async" and not get_storage().blocking
+
+
+def offload(when: Callable[..., bool] = lambda **params: True) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Выполнять sync-эндпоинт в threadpool независимо от режима.
+
+    `when` получает параметры запроса (как keyword-аргументы эндпоинта)
+    и решает, нужен ли threadpool; по умолчанию — всегда.
+    """
+
+    def mark(endpoint: Callable[..., Any]) -> Callable[..., Any]:
+        endpoint.offload = when
+        return endpoint
+
+    return mark
+
+
+def dispatching(endpoint: Callable[..., Any]) -> Callable[..., Any]:
+    """Async-обёртка над sync-эндпоинтом, выбирающая место выполнения.
+
+    Сигнатура и документация берутся из `endpoint` (через `__wrapped__`),
+    так что параметры и OpenAPI не меняются.
+    """
+    offloads = getattr(endpoint, "offload", lambda **params: False)
+
+    @functools.wraps(endpoint)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if runs_inline() and not offloads(**kwargs):
+            return endpoint(*args, **kwargs)
+        return await run_in_threadpool(endpoint, *args, **kwargs)
+
+    return wrapper
+
+
+class StorageRoute(APIRoute):
+    """Маршрут, у которого sync-эндпоинт выполняется по `config.API_MODE`.
+
+    Заодно FastAPI считает эндпоинт корутиной и валидирует ответ в event
+    loop, без второго перехода в threadpool.
+    """
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any):
+        if not (
+            inspect.iscoroutinefunction(endpoint)
+            or inspect.isgeneratorfunction(endpoint)
+            or inspect.isasyncgenfunction(endpoint)
+        ):
+            endpoint = dispatching(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        """Обработчик с выбором формата: ответ — по `Accept`, тело — по `Content-Type`.
+
+        Тело в MessagePack/CBOR разбирается только для `Body`-параметров;
+        эндпоинты, читающие тело сами (пакетные), смотрят `Content-Type` сами.
+        """
+        handler = super().get_route_handler()
+        decodes_body = self.body_field is not None
+
+        async def negotiated(request: Request) -> Response:
+            if decodes_body:
+                codec = media.body_codec(request.headers.get("content-type"))
+                if codec is not None and codec is not media.JSON:
+                    request = media.DecodedBodyRequest(request, codec)
+            token = media.use_codec(media.negotiate(request.headers.get("accept")))
+            try:
+                response = await handler(request)
+            finally:
+                media.reset_codec(token)
+            response.headers.append("Vary", "Accept")
+            return response
+
+        return negotiated
@@ -1,6 +1,9 @@
-from typing import Optional
+from datetime import datetime
+from typing import Annotated, Any, Dict, List, Literal, Optional, Union
 from pydantic import BaseModel, EmailStr, Field
 
+import config
+
 
 class UserCreate(BaseModel):
     """Модель для создания пользователя."""
@@ -50,6 +53,155 @@ class User(BaseModel):
         examples=["ivan.petrov@example.com"],
         description="Email пользователя.",
     )
+    created_at: datetime = Field(
+        ...,
+        examples=["2024-05-01T12:00:00Z"],
+        description="Когда пользователь создан (UTC).",
+    )
+    updated_at: datetime = Field(
+        ...,
+        examples=["2024-05-01T12:00:00Z"],
+        description="Когда пользователь последний раз изменён (UTC).",
+    )
+    seq: int = Field(
+        ...,
+        ge=0,
+        examples=[42],
+        description="Номер последнего изменения пользователя в хранилище (см. `GET /users/changes`).",
+    )
+
+class BulkItemResult(BaseModel):
+    """Результат обработки одного элемента пачки."""
+    index: int = Field(
+        ...,
+        ge=0,
+        examples=[0],
+        description="Позиция элемента во входной пачке (с нуля).",
+    )
+    status: int = Field(
+        ...,
+        examples=[201],
+        description=(
+            "`201` — создан, `200` — обновлён, `400` — email уже существует или ID повторяется, "
+            "`404` — пользователь не найден, `422` — ошибка валидации."
+        ),
+    )
+    user: Optional[User] = Field(
+        default=None,
+        description="Созданный или обновлённый пользователь (для `201` и `200`).",
+    )
+    detail: Optional[str] = Field(
+        default=None,
+        examples=["Email already exists"],
+        description="Причина ошибки.",
+    )
+
+class BulkCreateResponse(BaseModel):
+    """Итог пакетного создания пользователей."""
+    created: int = Field(..., ge=0, examples=[2], description="Сколько пользователей создано.")
+    failed: int = Field(..., ge=0, examples=[1], description="Сколько элементов не создано из-за ошибок.")
+    results: List[BulkItemResult] = Field(
+        ...,
+        description="Результаты по элементам. Если атомарная пачка отклонена — только ошибочные элементы.",
+    )
+
+class BulkUpdateResponse(BaseModel):
+    """Итог пакетного обновления пользователей."""
+    updated: int = Field(..., ge=0, examples=[2], description="Сколько пользователей обновлено.")
+    failed: int = Field(..., ge=0, examples=[1], description="Сколько элементов не применено из-за ошибок.")
+    results: List[BulkItemResult] = Field(
+        ...,
+        description="Результаты по элементам. Если атомарная пачка отклонена — только ошибочные элементы.",
+    )
+
+class UserBulkUpdate(UserUpdate):
+    """Элемент пакетного обновления: ID пользователя и поля для изменения."""
+    id: int = Field(
+        ...,
+        ge=1,
+        examples=[1],
+        description="ID пользователя для обновления.",
+    )
+
+class BulkDeleteResponse(BaseModel):
+    """Итог пакетного удаления пользователей."""
+    deleted: List[int] = Field(..., examples=[[1, 2]], description="ID удалённых пользователей.")
+    missing: List[int] = Field(..., examples=[[3]], description="ID, для которых пользователь не найден.")
+
+class UserIdsRequest(BaseModel):
+    """Список ID пользователей (пакетные получение и удаление)."""
+    ids: List[Annotated[int, Field(ge=1)]] = Field(
+        ...,
+        min_length=1,
+        max_length=config.BULK_MAX_ITEMS,
+        examples=[[1, 2, 3]],
+        description=f"ID пользователей (целые числа >= 1, не больше {config.BULK_MAX_ITEMS}). Повторы игнорируются.",
+    )
+
+class BatchGetResponse(BaseModel):
+    """Найденные пользователи и ID, которых нет."""
+    users: List[User] = Field(..., description="Найденные пользователи в порядке запроса.")
+    missing: List[int] = Field(..., examples=[[3]], description="ID, для которых пользователь не найден.")
+
+class UserCount(BaseModel):
+    """Количество пользователей."""
+    count: int = Field(..., ge=0, examples=[42], description="Сколько пользователей в хранилище.")
+
+class DomainCount(BaseModel):
+    """Число пользователей с email в домене."""
+    domain: str = Field(..., examples=["example.com"], description="Домен email в нижнем регистре.")
+    users: int = Field(..., ge=1, examples=[42], description="Сколько пользователей в домене.")
+
+class ChangeEntry(BaseModel):
+    """Изменение пользователя для дельта-синхронизации."""
+    seq: int = Field(..., ge=1, examples=[42], description="Номер изменения.")
+    op: Literal["create", "update", "delete"] = Field(
+        ...,
+        examples=["update"],
+        description="`create` — пользователь создан после `since`, `update` — изменён, `delete` — удалён.",
+    )
+    id: int = Field(..., ge=1, examples=[1], description="ID пользователя.")
+    user: Optional[User] = Field(
+        default=None,
+        description="Текущее состояние пользователя (для `create` и `update`).",
+    )
+
+class ChangesResponse(BaseModel):
+    """Страница изменений после `since`."""
+    changes: List[ChangeEntry] = Field(..., description="Изменения по возрастанию `seq`, по одному на пользователя.")
+    next_since: int = Field(..., examples=[42], description="Значение `since` для следующего запроса.")
+    has_more: bool = Field(..., examples=[False], description="Есть ли ещё изменения после `next_since`.")
+
+# Числовой ID запроса WebSocket — в пределах int64: ответ кодирует orjson.
+WS_ID_MIN = -(1 << 63)
+WS_ID_MAX = (1 << 63) - 1
+
+class WsRequest(BaseModel):
+    """Запрос в WebSocket-канале `/ws/users`."""
+    id: Union[Annotated[int, Field(ge=WS_ID_MIN, le=WS_ID_MAX)], str] = Field(
+        ...,
+        examples=[1],
+        description="ID запроса (строка или 64-битное целое): возвращается в ответе на него.",
+    )
+    op: Literal["create", "get", "update", "delete", "list"] = Field(..., examples=["get"], description="Операция.")
+    user_id: Optional[int] = Field(
+        default=None,
+        ge=1,
+        examples=[1],
+        description="ID пользователя (для `get`, `update`, `delete`).",
+    )
+    user: Optional[Dict[str, Any]] = Field(
+        default=None,
+        examples=[{"name": "Иван Петров", "email": "ivan.petrov@example.com"}],
+        description="Поля пользователя: как тело `POST /users` (`create`) или `PUT /users/{id}` (`update`).",
+    )
+    limit: Optional[int] = Field(default=None, ge=1, le=1000, examples=[50], description="Размер страницы (`list`).")
+    after: Optional[int] = Field(
+        default=None,
+        ge=0,
+        examples=[50],
+        description="Вернуть пользователей с ID больше этого (`list`).",
+    )
 
 class ErrorResponse(BaseModel):
     """Единый формат ошибки для документации (пример)."""
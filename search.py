@@ -0,0 +1,65 @@
+"""Поиск пользователей по имени и email: нормализация, триграммы, ранжирование.
+
+Хранилища находят кандидатов по своим индексам (триграммы имени,
+упорядоченный индекс email для поиска по префиксу), а порядок выдачи
+одинаков для всех движков и задаётся здесь.
+
+Ранг совпадения (меньше — выше в выдаче):
+0 — email совпадает с запросом;
+1 — email начинается с запроса;
+2 — имя начинается с запроса;
+3 — с запроса начинается одно из слов имени;
+4 — запрос встречается внутри имени.
+
+Подстрока имени ищется по триграммам, поэтому запрос короче
+`MIN_NAME_QUERY` символов проверяется только по префиксу email.
+"""
+
+import heapq
+from typing import Iterable, List, Optional, Set, Tuple
+
+from schemas import User
+
+
+MIN_NAME_QUERY = 3
+
+# Позиция в выдаче: (ранг, ID). Курсор страницы — позиция её последнего элемента.
+Position = Tuple[int, int]
+
+
+def normalize(text: str) -> str:
+    """Форма для сравнения: без регистра и крайних пробелов."""
+    return text.strip().lower()
+
+
+def trigrams(text: str) -> Set[str]:
+    """Триграммы нормализованной строки (пусто для строк короче трёх символов)."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def rank(user: User, query: str) -> Optional[int]:
+    """Ранг совпадения пользователя с нормализованным запросом или `None`."""
+    email = normalize(user.email)
+    if email == query:
+        return 0
+    if email.startswith(query):
+        return 1
+    if len(query) < MIN_NAME_QUERY:
+        return None
+    name = normalize(user.name)
+    if name.startswith(query):
+        return 2
+    if query not in name:
+        return None
+    return 3 if f" {query}" in name else 4
+
+
+def top(candidates: Iterable[User], query: str, after: Optional[Position], limit: int) -> List[Tuple[int, User]]:
+    """Первые `limit` совпадений после позиции `after`: пары (ранг, пользователь)."""
+    ranked = ((rank(user, query), user) for user in candidates)
+    matches = (
+        (r, user.id, user)
+        for r, user in ranked
+        if r is not None and (after is None or (r, user.id) > after)
+    )
+    return [(r, user) for r, _, user in heapq.nsmallest(limit, matches)]
@@ -0,0 +1,89 @@
+# test_compression.py
+import gzip
+import os
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import app
+import compression
+import crud
+from schemas import UserCreate
+
+
+@pytest.fixture()
+def client():
+    crud.get_storage().clear()
+    yield TestClient(app.app)
+    crud.get_storage().clear()
+
+
+def fill(count: int) -> None:
+    storage = crud.get_storage()
+    for i in range(count):
+        storage.create(UserCreate(name=f"User {i}", email=f"user{i}@example.com"))
+
+
+@pytest.mark.parametrize("encoding", compression.ENCODINGS)
+def test_large_responses_are_compressed(client, encoding):
+    fill(50)
+    plain = client.get("/users", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+
+    r = client.get("/users", headers={"Accept-Encoding": f"{encoding}, deflate"})
+    assert r.headers["content-encoding"] == encoding
+    assert "Accept-Encoding" in r.headers["vary"]
+    assert int(r.headers["content-length"]) < len(plain.content)
+    assert r.content == plain.content
+    assert r.headers["etag"] == "W/" + plain.headers["etag"]
+    r = client.get("/users", headers={"Accept-Encoding": encoding, "If-None-Match": r.headers["etag"]})
+    assert r.status_code == 304
+
+
+def test_small_responses_are_not_compressed(client):
+    fill(1)
+    r = client.get("/users/1", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in r.headers
+    assert r.json()["id"] == 1
+
+
+def test_streaming_response_is_compressed_in_chunks(client):
+    fill(1200)
+    with client.stream("GET", "/users/export", headers={"Accept-Encoding": "gzip"}) as r:
+        assert r.headers["content-encoding"] == "gzip"
+        assert "content-length" not in r.headers
+        raw = b"".join(r.iter_raw())
+    lines = gzip.decompress(raw).splitlines()
+    assert len(lines) == 1200
+
+
+def test_precompressed_static_files(tmp_path):
+    (tmp_path / "site.css").write_text("body { color: red; }\n" * 200)
+    (tmp_path / "tiny.css").write_text("a{}")
+    (tmp_path / "pic.png").write_bytes(os.urandom(2048))
+
+    static = compression.PrecompressedStaticFiles(directory=str(tmp_path))
+    static.precompress()
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        ["site.css", "tiny.css", "pic.png"] + [f"site.css{compression.SUFFIXES[e]}" for e in compression.ENCODINGS]
+    )
+    site = FastAPI()
+    site.mount("/static", static)
+    client = TestClient(site)
+
+    for encoding in compression.ENCODINGS:
+        r = client.get("/static/site.css", headers={"Accept-Encoding": encoding})
+        assert r.headers["content-encoding"] == encoding
+        assert r.headers["content-type"].startswith("text/css")
+        assert r.text == "body { color: red; }\n" * 200
+        assert client.get(
+            "/static/site.css", headers={"Accept-Encoding": encoding, "If-None-Match": r.headers["etag"]}
+        ).status_code == 304
+    assert "content-encoding" not in client.get("/static/site.css", headers={"Accept-Encoding": "identity"}).headers
+    assert "content-encoding" not in client.get("/static/pic.png", headers={"Accept-Encoding": "gzip"}).headers
+
+    # a source file edited after startup is served as is
+    stale = os.path.getmtime(tmp_path / "site.css") + 10
+    os.utime(tmp_path / "site.css", (stale, stale))
+    assert "content-encoding" not in client.get("/static/site.css", headers={"Accept-Encoding": "gzip"}).headers
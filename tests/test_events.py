@@ -0,0 +1,161 @@
+# test_events.py
+import asyncio
+
+import pytest
+import crud
+import events
+from schemas import UserCreate, UserUpdate
+
+
+@pytest.fixture()
+def storage():
+    s = crud.get_storage()
+    s.clear()
+    yield s
+    s.clear()
+
+
+def parse(frame: bytes) -> dict:
+    """SSE frame -> {field: value}."""
+    fields = {}
+    for line in filter(None, frame.decode().splitlines()):
+        name, _, value = line.partition(": ")
+        fields[name] = value
+    return fields
+
+
+async def next_frame(stream) -> dict:
+    return parse(await asyncio.wait_for(anext(stream), 1))
+
+
+def test_stream_fans_out_changes(storage):
+    async def scenario():
+        feed = events.ChangeFeed()
+        first, second = events.stream(feed), events.stream(feed)
+        assert await anext(first) == await anext(second) == b"retry: 2000\n\n"
+        assert feed.subscribers == 2
+
+        storage.create(UserCreate(name="A", email="a@example.com"))
+        storage.create(UserCreate(name="B", email="b@example.com"))
+        storage.update(1, UserUpdate(name="A2"))
+        feed.notify()
+        for stream in (first, second):
+            b, a = await next_frame(stream), await next_frame(stream)
+            assert (b["event"], b["data"]) == ("create", storage.encode(storage.get(2)).decode())
+            assert (a["event"], int(a["id"])) == ("create", storage.version())
+
+        storage.delete(2)
+        feed.notify()
+        assert await next_frame(first) == {"id": str(storage.version()), "event": "delete", "data": '{"id":2}'}
+
+        await first.aclose()
+        await second.aclose()
+        assert feed.subscribers == 0
+
+    asyncio.run(scenario())
+
+
+def test_stream_resumes_from_last_event_id(storage):
+    async def scenario():
+        feed = events.ChangeFeed()
+        storage.create(UserCreate(name="A", email="a@example.com"))
+        seen = storage.version()
+        storage.update(1, UserUpdate(name="A2"))
+        storage.create(UserCreate(name="B", email="b@example.com"))
+
+        stream = events.stream(feed, last_event_id=seen)
+        await anext(stream)
+        assert [(f["event"], f["id"]) for f in [await next_frame(stream), await next_frame(stream)]] == [
+            ("update", str(seen + 1)),
+            ("create", str(seen + 2)),
+        ]
+        # changes picked up during catch-up are not sent twice
+        storage.delete(1)
+        feed.notify()
+        assert (await next_frame(stream))["event"] == "delete"
+        await stream.aclose()
+
+        stale = events.stream(feed, last_event_id=0)
+        await anext(stale)
+        assert await anext(stale) == events.RESET
+        await stale.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_slow_subscriber_is_evicted(storage, monkeypatch):
+    monkeypatch.setattr(events.config, "STREAM_QUEUE_SIZE", 1)
+
+    async def scenario():
+        feed = events.ChangeFeed()
+        slow = events.stream(feed)
+        await anext(slow)
+        for i in range(3):
+            storage.create(UserCreate(name=f"U{i}", email=f"u{i}@example.com"))
+            feed.notify()
+            await asyncio.sleep(0.01)
+        assert feed.subscribers == 0
+        with pytest.raises(StopAsyncIteration):
+            await anext(slow)
+
+    asyncio.run(scenario())
+
+
+def test_heartbeat(storage, monkeypatch):
+    monkeypatch.setattr(events.config, "STREAM_HEARTBEAT_SECONDS", 0.01)
+
+    async def scenario():
+        feed = events.ChangeFeed()
+        stream = events.stream(feed)
+        await anext(stream)
+        assert await asyncio.wait_for(anext(stream), 1) == events.HEARTBEAT
+        await stream.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_pump_survives_storage_errors(storage, monkeypatch):
+    async def scenario():
+        feed = events.ChangeFeed()
+        stream = events.stream(feed)
+        await anext(stream)
+
+        original = type(storage).changes
+        failures = []
+
+        def flaky(self, since, limit):
+            if not failures:
+                failures.append(since)
+                raise OSError("disk went away")
+            return original(self, since, limit)
+
+        monkeypatch.setattr(type(storage), "changes", flaky)
+        storage.create(UserCreate(name="A", email="a@example.com"))
+        feed.notify()
+        await asyncio.sleep(0.01)
+        assert failures and not feed._pump_task.done()
+
+        feed.notify()
+        assert (await next_frame(stream))["event"] == "create"
+        await stream.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_finished_pump_is_restarted(storage):
+    async def scenario():
+        feed = events.ChangeFeed()
+        first = events.stream(feed)
+        await anext(first)
+        feed._pump_task.cancel()
+        await asyncio.sleep(0)
+
+        second = events.stream(feed)
+        await anext(second)
+        storage.create(UserCreate(name="A", email="a@example.com"))
+        feed.notify()
+        assert (await next_frame(second))["event"] == "create"
+        await first.aclose()
+        await second.aclose()
+
+    asyncio.run(scenario())
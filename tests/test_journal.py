@@ -0,0 +1,166 @@
+# test_journal.py
+import os
+import threading
+
+import pytest
+import crud
+import database
+from journal import Journal
+from schemas import UserCreate, UserUpdate
+
+
+@pytest.fixture(autouse=True)
+def reset_inmemory_db():
+    database.reset()
+    yield
+    database.reset()
+
+
+def reopen(directory, **kwargs):
+    """Simulate a restart: drop in-memory state and replay from disk."""
+    database.reset()
+    return crud.InMemoryUserStorage(Journal(str(directory), **kwargs))
+
+
+@pytest.mark.parametrize("fsync", ["always", "interval", "os"])
+def test_replay_restores_state(tmp_path, fsync):
+    storage = reopen(tmp_path, fsync=fsync, fsync_interval_ms=5)
+    storage.create(UserCreate(name="A", email="a@example.com"))
+    storage.create(UserCreate(name="B", email="b@example.com"))
+    storage.create(UserCreate(name="C", email="c@example.com"))
+    storage.update(1, UserUpdate(email="a.new@example.com"))
+    storage.delete(3)
+    storage.close()
+
+    storage = reopen(tmp_path, fsync=fsync)
+    assert [(u.id, u.email) for u in storage.list()] == [(1, "a.new@example.com"), (2, "b@example.com")]
+    assert storage.email_exists("a.new@example.com")
+    assert [u.id for _, u in storage.search("a.n")] == [1]
+    # ids of deleted users are never reused
+    assert storage.create(UserCreate(name="D", email="d@example.com")).id == 4
+    storage.close()
+
+
+def test_snapshot_compacts_log(tmp_path):
+    storage = reopen(tmp_path, fsync="os", snapshot_every=3)
+    for i in range(4):
+        storage.create(UserCreate(name=f"U{i}", email=f"u{i}@example.com"))
+    storage.close()
+
+    assert os.path.exists(tmp_path / "snapshot.json")
+    with open(tmp_path / "journal.log") as f:
+        assert len(f.readlines()) == 1
+
+    storage = reopen(tmp_path, fsync="os")
+    assert storage.count() == 4
+    storage.close()
+
+
+def test_snapshot_is_written_without_blocking_writes(tmp_path, monkeypatch):
+    storage = reopen(tmp_path, fsync="always", snapshot_every=3)
+    journal = storage._journal
+    release = threading.Event()
+    write_snapshot = journal._write_snapshot
+
+    def slow_write(*args):
+        release.wait(5)
+        write_snapshot(*args)
+
+    monkeypatch.setattr(journal, "_write_snapshot", slow_write)
+    for i in range(6):
+        storage.create(UserCreate(name=f"U{i}", email=f"u{i}@example.com"))
+    # the snapshot of the first three is still being written
+    assert not os.path.exists(tmp_path / "snapshot.json")
+    assert os.path.exists(tmp_path / "journal.log.1")
+    release.set()
+    storage.close()
+    assert not os.path.exists(tmp_path / "journal.log.1")
+
+    storage = reopen(tmp_path, fsync="os")
+    assert storage.count() == 6
+    storage.close()
+
+
+def test_unfinished_snapshot_keeps_the_old_log(tmp_path, monkeypatch):
+    storage = reopen(tmp_path, fsync="os", snapshot_every=2)
+    # the process dies before any snapshot reaches the disk
+    monkeypatch.setattr(storage._journal, "_write_snapshot", lambda *args: None)
+    for i in range(5):
+        storage.create(UserCreate(name=f"U{i}", email=f"u{i}@example.com"))
+    storage.close()
+    assert not os.path.exists(tmp_path / "snapshot.json")
+
+    storage = reopen(tmp_path, fsync="os", snapshot_every=2)
+    assert [u.name for u in storage.list()] == [f"U{i}" for i in range(5)]
+    storage.create(UserCreate(name="U5", email="u5@example.com"))
+    storage.create(UserCreate(name="U6", email="u6@example.com"))
+    storage.close()
+    assert not os.path.exists(tmp_path / "journal.log.1")
+
+    storage = reopen(tmp_path, fsync="os")
+    assert storage.count() == 7
+    storage.close()
+
+
+def test_torn_tail_is_discarded(tmp_path):
+    storage = reopen(tmp_path, fsync="os")
+    storage.create(UserCreate(name="A", email="a@example.com"))
+    storage.close()
+    with open(tmp_path / "journal.log", "a") as f:
+        f.write('{"seq": 2, "op": "cre')
+
+    storage = reopen(tmp_path, fsync="os")
+    assert storage.count() == 1
+    storage.create(UserCreate(name="B", email="b@example.com"))
+    storage.close()
+
+    storage = reopen(tmp_path, fsync="os")
+    assert [u.name for u in storage.list()] == ["A", "B"]
+    storage.close()
+
+
+def test_replays_records_without_timestamps(tmp_path):
+    # journals written before users had created_at/updated_at/seq
+    with open(tmp_path / "journal.log", "w") as f:
+        f.write('{"seq": 1, "op": "create", "user": {"id": 1, "name": "A", "email": "a@example.com"}}\n')
+
+    storage = reopen(tmp_path, fsync="os")
+    user = storage.get(1)
+    assert user.created_at == user.updated_at
+    assert user.seq == storage.version()
+    # the change log does not survive a restart
+    assert storage.changes(storage.version(), 10) == []
+    with pytest.raises(crud.ChangesExpiredError):
+        storage.changes(0, 10)
+
+    updated = storage.update(1, UserUpdate(name="B"))
+    storage.close()
+    storage = reopen(tmp_path, fsync="os")
+    assert storage.get(1).updated_at == updated.updated_at
+    assert storage.get(1).created_at == user.created_at
+    storage.close()
+
+
+def test_failed_append_leaves_memory_unchanged(tmp_path, monkeypatch):
+    storage = reopen(tmp_path, fsync="os")
+    storage.create(UserCreate(name="A", email="a@example.com"))
+    version = storage.version()
+
+    def broken(op, **fields):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(storage._journal, "append", broken)
+    with pytest.raises(OSError):
+        storage.create(UserCreate(name="B", email="b@example.com"))
+    with pytest.raises(OSError):
+        storage.update(1, UserUpdate(name="A2"))
+    with pytest.raises(OSError):
+        storage.delete(1)
+    with pytest.raises(OSError):
+        storage.create_many([UserCreate(name="C", email="c@example.com")])
+
+    assert [(u.id, u.name) for u in storage.list()] == [(1, "A")]
+    assert not storage.email_exists("b@example.com")
+    assert storage.version() == version
+    monkeypatch.undo()
+    storage.close()
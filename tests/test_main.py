@@ -1,8 +1,12 @@
 # test_main.py
+import json
+
 import pytest
 from fastapi.testclient import TestClient
-from .. import database
+import config
+import crud
 import app
+import routing
 
 
 @pytest.fixture()
@@ -18,11 +22,9 @@ def reset_inmemory_db():
     """
     Reset in-memory storage before each test so tests are independent.
     """
-    database.users.clear()
-    database.next_id = 1
+    crud.get_storage().clear()
     yield
-    database.users.clear()
-    database.next_id = 1
+    crud.get_storage().clear()
 
 
 @pytest.fixture()
@@ -130,3 +132,514 @@ def test_update_to_existing_email_subtests(client, create_user):
 def test_validation_parametrized(client, payload, expected_status):
     r = client.post("/users", json=payload)
     assert r.status_code == expected_status
+
+
+def test_email_released_after_update_and_delete(client, create_user):
+    u1 = create_user("U1", "u1@example.com")
+
+    r = client.put(f"/users/{u1['id']}", json={"email": "u1.new@example.com"})
+    assert r.status_code == 200
+
+    # old email is released, the new one is taken
+    create_user("U2", "u1@example.com")
+    r = client.post("/users", json={"name": "U3", "email": "u1.new@example.com"})
+    assert r.status_code == 400
+
+    r = client.delete(f"/users/{u1['id']}")
+    assert r.status_code == 204
+    create_user("U3", "u1.new@example.com")
+
+
+def test_list_users_keyset_pagination(client, create_user):
+    for i in range(5):
+        create_user(f"U{i}", f"u{i}@example.com")
+    client.delete("/users/2")
+
+    seen = []
+    r = client.get("/users", params={"limit": 2})
+    while True:
+        assert r.status_code == 200
+        seen.extend(u["id"] for u in r.json())
+        cursor = r.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        r = client.get("/users", params={"limit": 2, "after": cursor})
+
+    assert seen == [1, 3, 4, 5]
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "eyJpZCI6ICJ4In0"])
+def test_list_users_invalid_cursor(client, cursor):
+    r = client.get("/users", params={"limit": 2, "after": cursor})
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Invalid cursor"
+
+
+def test_export_users_ndjson(client, create_user):
+    for i in range(3):
+        create_user(f"U{i}", f"u{i}@example.com")
+
+    r = client.get("/users/export")
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in r.text.splitlines()]
+    assert [u["id"] for u in lines] == [1, 2, 3]
+    assert {k: lines[0][k] for k in ("id", "name", "email")} == {"id": 1, "name": "U0", "email": "u0@example.com"}
+
+
+def test_export_closes_the_snapshot_when_streaming_stops(client, create_user, monkeypatch):
+    create_user("U0", "u0@example.com")
+    storage = crud.get_storage()
+    closed = []
+
+    def export():
+        try:
+            while True:
+                yield storage.get(1)
+        finally:
+            closed.append(True)
+
+    def encode(user):
+        raise RuntimeError("client went away")
+
+    monkeypatch.setattr(storage, "export", export)
+    monkeypatch.setattr(storage, "encode", encode)
+    with pytest.raises(RuntimeError):
+        client.get("/users/export")
+    assert closed == [True]
+
+
+def test_conditional_get_user(client, create_user):
+    create_user("U1", "u1@example.com")
+    create_user("U2", "u2@example.com")
+
+    r = client.get("/users/1")
+    etag = r.headers["ETag"]
+    r = client.get("/users/1", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.content == b""
+    assert r.headers["ETag"] == etag
+
+    # changes to other users do not invalidate this one
+    client.put("/users/2", json={"name": "U2 renamed"})
+    assert client.get("/users/1", headers={"If-None-Match": etag}).status_code == 304
+
+    client.put("/users/1", json={"name": "U1 renamed"})
+    r = client.get("/users/1", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.json()["name"] == "U1 renamed"
+    assert r.headers["ETag"] != etag
+
+
+def test_conditional_list_users(client, create_user):
+    create_user("U1", "u1@example.com")
+
+    etag = client.get("/users").headers["ETag"]
+    assert client.get("/users", headers={"If-None-Match": f'"0", {etag}'}).status_code == 304
+    assert client.get("/users", headers={"If-None-Match": f"W/{etag}"}).status_code == 304
+
+    client.delete("/users/1")
+    r = client.get("/users", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.json() == []
+
+
+def test_bulk_create_atomic(client, create_user):
+    create_user("Existing", "taken@example.com")
+
+    batch = [
+        {"name": "A", "email": "a@example.com"},
+        {"name": "B", "email": "taken@example.com"},
+        {"name": "C", "email": "a@example.com"},
+    ]
+    r = client.post("/users/bulk", json=batch)
+    assert r.status_code == 400
+    assert r.json()["created"] == 0
+    assert [item["index"] for item in r.json()["results"]] == [1, 2]
+    assert len(client.get("/users").json()) == 1
+
+    r = client.post("/users/bulk", json=[{"name": "A", "email": "a@example.com"}, {"name": ""}])
+    assert r.status_code == 422
+    assert [item["index"] for item in r.json()["results"]] == [1]
+
+    r = client.post("/users/bulk", json=batch[:1] + [{"name": "D", "email": "d@example.com"}])
+    assert r.status_code == 201
+    assert [item["user"]["id"] for item in r.json()["results"]] == [2, 3]
+
+
+def test_bulk_create_best_effort_ndjson(client, create_user):
+    create_user("Existing", "taken@example.com")
+
+    body = "\n".join([
+        '{"name": "A", "email": "a@example.com"}',
+        '{"name": "B", "email": "taken@example.com"}',
+        "not json",
+        '{"name": "C", "email": "c@example.com"}',
+    ])
+    r = client.post(
+        "/users/bulk",
+        params={"atomic": "false"},
+        content=body,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert r.status_code == 200
+    data = r.json()
+    assert (data["created"], data["failed"]) == (2, 2)
+    assert [item["status"] for item in data["results"]] == [201, 400, 422, 201]
+    # contiguous id block for the created users
+    assert [data["results"][i]["user"]["id"] for i in (0, 3)] == [2, 3]
+
+
+def test_bulk_create_rejects_oversized_batch(client, monkeypatch):
+    monkeypatch.setattr(config, "BULK_MAX_ITEMS", 2)
+    batch = [{"name": f"U{i}", "email": f"u{i}@example.com"} for i in range(3)]
+    assert client.post("/users/bulk", json=batch).status_code == 413
+
+
+def test_batch_get_users(client, create_user):
+    for i in range(3):
+        create_user(f"U{i}", f"u{i}@example.com")
+    client.delete("/users/2")
+
+    r = client.post("/users/batch-get", json={"ids": [3, 2, 1, 3, 42]})
+    assert r.status_code == 200
+    assert [u["id"] for u in r.json()["users"]] == [3, 1]
+    assert r.json()["missing"] == [2, 42]
+
+    assert client.post("/users/batch-get", json={"ids": []}).status_code == 422
+    assert client.post("/users/batch-get", json={"ids": [0]}).status_code == 422
+    too_many = {"ids": list(range(1, config.BULK_MAX_ITEMS + 2))}
+    assert client.post("/users/batch-get", json=too_many).status_code == 422
+    assert client.request("DELETE", "/users/bulk", json=too_many).status_code == 422
+
+
+def test_bulk_update_and_delete(client, create_user):
+    create_user("A", "a@example.com")
+    create_user("B", "b@example.com")
+    create_user("C", "c@example.com")
+
+    r = client.patch("/users/bulk", json=[
+        {"id": 1, "email": "b@example.com"},
+        {"id": 2, "email": "a@example.com"},
+        {"id": 42, "name": "Nobody"},
+    ])
+    assert r.status_code == 400
+    assert [(i["index"], i["status"]) for i in r.json()["results"]] == [(2, 404)]
+
+    r = client.patch("/users/bulk", params={"atomic": "false"}, json=[
+        {"id": 1, "email": "b@example.com"},
+        {"id": 2, "email": "a@example.com"},
+        {"id": 42, "name": "Nobody"},
+        {"id": 3, "email": "bad"},
+    ])
+    assert r.status_code == 200
+    assert (r.json()["updated"], r.json()["failed"]) == (2, 2)
+    assert [i["status"] for i in r.json()["results"]] == [200, 200, 404, 422]
+    assert client.get("/users/1").json()["email"] == "b@example.com"
+
+    r = client.request("DELETE", "/users/bulk", json={"ids": [3, 1, 42]})
+    assert r.status_code == 200
+    assert r.json() == {"deleted": [3, 1], "missing": [42]}
+    assert [u["id"] for u in client.get("/users").json()] == [2]
+
+
+def test_sparse_fieldsets(client, create_user):
+    create_user("Ivan", "ivan@example.com")
+    create_user("Anna", "anna@example.com")
+
+    r = client.get("/users", params={"fields": "name,id"})
+    assert r.json() == [{"id": 1, "name": "Ivan"}, {"id": 2, "name": "Anna"}]
+
+    r = client.get("/users/2", params={"fields": "email"})
+    assert r.json() == {"email": "anna@example.com"}
+
+    r = client.get("/users/2", params={"fields": "id,name,email"})
+    assert r.json() == {"id": 2, "name": "Anna", "email": "anna@example.com"}
+
+    r = client.get("/users", params={"fields": "id,password"})
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Unknown fields: password"
+
+
+def test_count_and_head(client, create_user):
+    assert client.get("/users/count").json() == {"count": 0}
+    create_user("Ivan", "ivan@example.com")
+    create_user("Anna", "anna@example.com")
+    client.delete("/users/1")
+
+    assert client.get("/users/count").json() == {"count": 1}
+
+    r = client.head("/users")
+    assert r.status_code == 200
+    assert r.headers["x-total-count"] == "1"
+    assert r.headers["etag"] == client.get("/users").headers["etag"]
+    assert r.content == b""
+    assert client.head("/users", headers={"If-None-Match": r.headers["etag"]}).status_code == 304
+
+    r = client.head("/users/2")
+    assert r.status_code == 200
+    assert r.headers["etag"] == client.get("/users/2").headers["etag"]
+    assert client.head("/users/2", headers={"If-None-Match": r.headers["etag"]}).status_code == 304
+
+    r = client.head("/users/1")
+    assert r.status_code == 404
+    assert r.content == b""
+
+
+@pytest.mark.parametrize("path, media_type", [
+    ("/users/count", "application/json"),
+    ("/users/export", "application/x-ndjson"),
+    ("/users/search?q=iv", "application/json"),
+    ("/users/changes?since={seq}", "application/json"),
+    ("/users/stats/domains", "application/json"),
+    ("/users/stream", "text/event-stream"),
+])
+def test_head_on_fixed_user_paths(client, create_user, path, media_type):
+    create_user("Ivan", "ivan@example.com")
+    r = client.head(path.format(seq=client.get("/users").headers["x-change-seq"]))
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith(media_type)
+    assert r.content == b""
+
+
+@pytest.mark.parametrize("mode, blocking, inline", [
+    ("async", False, True),
+    ("async", True, False),
+    ("sync", False, False),
+])
+def test_api_mode_picks_where_handlers_run(client, create_user, monkeypatch, mode, blocking, inline):
+    create_user("Ivan", "ivan@example.com")
+    monkeypatch.setattr(config, "API_MODE", mode)
+    monkeypatch.setattr(crud.get_storage(), "blocking", blocking)
+    offloaded = []
+    original = routing.run_in_threadpool
+
+    async def spy(func, *args, **kwargs):
+        offloaded.append(func.__name__)
+        return await original(func, *args, **kwargs)
+
+    monkeypatch.setattr(routing, "run_in_threadpool", spy)
+
+    assert client.get("/users/1").json()["name"] == "Ivan"
+    assert client.put("/users/1", json={"name": "Anna"}).json()["name"] == "Anna"
+    # writes wait for the storage lock, so they never run inline
+    assert offloaded == (["update_user"] if inline else ["get_user", "update_user"])
+
+    # bulk requests and the unbounded list never run on the event loop
+    offloaded.clear()
+    assert client.get("/users", params={"limit": 10}).status_code == 200
+    assert client.get("/users").status_code == 200
+    assert client.request("DELETE", "/users/bulk", json={"ids": [1]}).json()["deleted"] == [1]
+    assert offloaded == (["list_users", "delete_users_bulk"] if inline else ["list_users"] * 2 + ["delete_users_bulk"])
+
+
+def test_search_users(client, create_user):
+    create_user("Иван Петров", "ivan@example.com")
+    create_user("Пётр Иванов", "petr@example.com")
+    create_user("Анна", "anna@example.com")
+
+    r = client.get("/users/search", params={"q": "иван", "limit": 1, "fields": "id"})
+    assert r.json() == [{"id": 1}]
+    r = client.get("/users/search", params={"q": "иван", "after": r.headers["x-next-cursor"]})
+    assert [u["id"] for u in r.json()] == [2]
+    assert "x-next-cursor" not in r.headers
+
+    assert client.get("/users/search", params={"q": "an"}).json()[0]["email"] == "anna@example.com"
+    assert client.get("/users/search", params={"q": "zzz"}).json() == []
+    assert client.get("/users/search", params={"q": ""}).status_code == 422
+    assert client.get("/users/search", params={"q": "a", "after": "bad"}).status_code == 400
+
+
+def test_domain_filter_and_stats(client, create_user):
+    create_user("Ivan", "ivan@example.com")
+    create_user("Anna", "anna@mail.ru")
+    create_user("Petr", "petr@example.com")
+
+    r = client.get("/users", params={"domain": "example.com", "limit": 1})
+    assert [u["id"] for u in r.json()] == [1]
+    r = client.get("/users", params={"domain": "example.com", "after": r.headers["x-next-cursor"]})
+    assert [u["id"] for u in r.json()] == [3]
+
+    client.put("/users/2", json={"email": "anna@example.com"})
+    assert client.get("/users/stats/domains").json() == [{"domain": "example.com", "users": 3}]
+
+
+def test_sorted_listing(client, create_user):
+    create_user("Vera", "vera@example.com")
+    create_user("Anna", "anna@example.com")
+    create_user("Boris", "boris@example.com")
+
+    names = []
+    r = client.get("/users", params={"sort": "-name", "limit": 2})
+    names += [u["name"] for u in r.json()]
+    r = client.get("/users", params={"sort": "-name", "limit": 2, "after": r.headers["x-next-cursor"]})
+    names += [u["name"] for u in r.json()]
+    assert names == ["Vera", "Boris", "Anna"]
+    assert "x-next-cursor" not in r.headers
+
+    cursor = client.get("/users", params={"sort": "name", "limit": 1}).headers["x-next-cursor"]
+    assert client.get("/users", params={"sort": "email", "after": cursor}).status_code == 400
+    assert client.get("/users", params={"sort": "password"}).status_code == 422
+    assert client.get("/users", params={"sort": "name", "domain": "example.com"}).status_code == 400
+
+
+def test_delta_sync(client, create_user):
+    ivan = create_user("Ivan", "ivan@example.com")
+    create_user("Anna", "anna@example.com")
+    r = client.get("/users")
+    since = int(r.headers["x-change-seq"])
+    assert since == max(u["seq"] for u in r.json())
+    assert ivan["created_at"] == ivan["updated_at"]
+
+    client.put("/users/1", json={"name": "Ivan P"})
+    client.delete("/users/2")
+    create_user("Petr", "petr@example.com")
+
+    r = client.get("/users/changes", params={"since": since})
+    assert r.status_code == 200
+    body = r.json()
+    assert [(c["op"], c["id"]) for c in body["changes"]] == [("update", 1), ("delete", 2), ("create", 3)]
+    assert body["changes"][0]["user"]["name"] == "Ivan P"
+    assert body["changes"][0]["user"]["created_at"] == ivan["created_at"]
+    assert body["changes"][1]["user"] is None
+    assert body["next_since"] == body["changes"][-1]["seq"] == since + 3
+    assert body["has_more"] is False
+
+    r = client.get("/users/changes", params={"since": since, "limit": 2})
+    assert r.json()["has_more"] is True
+    r = client.get("/users/changes", params={"since": r.json()["next_since"]})
+    assert [c["id"] for c in r.json()["changes"]] == [3]
+
+    r = client.get("/users/changes", params={"since": since + 3})
+    assert r.json() == {"changes": [], "next_since": since + 3, "has_more": False}
+    assert client.get("/users/changes", params={"since": 0}).status_code == 410
+    assert client.get("/users", params={"fields": "id,seq"}).json() == [
+        {"id": 1, "seq": since + 1},
+        {"id": 3, "seq": since + 3},
+    ]
+
+
+def test_websocket_crud(client):
+    with client.websocket_connect("/ws/users") as ws:
+        def call(**message):
+            ws.send_json(message)
+            return ws.receive_json()
+
+        r = call(id=1, op="create", user={"name": "Ivan", "email": "ivan@example.com"})
+        assert (r["id"], r["status"], r["user"]["id"]) == (1, 201, 1)
+        assert call(id=2, op="create", user={"name": "Anna", "email": "ivan@example.com"}) == {
+            "id": 2, "status": 400, "detail": "Email already exists",
+        }
+        assert call(id="g", op="get", user_id=1)["user"] == client.get("/users/1").json()
+
+        r = call(id=3, op="update", user_id=1, user={"name": "Ivan P"})
+        assert (r["status"], r["user"]["name"]) == (200, "Ivan P")
+        assert call(id=4, op="update", user_id=1, user={"email": "bad"})["status"] == 422
+
+        call(id=5, op="create", user={"name": "Anna", "email": "anna@example.com"})
+        r = call(id=6, op="list", limit=1)
+        assert ([u["id"] for u in r["users"]], r["next"]) == ([1], 1)
+        r = call(id=7, op="list", limit=1, after=1)
+        assert ([u["id"] for u in r["users"]], r["next"]) == ([2], None)
+
+        # pipelined requests are answered in order and matched by id
+        ws.send_json({"id": 8, "op": "delete", "user_id": 2})
+        ws.send_json({"id": 9, "op": "get", "user_id": 2})
+        assert ws.receive_json() == {"id": 8, "status": 204}
+        assert ws.receive_json() == {"id": 9, "status": 404, "detail": "User not found"}
+
+        assert call(id=10, op="get")["detail"] == "user_id: Field required"
+        assert call(id=11, op="drop")["status"] == 422
+        ws.send_text("not json")
+        assert ws.receive_json() == {"id": None, "status": 400, "detail": "Invalid JSON"}
+        r = call(id=2**64, op="get", user_id=1)
+        assert (r["id"], r["status"]) == (None, 422)
+        assert [u["id"] for u in call(id=14, op="list")["users"]] == [1]
+        ws.send_bytes(b'{"id": 12, "op": "get", "user_id": 1}')
+        assert ws.receive_json() == {"id": None, "status": 400, "detail": "Expected a text frame"}
+        assert call(id=13, op="get", user_id=1)["status"] == 200
+
+    assert [u["name"] for u in client.get("/users").json()] == ["Ivan P"]
+
+
+@pytest.mark.parametrize("module,media_type", [("msgpack", "application/msgpack"), ("cbor2", "application/cbor")])
+def test_binary_formats(client, module, media_type):
+    codec = pytest.importorskip(module)
+    pack, unpack = (codec.packb, codec.unpackb) if module == "msgpack" else (codec.dumps, codec.loads)
+    headers = {"Content-Type": media_type, "Accept": media_type}
+
+    r = client.post("/users", content=pack({"name": "Ivan", "email": "ivan@example.com"}), headers=headers)
+    assert (r.status_code, r.headers["content-type"]) == (201, media_type)
+    assert "Accept" in r.headers["vary"]
+    ivan = unpack(r.content)
+    assert ivan == client.get("/users/1").json()
+
+    r = client.put("/users/1", content=pack({"email": "bad"}), headers=headers)
+    assert r.status_code == 422
+    r = client.put("/users/1", content=pack({"name": "Ivan P"}), headers=headers)
+    assert unpack(r.content)["name"] == "Ivan P"
+
+    users = [{"name": f"U{i}", "email": f"u{i}@example.com"} for i in range(30)]
+    r = client.post("/users/bulk", content=pack(users), headers=headers)
+    assert (r.status_code, unpack(r.content)["created"]) == (201, 30)
+    r = client.post("/users/bulk", content=pack({"name": "X"}), headers=headers)
+    assert r.status_code == 400
+
+    # byte strings are not JSON values: rejected while decoding, not a 500 on validation
+    binary = {"name": b"\xff", "email": "b@example.com"}
+    assert client.post("/users", content=pack(binary), headers=headers).status_code == 400
+    assert client.post("/users/bulk", content=pack([binary]), headers=headers).status_code == 400
+
+    # arrays are assembled from per-user encodings: check both short and long headers
+    for limit in (3, 31):
+        r = client.get("/users", params={"limit": limit, "fields": "id,name"}, headers={"Accept": media_type})
+        assert unpack(r.content) == client.get("/users", params={"limit": limit, "fields": "id,name"}).json()
+    r = client.post("/users/batch-get", json={"ids": [1, 99]}, headers={"Accept": media_type})
+    assert unpack(r.content)["missing"] == [99]
+
+    # each representation has its own ETag
+    json_etag = client.get("/users/1").headers["etag"]
+    r = client.get("/users/1", headers={"Accept": media_type})
+    assert r.headers["etag"] != json_etag
+    assert client.get("/users/1", headers={"Accept": media_type, "If-None-Match": json_etag}).status_code == 200
+    assert client.get("/users/1", headers={"Accept": media_type, "If-None-Match": r.headers["etag"]}).status_code == 304
+    assert client.head("/users/1", headers={"Accept": media_type}).headers["etag"] == r.headers["etag"]
+    assert client.get("/users", headers={"Accept": media_type}).headers["etag"] != client.get("/users").headers["etag"]
+
+    # JSON stays the default and errors are always JSON
+    assert client.get("/users/1", headers={"Accept": "text/html, */*"}).headers["content-type"] == "application/json"
+    r = client.get("/users/999", headers={"Accept": media_type})
+    assert r.json() == {"detail": "User not found"}
+
+
+def test_docs_are_served_from_cache(client):
+    r = client.get("/openapi.json", headers={"Accept-Encoding": "identity"})
+    assert r.json() == app.app.openapi()
+    assert r.headers["cache-control"].startswith("public, max-age=")
+    etag = r.headers["etag"]
+    assert not etag.startswith("W/")
+
+    r = client.get("/openapi.json", headers={"Accept-Encoding": "gzip"})
+    assert r.headers["content-encoding"] == "gzip"
+    assert r.headers["etag"] != etag
+    assert r.json() == app.app.openapi()
+    assert client.get("/openapi.json", headers={"Accept-Encoding": "gzip", "If-None-Match": r.headers["etag"]}).status_code == 304
+    assert client.get("/openapi.json", headers={"If-None-Match": etag}).status_code == 200
+
+    for url in ("/docs", "/redoc"):
+        r = client.get(url)
+        assert r.headers["content-type"].startswith("text/html")
+        assert "/openapi.json" in r.text
+    assert "/docs" not in client.get("/openapi.json").json()["paths"]
+
+
+def test_docs_follow_root_path():
+    proxied = TestClient(app.app, root_path="/api")
+    schema = proxied.get("/openapi.json").json()
+    assert schema["servers"] == [{"url": "/api"}]
+    swagger = proxied.get("/docs").text
+    assert "/api/openapi.json" in swagger and "/api/docs/oauth2-redirect" in swagger
+    assert "/api/openapi.json" in proxied.get("/redoc").text
+
+    # the unprefixed variant is cached separately
+    assert "servers" not in TestClient(app.app).get("/openapi.json").json()
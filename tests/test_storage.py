@@ -0,0 +1,518 @@
+# test_storage.py
+import sqlite3
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import crud
+from journal import Journal
+from schemas import UserCreate, UserUpdate
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    """
+    Storage backend under test, empty before and after each test.
+    """
+    if request.param == "memory":
+        s = crud.InMemoryUserStorage()
+    else:
+        s = crud.SQLiteUserStorage(str(tmp_path / "users.db"), pool_size=4)
+    s.clear()
+    yield s
+    s.clear()
+    s.close()
+
+
+def test_storage_contract(storage):
+    u1 = storage.create(UserCreate(name="A", email="a@example.com"))
+    u2 = storage.create(UserCreate(name="B", email="b@example.com"))
+    assert (u1.id, u2.id) == (1, 2)
+    assert storage.count() == 2
+    assert [u.id for u in storage.list()] == [1, 2]
+    assert [u.id for u in storage.page(after=1, limit=5)] == [2]
+    assert storage.get(1) == u1
+    assert storage.get(999) is None
+    assert storage.get_many([2, 999, 1]) == {1: u1, 2: u2}
+    assert storage.email_exists("a@example.com")
+
+    with pytest.raises(crud.EmailAlreadyExistsError):
+        storage.create(UserCreate(name="A2", email="a@example.com"))
+    with pytest.raises(crud.EmailAlreadyExistsError):
+        storage.update(2, UserUpdate(email="a@example.com"))
+
+    updated = storage.update(1, UserUpdate(email="a.new@example.com"))
+    assert updated.name == "A" and updated.email == "a.new@example.com"
+    assert not storage.email_exists("a@example.com")
+    assert storage.update(999, UserUpdate(name="X")) is None
+
+    assert storage.delete(1)
+    assert not storage.delete(1)
+    assert not storage.email_exists("a.new@example.com")
+    assert storage.count() == 1
+
+
+def test_set_storage_swaps_backend():
+    original = crud.get_storage()
+    replacement = crud.InMemoryUserStorage()
+    try:
+        crud.set_storage(replacement)
+        assert crud.get_storage() is replacement
+    finally:
+        crud.set_storage(original)
+
+
+def test_sqlite_survives_reopen_and_shares_pool_across_threads(tmp_path):
+    path = str(tmp_path / "users.db")
+    storage = crud.SQLiteUserStorage(path, pool_size=2)
+
+    def create(i):
+        return storage.create(UserCreate(name=f"U{i}", email=f"u{i}@example.com")).id
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        ids = list(pool.map(create, range(50)))
+    assert sorted(ids) == list(range(1, 51))
+    assert storage._opened <= 2
+    storage.close()
+
+    reopened = crud.SQLiteUserStorage(path, pool_size=2)
+    assert reopened.count() == 50
+    assert reopened.email_exists("u0@example.com")
+    reopened.close()
+
+
+def test_concurrent_creates_keep_ids_and_emails_unique(storage):
+    payloads = [UserCreate(name=f"U{i}", email=f"u{i % 20}@example.com") for i in range(200)]
+
+    def create(payload):
+        try:
+            return storage.create(payload).id
+        except crud.EmailAlreadyExistsError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        ids = [i for i in pool.map(create, payloads) if i is not None]
+
+    assert len(ids) == 20
+    assert len(set(ids)) == 20
+    assert storage.count() == 20
+
+
+def test_export_is_a_snapshot(storage):
+    for i in range(3):
+        storage.create(UserCreate(name=f"U{i}", email=f"u{i}@example.com"))
+
+    exported = storage.export()
+    first = next(exported)
+    storage.delete(3)
+    storage.create(UserCreate(name="U3", email="u3@example.com"))
+
+    assert [first.id] + [u.id for u in exported] == [1, 2, 3]
+
+
+def test_encode_follows_updates(storage):
+    user = storage.create(UserCreate(name="A", email="a@example.com"))
+    assert storage.encode(user).startswith(b'{"id":1,"name":"A","email":"a@example.com","created_at":"')
+    assert storage.encode(user) == user.model_dump_json().encode()
+
+    updated = storage.update(1, UserUpdate(name="Б"))
+    assert storage.encode(updated).startswith('{"id":1,"name":"Б","email":"a@example.com",'.encode())
+    assert storage.encode(updated) == updated.model_dump_json().encode()
+
+
+def test_versions_grow_on_every_write(storage):
+    v0 = storage.version()
+    storage.create(UserCreate(name="A", email="a@example.com"))
+    storage.create(UserCreate(name="B", email="b@example.com"))
+    v_a = storage.user_version(1)
+    assert storage.version() > v0
+
+    storage.update(2, UserUpdate(name="B2"))
+    assert storage.user_version(1) == v_a
+    assert storage.user_version(2) > v_a
+
+    before_delete = storage.version()
+    storage.delete(2)
+    assert storage.user_version(2) is None
+    assert storage.version() > before_delete
+
+
+def test_sqlite_migrates_table_without_version(tmp_path):
+    path = str(tmp_path / "users.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, email TEXT NOT NULL)")
+    conn.execute("INSERT INTO users (name, email) VALUES ('A', 'a@example.com')")
+    conn.commit()
+    conn.close()
+
+    storage = crud.SQLiteUserStorage(path, pool_size=1)
+    assert storage.user_version(1) == 0
+    assert storage.count() == 1
+    storage.update(1, UserUpdate(name="A2"))
+    assert storage.user_version(1) == storage.version() > 0
+    storage.close()
+
+
+def test_sqlite_migrates_store_meta_without_count(tmp_path):
+    path = str(tmp_path / "users.db")
+    storage = crud.SQLiteUserStorage(path, pool_size=1)
+    storage.create(UserCreate(name="A", email="a@example.com"))
+    storage.close()
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        DROP TRIGGER users_count_insert;
+        DROP TRIGGER users_count_delete;
+        ALTER TABLE store_meta DROP COLUMN user_count;
+        INSERT INTO users (name, email, created_at, updated_at) VALUES ('B', 'b@example.com', '', '');
+    """)
+    conn.close()
+
+    storage = crud.SQLiteUserStorage(path, pool_size=1)
+    assert storage.count() == 2
+    storage.delete(1)
+    assert storage.count() == 1
+    storage.close()
+
+
+def test_create_many(storage):
+    storage.create(UserCreate(name="A", email="a@example.com"))
+    batch = [
+        UserCreate(name="B", email="b@example.com"),
+        UserCreate(name="A2", email="a@example.com"),
+        UserCreate(name="B2", email="b@example.com"),
+        UserCreate(name="C", email="c@example.com"),
+    ]
+
+    with pytest.raises(crud.BulkConflictError) as e:
+        storage.create_many(batch, atomic=True)
+    assert e.value.conflicts == [1, 2]
+    assert storage.count() == 1
+
+    created = storage.create_many(batch)
+    assert [u.id if u else None for u in created] == [2, None, None, 3]
+    assert storage.get(3).email == "c@example.com"
+    assert storage.create_many([]) == []
+
+
+def test_update_many_checks_emails_across_the_batch(storage):
+    for name in "abcd":
+        storage.create(UserCreate(name=name.upper(), email=f"{name}@example.com"))
+
+    # swap a <-> b, and c takes d's email while d's own update fails,
+    # so d keeps its email and c must fail too
+    changes = [
+        (1, UserUpdate(email="b@example.com")),
+        (2, UserUpdate(email="a@example.com")),
+        (3, UserUpdate(email="d@example.com")),
+        (4, UserUpdate(email="a@example.com")),
+        (99, UserUpdate(name="X")),
+        (1, UserUpdate(name="dup")),
+    ]
+    with pytest.raises(crud.BulkConflictError) as e:
+        storage.update_many(changes, atomic=True)
+    assert e.value.conflicts == [2, 3, 4, 5]
+    assert storage.get(1).email == "a@example.com"
+
+    results = storage.update_many(changes)
+    assert [type(r).__name__ for r in results] == [
+        "User", "User", "EmailAlreadyExistsError", "EmailAlreadyExistsError", "UserNotFoundError", "DuplicateIdError",
+    ]
+    assert [storage.get(i).email for i in (1, 2, 3, 4)] == [
+        "b@example.com", "a@example.com", "c@example.com", "d@example.com",
+    ]
+    assert storage.email_exists("a@example.com") and storage.email_exists("b@example.com")
+    with pytest.raises(crud.EmailAlreadyExistsError):
+        storage.create(UserCreate(name="X", email="b@example.com"))
+
+
+def test_update_many_swap_is_one_change_per_user(storage):
+    storage.create(UserCreate(name="A", email="a@one.example"))
+    storage.create(UserCreate(name="B", email="b@two.example"))
+    version = storage.version()
+
+    storage.update_many([
+        (1, UserUpdate(email="b@two.example")),
+        (2, UserUpdate(email="a@one.example")),
+    ])
+    assert storage.version() == version + 2
+    assert [user_id for _, user_id, _ in storage.changes(version, 10)] == [1, 2]
+    assert sorted(storage.domain_stats()) == [("one.example", 1), ("two.example", 1)]
+
+
+def test_delete_many(storage, monkeypatch):
+    monkeypatch.setattr(crud, "BULK_REINDEX_THRESHOLD", 1)
+    for i in range(5):
+        storage.create(UserCreate(name=f"U{i}", email=f"u{i}@example.com"))
+
+    assert storage.delete_many([4, 2, 42, 2]) == [4, 2]
+    assert [u.id for u in storage.page(after=1)] == [3, 5]
+    assert not storage.email_exists("u1@example.com")
+    assert storage.count() == 3
+
+
+def test_async_storage(storage):
+    async def scenario():
+        async_storage = crud.AsyncUserStorage(storage)
+        user = await async_storage.create(UserCreate(name="A", email="a@example.com"))
+        await async_storage.update(user.id, UserUpdate(name="A2"))
+        assert (await async_storage.get(user.id)).name == "A2"
+        assert await async_storage.count() == 1
+        assert await async_storage.user_version(user.id) == await async_storage.version()
+        assert await async_storage.delete_many([user.id, 42]) == [user.id]
+        assert await async_storage.list() == []
+
+    asyncio.run(scenario())
+
+
+def test_async_storage_writes_do_not_block_the_loop(monkeypatch):
+    monkeypatch.setattr(crud.config, "API_MODE", "async")
+    storage = crud.InMemoryUserStorage()
+    storage.clear()
+
+    async def scenario():
+        async_storage = crud.AsyncUserStorage(storage)
+        # a bulk operation in another thread holds the writer lock
+        storage._lock.acquire()
+        create = asyncio.create_task(async_storage.create(UserCreate(name="A", email="a@example.com")))
+        changes = asyncio.create_task(async_storage.changes(storage.version(), 10))
+        await asyncio.sleep(0.05)
+        assert not create.done() and not changes.done()
+        storage._lock.release()
+        assert (await create).id == 1
+        await changes
+
+    asyncio.run(scenario())
+    storage.clear()
+
+
+def test_blocking_flags(tmp_path):
+    assert not crud.InMemoryUserStorage().blocking
+    journaled = crud.InMemoryUserStorage(Journal(str(tmp_path / "journal"), fsync="os"))
+    assert journaled.blocking
+    journaled.close()
+    storage = crud.SQLiteUserStorage(str(tmp_path / "users.db"), pool_size=1)
+    assert storage.blocking
+    storage.close()
+
+
+def test_search_ranks_and_follows_writes(storage, monkeypatch):
+    monkeypatch.setattr(crud, "BULK_REINDEX_THRESHOLD", 2)
+    storage.create_many([
+        UserCreate(name="Иван Петров", email="ivan@example.com"),
+        UserCreate(name="Пётр Иванов", email="petr@example.com"),
+        UserCreate(name="Анна", email="ivanova@example.com"),
+        UserCreate(name="Диван", email="sofa@example.com"),
+    ])
+    storage.create(UserCreate(name="Иванна", email="anna@example.com"))
+
+    def ids(query, after=None, limit=20):
+        return [user.id for _, user in storage.search(query, after, limit)]
+
+    # Префикс email, имя с начала, слово имени, подстрока.
+    assert ids("ИВАН") == [1, 5, 2, 4]
+    assert ids("ivan") == [1, 3]
+    assert ids("ivan@example.com") == [1]
+    assert ids("iv") == [1, 3]
+    assert ids("ив") == []
+    assert ids("петров") == [1]
+
+    rank, user = storage.search("иван", limit=2)[-1]
+    assert ids("иван", after=(rank, user.id)) == [2, 4]
+
+    storage.update(1, UserUpdate(name="Сидор", email="sidor@example.com"))
+    storage.delete(3)
+    assert ids("иван") == [5, 2, 4]
+    assert ids("сид") == [1]
+    assert storage.delete_many([4, 5, 2]) == [4, 5, 2]
+    assert ids("иван") == []
+    assert ids("s") == [1]
+
+
+def test_sqlite_indexes_existing_names_for_search(tmp_path):
+    path = str(tmp_path / "users.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, email TEXT NOT NULL)")
+    conn.execute("INSERT INTO users (name, email) VALUES ('Иван Петров', 'a@example.com')")
+    conn.commit()
+    conn.close()
+
+    storage = crud.SQLiteUserStorage(path, pool_size=1)
+    assert [user.id for _, user in storage.search("петр")] == [1]
+    storage.close()
+
+
+def test_domain_index_and_stats(storage, monkeypatch):
+    monkeypatch.setattr(crud, "BULK_REINDEX_THRESHOLD", 1)
+    storage.create_many([
+        UserCreate(name="A", email="a@example.com"),
+        UserCreate(name="B", email="b@Mail.RU"),
+        UserCreate(name="C", email="c@example.com"),
+        UserCreate(name="D", email="d@example.com"),
+    ])
+    assert storage.domain_stats() == [("example.com", 3), ("mail.ru", 1)]
+    assert [u.id for u in storage.page(domain="EXAMPLE.com")] == [1, 3, 4]
+    assert [u.id for u in storage.page(after=1, limit=1, domain="example.com")] == [3]
+    assert storage.page(domain="nowhere.org") == []
+
+    storage.update(1, UserUpdate(email="a@mail.ru"))
+    assert [u.id for u in storage.page(domain="mail.ru")] == [1, 2]
+    assert storage.domain_stats(limit=1) == [("example.com", 2)]
+
+    storage.delete_many([3, 4])
+    storage.delete(2)
+    assert storage.domain_stats() == [("mail.ru", 1)]
+    assert storage.page(domain="example.com") == []
+
+
+def test_sqlite_counts_domains_of_existing_users(tmp_path):
+    path = str(tmp_path / "users.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, email TEXT NOT NULL)")
+    conn.executemany("INSERT INTO users (name, email) VALUES (?, ?)", [("A", "a@x.org"), ("B", "b@X.org")])
+    conn.commit()
+    conn.close()
+
+    storage = crud.SQLiteUserStorage(path, pool_size=1)
+    assert storage.domain_stats() == [("x.org", 2)]
+    assert [u.id for u in storage.page(domain="x.org")] == [1, 2]
+    storage.close()
+
+
+def test_page_by_sorted_indexes(storage, monkeypatch):
+    monkeypatch.setattr(crud, "BULK_REINDEX_THRESHOLD", 2)
+    storage.create_many([
+        UserCreate(name="Борис", email="Zed@example.com"),
+        UserCreate(name="Анна", email="b@example.com"),
+        UserCreate(name="Борис", email="a@example.com"),
+    ])
+    storage.create(UserCreate(name="Вера", email="c@example.com"))
+
+    def ids(field, descending=False, after=None, limit=None):
+        return [u.id for u in storage.page_by(field, descending, after, limit)]
+
+    assert ids("name") == [2, 1, 3, 4]
+    assert ids("name", descending=True) == [4, 3, 1, 2]
+    assert ids("name", after=("Борис", 1), limit=2) == [3, 4]
+    assert ids("name", descending=True, after=("Борис", 3), limit=1) == [1]
+    assert ids("email") == [3, 2, 4, 1]
+    assert ids("id", descending=True, after=(3, 3)) == [2, 1]
+
+    storage.update(4, UserUpdate(name="Алла", email="0@example.com"))
+    storage.delete_many([1, 2, 3])
+    assert ids("name") == ids("email") == [4]
+
+
+def test_non_ascii_emails_fold_like_python(storage):
+    storage.create(UserCreate(name="A", email="Ärmel@example.com"))
+    storage.create(UserCreate(name="B", email="äpfel@example.com"))
+    storage.create(UserCreate(name="C", email="bob@example.com"))
+
+    # "ä" < "ä" + "r": SQLite's ASCII-only lower() would put "Ä..." first
+    assert [u.id for u in storage.page_by("email", False, None, None)] == [3, 2, 1]
+    after = (crud.SORT_KEYS["email"](storage.get(2)), 2)
+    assert [u.id for u in storage.page_by("email", False, after, None)] == [1]
+    assert [u.id for _, u in storage.search("ÄR")] == [1]
+    assert {u.id for _, u in storage.search("ä")} == {1, 2}
+
+
+def test_change_log(storage):
+    storage.create(UserCreate(name="A", email="a@example.com"))
+    storage.create(UserCreate(name="B", email="b@example.com"))
+    since = storage.version()
+    storage.update(1, UserUpdate(name="A2"))
+    storage.delete(2)
+    storage.create(UserCreate(name="C", email="c@example.com"))
+    storage.create(UserCreate(name="D", email="d@example.com"))
+    storage.delete(4)
+
+    records = storage.changes(since, 100)
+    assert [seq - since for seq, _, _ in records] == [1, 2, 3, 4, 5]
+    assert crud.collapse_changes(records) == [
+        (since + 1, 1, "update"),
+        (since + 2, 2, "delete"),
+        (since + 3, 3, "create"),
+    ]
+    assert storage.changes(since, 2) == records[:2]
+    assert storage.changes(storage.version(), 100) == []
+    assert storage.get(1).seq == storage.user_version(1) == since + 1
+    assert storage.get(1).updated_at > storage.get(1).created_at
+
+    # the log starts when the store was cleared; unknown points need a full resync
+    assert storage.changes(since - 2, 100)[0][1:] == (1, "create")
+    for stale in (since - 3, storage.version() + 1):
+        with pytest.raises(crud.ChangesExpiredError):
+            storage.changes(stale, 100)
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_change_log_is_bounded(backend, tmp_path, monkeypatch):
+    monkeypatch.setattr(crud.config, "CHANGELOG_SIZE", 3)
+    if backend == "memory":
+        storage = crud.InMemoryUserStorage()
+    else:
+        storage = crud.SQLiteUserStorage(str(tmp_path / "users.db"), pool_size=1)
+    storage.clear()
+    start = storage.version()
+    storage.create_many([UserCreate(name=f"U{i}", email=f"u{i}@example.com") for i in range(10)])
+
+    with pytest.raises(crud.ChangesExpiredError):
+        storage.changes(start, 100)
+    assert [user_id for _, user_id, _ in storage.changes(storage.version() - 3, 100)] == [8, 9, 10]
+    storage.clear()
+    storage.close()
+
+
+def test_export_encodes_the_snapshot_version(storage):
+    for i in range(3):
+        storage.create(UserCreate(name=f"U{i}", email=f"u{i}@example.com"))
+
+    exported = storage.export()
+    next(exported)
+    storage.update(3, UserUpdate(name="CHANGED"))
+
+    last = list(exported)[-1]
+    assert last.name == "U2"
+    assert storage.encode(last) == last.model_dump_json().encode()
+
+
+def test_sqlite_export_does_not_hold_a_pooled_connection(tmp_path):
+    storage = crud.SQLiteUserStorage(str(tmp_path / "users.db"), pool_size=1)
+    for i in range(3):
+        storage.create(UserCreate(name=f"U{i}", email=f"u{i}@example.com"))
+
+    exported = storage.export()
+    next(exported)
+    # the only pooled connection is still free for other requests
+    assert storage.get(2).name == "U1"
+    exported.close()
+    storage.close()
+
+
+def test_sqlite_migrates_to_folded_email_column(tmp_path):
+    path = str(tmp_path / "users.db")
+    storage = crud.SQLiteUserStorage(path, pool_size=1)
+    storage.create(UserCreate(name="A", email="Élan@example.com"))
+    storage.create(UserCreate(name="B", email="b@example.com"))
+    storage.close()
+    # a database from before the email_folded column
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        DROP INDEX ix_users_email_fold;
+        ALTER TABLE users DROP COLUMN email_folded;
+        CREATE INDEX ix_users_email_lower ON users (lower(email));
+    """)
+    conn.close()
+
+    storage = crud.SQLiteUserStorage(path, pool_size=1)
+    assert [u.id for _, u in storage.search("éla")] == [1]
+    assert [u.id for u in storage.page_by("email")] == [2, 1]
+    storage.close()
+    conn = sqlite3.connect(path)
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "ix_users_email_fold" in indexes and "ix_users_email_lower" not in indexes
+    # the file needs no functions of the application
+    with conn:
+        conn.execute("UPDATE users SET name = 'B2' WHERE id = 2")
+        conn.execute("DELETE FROM users WHERE id = 1")
+    assert conn.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+    conn.close()
\ No newline at end of file